@@ -0,0 +1,112 @@
+# Post-run analysis of ES-EKF estimates.
+#
+# Converts the estimated orientations to RPY angles and projects the attitude error
+# covariance onto them, J P J^T with J the first-order RPY Jacobian, for all recorded steps
+# at once. The results object is what the error plots and the submission writer consume.
+import numpy as np
+from covariance import CovarianceRecorder
+from rotations import QuaternionArray, angle_normalize
+
+
+def rpy_jacobian_diag(a):
+    """
+    Diagonal of rotations.rpy_jacobian_axis_angle() for N x 3 axis-angle vectors.
+
+    With u = a / |a| and t = |a|, the product Jr @ Ja of that function reduces to
+    diag(1 / (1 + a_x^2), 1 / sqrt(1 - a_y^2), 1 / (1 + a_z^2)): the 1 / |a| factors of Ja
+    cancel against t in Jr. The closed form is exact (to rounding) and has the identity as
+    its limit at zero rotation, where the original divides 0 by 0.
+
+    :param a: N x 3 axis-angle vectors.
+    :return: N x 3 diagonal entries.
+    """
+    a = np.asarray(a, dtype=np.float64)
+    d = np.empty_like(a)
+    d[:, 0] = 1 / (1 + a[:, 0] ** 2)
+    d[:, 1] = 1 / np.sqrt(1 - a[:, 1] ** 2)
+    d[:, 2] = 1 / (1 + a[:, 2] ** 2)
+    return d
+
+
+class Results():
+    def __init__(self, p_est, steps, euler, p_cov, euler_cov):
+        """
+        :param p_est: N x 3 position estimates (all steps).
+        :param steps: Filter steps at which the remaining arrays are given (M,).
+        :param euler: M x 3 estimated RPY angles.
+        :param p_cov: M x 3 x 3 position covariances.
+        :param euler_cov: M x 3 x 3 RPY covariances, J P J^T.
+        """
+        self.p_est = p_est
+        self.steps = steps
+        self.euler = euler
+        self.p_cov = p_cov
+        self.euler_cov = euler_cov
+
+    @property
+    def p_std(self):
+        """M x 3 position standard deviations."""
+        return np.sqrt(np.diagonal(self.p_cov, axis1=1, axis2=2))
+
+    @property
+    def euler_std(self):
+        """M x 3 RPY standard deviations."""
+        return np.sqrt(np.diagonal(self.euler_cov, axis1=1, axis2=2))
+
+    def bounds(self, sigma=3):
+        """(position, RPY) error bounds of sigma standard deviations, M x 3 each."""
+        return sigma * self.p_std, sigma * self.euler_std
+
+    def errors(self, gt):
+        """
+        Errors against the ground truth, over the steps that have one.
+
+        :param gt: Ground truth Data object.
+        :return: (p_err, steps, euler_err): num_gt x 3 position errors at every step, the
+                 recorded steps below num_gt and the RPY errors at those steps.
+        """
+        num_gt = gt.p.shape[0]
+        s = self.steps[self.steps < num_gt]
+        p_err = gt.p - self.p_est[:num_gt]
+        euler_err = angle_normalize(gt.r[s] - self.euler[:len(s)])
+        return p_err, s, euler_err
+
+    def submission(self, indices):
+        """Submission string: the position estimates at the given indices."""
+        return ''.join('%.3f ' % v for v in self.p_est[indices].ravel())
+
+
+def analyse(p_est, q_est, cov):
+    """
+    Analyse one run.
+
+    :param p_est: N x 3 position estimates.
+    :param q_est: N x 4 estimated wxyz quaternions.
+    :param cov: CovarianceRecorder of the run, or an N x 9 x 9 covariance array. J is
+                diagonal, so the RPY variances only depend on the attitude variances and
+                a 'diag' history is enough for the bounds (the covariance matrices of the
+                results are then diagonal).
+    :return: Results
+    """
+    if isinstance(cov, CovarianceRecorder):
+        steps = cov.steps
+        p_cov = cov.block(slice(0, 3)) if cov.policy != 'diag' else _diag(cov.var(slice(0, 3)))
+        att_cov = cov.block(slice(6, 9)) if cov.policy != 'diag' else _diag(cov.var(slice(6, 9)))
+    else:
+        steps = np.arange(cov.shape[0])
+        p_cov = cov[:, 0:3, 0:3]
+        att_cov = cov[:, 6:9, 6:9]
+
+    q = QuaternionArray(q_est[steps])
+    euler = q.to_euler()
+    d = rpy_jacobian_diag(q.to_axis_angle())
+    euler_cov = d[:, :, None] * att_cov * d[:, None, :]
+    return Results(p_est, steps, euler, p_cov, euler_cov)
+
+
+def _diag(var):
+    """M x 3 x 3 diagonal matrices from M x 3 variances."""
+    out = np.zeros(var.shape + (3,))
+    idx = np.arange(3)
+    out[:, idx, idx] = var
+    return out
@@ -0,0 +1,213 @@
+# Lockstep multi-filter ES-EKF.
+#
+# Runs M copies of the esekf.ESEKF filter on the same IMU stream as one batched NumPy
+# computation: positions and velocities are M x 3, orientations M x 4 and covariances
+# M x 9 x 9. Every member may have its own IMU noise parameters, and measurements may be
+# given per member (e.g. LIDAR fixes transformed with different extrinsics) with per-member
+# variances, which covers Monte Carlo runs, noise-parameter studies and calibration
+# comparisons at a fraction of the cost of M separate runs.
+import numpy as np
+from esekf import PRECISIONS, g
+from events import iter_events
+from lie import quat_exp, rotvec_quat
+from rotations import QuaternionArray
+
+
+# C = Quaternion.to_mat() as a linear map of the outer product q q^T (flattened to 16).
+_QQ_TO_MAT = np.zeros((4, 4, 3, 3))
+for _i in range(3):
+    _QQ_TO_MAT[0, 0, _i, _i] = 1
+    for _j in range(3):
+        _QQ_TO_MAT[_j + 1, _j + 1, _i, _i] = 1 if _i == _j else -1
+_QQ_TO_MAT[1, 2, 0, 1] = _QQ_TO_MAT[1, 2, 1, 0] = 2  # xy
+_QQ_TO_MAT[1, 3, 0, 2] = _QQ_TO_MAT[1, 3, 2, 0] = 2  # xz
+_QQ_TO_MAT[2, 3, 1, 2] = _QQ_TO_MAT[2, 3, 2, 1] = 2  # yz
+_QQ_TO_MAT[0, 3, 1, 0], _QQ_TO_MAT[0, 3, 0, 1] = 2, -2  # wz
+_QQ_TO_MAT[0, 2, 0, 2], _QQ_TO_MAT[0, 2, 2, 0] = 2, -2  # wy
+_QQ_TO_MAT[0, 1, 2, 1], _QQ_TO_MAT[0, 1, 1, 2] = 2, -2  # wx
+_QQ_TO_MAT = _QQ_TO_MAT.reshape(16, 9)
+
+
+def quat_to_mat(q):
+    """Rotation matrices of M x 4 wxyz quaternions, as one product with a constant map."""
+    m = q.shape[0]
+    return ((q[:, :, None] * q[:, None, :]).reshape(m, 16) @ _QQ_TO_MAT.astype(q.dtype, copy=False)).reshape(m, 3, 3)
+
+
+class BatchESEKF():
+    def __init__(self, p, v, q, p_cov=None, var_imu_f=0.10, var_imu_w=0.25, m=None,
+                 precision='float64'):
+        """
+        :param p: Initial positions, M x 3 (or [3,] shared by all members).
+        :param v: Initial velocities, M x 3 (or [3,]).
+        :param q: Initial wxyz orientations, M x 4 (or [4,]).
+        :param p_cov: Initial covariances, M x 9 x 9 (or 9 x 9). Defaults to zero.
+        :param var_imu_f: IMU specific force variance, scalar or [M,].
+        :param var_imu_w: IMU angular rate variance, scalar or [M,].
+        :param m: Number of members, if it cannot be inferred from the other arguments.
+        :param precision: 'float64', 'mixed' (float32 covariances) or 'float32' (see
+                          esekf.PRECISIONS). Below float64, correct() uses the symmetrised
+                          Joseph form.
+        """
+        if precision not in PRECISIONS:
+            raise ValueError("precision must be one of %s." % (tuple(PRECISIONS),))
+        self.precision = precision
+        self.dtype, cov_dtype = PRECISIONS[precision]
+        self.joseph = cov_dtype != np.float64
+        if m is None:
+            m = max(np.shape(a)[0] if np.ndim(a) == 2 else 1 for a in (p, v, q))
+            m = max([m] + [len(a) for a in (var_imu_f, var_imu_w) if np.ndim(a) == 1])
+        self.m = m
+        self.x = np.zeros((m, 10), dtype=self.dtype)
+        self.p = self.x[:, 0:3]
+        self.v = self.x[:, 3:6]
+        self.q = self.x[:, 6:10]
+        self.p[:] = p
+        self.v[:] = v
+        self.q[:] = q
+        P = np.zeros((m, 9, 9), dtype=cov_dtype)
+        if p_cov is not None:
+            P[:] = p_cov
+        self.p_cov = P
+        self.var_imu_f = np.broadcast_to(np.asarray(var_imu_f, dtype=np.float64), (m,)).copy()
+        self.var_imu_w = np.broadcast_to(np.asarray(var_imu_w, dtype=np.float64), (m,)).copy()
+
+        # Work buffers, reused on every step.
+        self._F = np.tile(np.eye(9, dtype=cov_dtype), (m, 1, 1))
+        self._tmp = np.zeros((m, 9, 9), dtype=cov_dtype)
+        self._p_cov_diag = P.reshape(m, -1)[:, ::10]  # view of the diagonals
+        self._q_diag = np.zeros((m, 9), dtype=cov_dtype)  # diagonals of L Q L^T for the cached dt
+        self._eye = np.eye(9, dtype=cov_dtype)
+        self._dt = None
+
+    def predict(self, imu_f, imu_w, dt):
+        """
+        Propagate all members through one IMU sample.
+
+        :param imu_f: Specific force in the vehicle frame, [3,] shared or M x 3.
+        :param imu_w: Angular rate in the vehicle frame, [3,] shared or M x 3.
+        :param dt: Time step [s].
+        """
+        m = self.m
+        imu_f = np.asarray(imu_f, dtype=np.float64)
+        imu_w = np.asarray(imu_w, dtype=np.float64)
+        C = self._predict_state(imu_f, imu_w, dt)
+
+        F = self._F
+        if dt != self._dt:
+            self._dt = dt
+            F[:, 0:3, 3:6] = dt * np.eye(3)
+            self._q_diag[:, 3:6] = (self.var_imu_f * dt ** 2)[:, None]
+            self._q_diag[:, 6:9] = (self.var_imu_w * dt ** 2)[:, None]
+
+        # F[3:6, 6:9] = -C [f]x dt, with [f]x shared by all members when the IMU input is.
+        if imu_f.ndim == 1:
+            fx, fy, fz = (imu_f * dt).tolist()
+            S = np.array([[0, fz, -fy], [-fz, 0, fx], [fy, -fx, 0]])
+        else:
+            f = imu_f * dt
+            S = np.zeros((m, 3, 3))
+            S[:, 0, 1], S[:, 0, 2] = f[:, 2], -f[:, 1]
+            S[:, 1, 0], S[:, 1, 2] = -f[:, 2], f[:, 0]
+            S[:, 2, 0], S[:, 2, 1] = f[:, 1], -f[:, 0]
+        np.matmul(C, S, out=F[:, 3:6, 6:9])
+        self._propagate()
+
+    def _predict_state(self, imu_f, imu_w, dt):
+        """Propagate the nominal states (f_imu); returns the rotation matrices before the step."""
+        C = quat_to_mat(self.q)
+        cf = np.matmul(C, imu_f[..., None])[..., 0]
+        cf += g
+        self.p += dt * self.v
+        self.p += (dt ** 2 / 2.0) * cf
+        self.v += dt * cf
+        if imu_w.ndim == 1:
+            bw, bx, by, bz = rotvec_quat(*(imu_w * dt).tolist())
+            self.q[:] = self.q @ np.array([[bw, bx, by, bz],
+                                           [-bx, bw, -bz, by],
+                                           [-by, bz, bw, -bx],
+                                           [-bz, -by, bx, bw]])
+        else:
+            self.q[:] = QuaternionArray(self.q).quat_mult_left(quat_exp(imu_w * dt)).q
+        return C
+
+    def _propagate(self):
+        """P = F P F^T + L Q L^T, with per-member Q on the v and theta diagonals."""
+        F = self._F
+        np.matmul(F, self.p_cov, out=self._tmp)
+        np.matmul(self._tmp, F.transpose(0, 2, 1), out=self.p_cov)
+        self._p_cov_diag += self._q_diag
+
+    def correct(self, y, var):
+        """
+        Fuse one position measurement into every member.
+
+        :param y: Measured position, [3,] shared or M x 3.
+        :param var: Measurement variance, scalar or [M,].
+        """
+        dx = self._update(y - self.p, var)
+        self.p += dx[:, 0:3]
+        self.v += dx[:, 3:6]
+        self.q[:] = QuaternionArray(self.q).quat_mult_left(quat_exp(dx[:, 6:9])).q
+
+    def _update(self, r, var):
+        """Covariance update for the innovations r (M x 3); returns the corrections dx."""
+        m = self.m
+        P = self.p_cov
+        var = np.asarray(var, dtype=P.dtype).reshape(-1, 1, 1)
+        S = P[:, 0:3, 0:3] + var * np.eye(3, dtype=P.dtype)
+
+        # Batched form of esekf.selection_update: S = L L^T, W = L^-1 H P,
+        # dx = W^T L^-1 r and P = P - W^T W.
+        L = np.linalg.cholesky(S)
+        rhs = np.empty((m, 3, 10), dtype=P.dtype)
+        rhs[:, :, :9] = P[:, 0:3, :]
+        rhs[:, :, 9] = r
+        Z = np.linalg.solve(L, rhs)
+        W = Z[:, :, :9]
+        dx = np.einsum('mki,mk->mi', W, Z[:, :, 9])
+        if self.joseph:
+            # P = A P A^T + var K K^T with A = I - K H and K = W^T L^-1, symmetrised.
+            K = np.linalg.solve(L.transpose(0, 2, 1), W).transpose(0, 2, 1)
+            A = self._eye - np.pad(K, ((0, 0), (0, 0), (0, 6)))
+            Kt = K.transpose(0, 2, 1)
+            np.matmul(np.matmul(A, P), A.transpose(0, 2, 1), out=self._tmp)
+            self._tmp += var * np.matmul(K, Kt)
+            np.add(self._tmp, self._tmp.transpose(0, 2, 1), out=P)
+            P *= 0.5
+        else:
+            P -= np.matmul(W.transpose(0, 2, 1), W)
+        return dx
+
+
+def run_batch(ekf, imu_f, imu_w, sensors, n=None):
+    """
+    Run a BatchESEKF over a recorded log, with the event ordering of esekf.run().
+
+    :param ekf: BatchESEKF, already initialised at imu_f.t[0].
+    :param imu_f: StampedData of specific forces.
+    :param imu_w: StampedData of angular rates.
+    :param sensors: List of (StampedData, variance) position sensors. A sensor's data may be
+                    N x 3 (shared) or M x N x 3 (per member), and its variance scalar or [M,].
+    :param n: Number of ticks to run. Defaults to imu_f.data.shape[0].
+    :return: n x M x 3 position estimates, in the filter's state dtype.
+    """
+    if n is None:
+        n = imu_f.data.shape[0]
+    p_est = np.zeros([n, ekf.m, 3], dtype=ekf.dtype)
+
+    t = imu_f.t[:n].tolist()
+    k = 0
+    for t_e, j, i in iter_events([imu_f.t[1:n]] + [s for s, _ in sensors]):
+        if t_e > t[-1]:
+            break
+        if j == 0:
+            p_est[k] = ekf.p
+            k = i + 1
+            ekf.predict(imu_f.data[k - 1], imu_w.data[k - 1], t[k] - t[k - 1])
+        else:
+            y, var = sensors[j - 1]
+            ekf.correct(y.data[i] if y.data.ndim == 2 else y.data[:, i], var)
+    p_est[k] = ekf.p
+
+    return p_est
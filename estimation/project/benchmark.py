@@ -0,0 +1,306 @@
+# Micro- and macro-benchmarks for the ES-EKF.
+#
+# Times the filter building blocks (prediction, measurement update, quaternion operations)
+# in isolation and full runs over the bundled datasets. Each benchmark reports the
+# throughput and per-call latency percentiles. Results are appended to a JSON-lines history
+# file; a benchmark whose median latency grows by more than the threshold relative to the
+# previous entry counts as a regression, and failing runs are not recorded. Full runs are
+# also checked against the reference trajectories in data/, so an optimisation cannot
+# silently change the estimates.
+#
+#   python benchmark.py                       # run, compare with history, record
+#   python benchmark.py --update-reference    # after an intended change of the estimates
+import argparse
+import datetime
+import json
+import os
+import subprocess
+import sys
+import time
+import numpy as np
+from bias_esekf import BiasESEKF
+from calibration import lidar_to_imu
+from data.columnar import load_any
+from esekf import ESEKF, PRECISIONS, run, selection_update
+from iekf import InvariantESEKF
+from preintegration import ImuPreintegrator
+from rotations import Quaternion, QuaternionArray
+from smoother import FixedLagSmoother
+from sqrt_esekf import SqrtESEKF
+from run_esekf import PARTS
+from stream import StreamingESEKF, estimates, replay
+
+HISTORY = 'benchmarks.jsonl'
+REFERENCE = 'data/pt%d_p_est.npy'
+MACRO_PARTS = (1, 3)
+
+
+def summarize(latencies, samples=None):
+    """
+    Throughput and latency percentiles of a list of per-call times [s].
+
+    :param samples: Samples processed by all the calls together. Defaults to one per call.
+    """
+    latencies = np.asarray(latencies)
+    total = latencies.sum()
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99]) * 1e6
+    return {'calls': len(latencies),
+            'per_second': (len(latencies) if samples is None else samples) / total,
+            'mean_us': latencies.mean() * 1e6,
+            'p50_us': p50, 'p90_us': p90, 'p99_us': p99}
+
+
+def time_calls(fn, n):
+    """Per-call wall times [s] of n calls of fn()."""
+    clock = time.perf_counter
+    out = np.empty(n)
+    for i in range(n):
+        start = clock()
+        fn()
+        out[i] = clock() - start
+    return out
+
+
+def micro(n=2000):
+    """Benchmarks of the individual building blocks."""
+    rng = np.random.default_rng(0)
+    f = [0.3, -0.2, 9.8]
+    w = [0.01, -0.02, 0.05]
+    y = np.array([0.1, 0.2, 0.3])
+    A = rng.normal(size=(9, 9))
+    P0 = A @ A.T
+    q = Quaternion(euler=[0.1, 0.2, 0.3])
+    q2 = Quaternion(euler=[-0.3, 0.1, 0.2])
+    qa = QuaternionArray.from_euler(rng.uniform(-1, 1, (10000, 3)))
+
+    ekf = ESEKF(np.zeros(3), np.zeros(3), q.to_numpy(), P0)
+    deferred = ESEKF(np.zeros(3), np.zeros(3), q.to_numpy(), P0, deferred=True)
+    P = P0.copy()
+
+    def update():
+        P[...] = P0
+        selection_update(P, slice(0, 3), [0.1, 0.2, 0.3], 1.0)
+
+    preint = ImuPreintegrator()
+    epoch = ImuPreintegrator()
+    for _ in range(20):
+        epoch.integrate(f, w, 0.005)
+
+    def propagate():
+        ekf.p_cov[...] = P0
+        ekf.propagate(epoch)
+
+    bias_ekf = BiasESEKF(np.zeros(3), np.zeros(3), q.to_numpy())
+    iekf = InvariantESEKF(np.zeros(3), np.zeros(3), q.to_numpy(), P0)
+    sqrt_ekf = SqrtESEKF(np.zeros(3), np.zeros(3), q.to_numpy(), P0)
+    lagged = FixedLagSmoother(ESEKF(np.zeros(3), np.zeros(3), q.to_numpy(), P0), 20)
+
+    results = {
+        'esekf.predict': summarize(time_calls(lambda: ekf.predict(f, w, 0.005), n)),
+        'esekf.predict (deferred)': summarize(time_calls(lambda: deferred.predict(f, w, 0.005), n)),
+        'esekf.correct': summarize(time_calls(lambda: ekf.correct(y, 1.0), n)),
+        'selection_update': summarize(time_calls(update, n)),
+        'BiasESEKF.predict': summarize(time_calls(lambda: bias_ekf.predict(f, w, 0.005), n)),
+        'BiasESEKF.correct': summarize(time_calls(lambda: bias_ekf.correct(y, 1.0), n)),
+        'InvariantESEKF.predict': summarize(time_calls(lambda: iekf.predict(f, w, 0.005), n)),
+        'InvariantESEKF.correct': summarize(time_calls(lambda: iekf.correct(y, 1.0), n)),
+        'SqrtESEKF.predict': summarize(time_calls(lambda: sqrt_ekf.predict(f, w, 0.005), n)),
+        'SqrtESEKF.correct': summarize(time_calls(lambda: sqrt_ekf.correct(y, 1.0), n)),
+        'ImuPreintegrator.integrate': summarize(time_calls(lambda: preint.integrate(f, w, 0.005), n)),
+        'esekf.propagate[20]': summarize(time_calls(propagate, n), samples=20 * n),
+        'FixedLagSmoother.predict[lag 20]': summarize(time_calls(lambda: lagged.predict(f, w, 0.005), n)),
+        'Quaternion(euler)': summarize(time_calls(lambda: Quaternion(euler=w), n)),
+        'Quaternion.to_mat': summarize(time_calls(q.to_mat, n)),
+        'Quaternion.to_euler': summarize(time_calls(q.to_euler, n)),
+        'Quaternion.quat_mult_left': summarize(time_calls(lambda: q.quat_mult_left(q2), n)),
+        'QuaternionArray.to_euler[10000]': summarize(time_calls(qa.to_euler, max(n // 100, 10)),
+                                                     samples=len(qa) * max(n // 100, 10)),
+        'QuaternionArray.to_mat[10000]': summarize(time_calls(qa.to_mat, max(n // 100, 10)),
+                                                   samples=len(qa) * max(n // 100, 10)),
+    }
+    return results
+
+
+class TimedESEKF(ESEKF):
+    """ESEKF recording the wall time of every predict() and correct() call."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.predict_times = []
+        self.correct_times = []
+
+    def predict(self, imu_f, imu_w, dt):
+        start = time.perf_counter()
+        super().predict(imu_f, imu_w, dt)
+        self.predict_times.append(time.perf_counter() - start)
+
+    def correct(self, y, var, joseph=None):
+        start = time.perf_counter()
+        super().correct(y, var, joseph)
+        self.correct_times.append(time.perf_counter() - start)
+
+
+def run_part(part, ekf_class=ESEKF, **kwargs):
+    """
+    Run one project part with its default configuration; returns (ekf, p_est, seconds).
+    kwargs are passed on to ekf_class.
+    """
+    config = PARTS[part]
+    data = load_any(config['data'])
+    gt = data['gt']
+    lidar = lidar_to_imu(data['lidar'], config['c_li'])
+    ekf = ekf_class(gt.p[0], gt.v[0], Quaternion(euler=gt.r[0]).to_numpy(), **kwargs)
+    start = time.perf_counter()
+    p_est = run(ekf, data['imu_f'], data['imu_w'],
+                [(data['gnss'], 0.01), (lidar, config['var_lidar'])])[0]
+    return ekf, p_est, time.perf_counter() - start
+
+
+def stream_part(part):
+    """Replay one project part through StreamingESEKF; returns the per-push latencies [s]."""
+    config = PARTS[part]
+    data = load_any(config['data'])
+    gt = data['gt']
+    lidar = lidar_to_imu(data['lidar'], config['c_li'])
+    online = StreamingESEKF(ESEKF(gt.p[0], gt.v[0], Quaternion(euler=gt.r[0]).to_numpy()),
+                            {'gnss': 0.01, 'lidar': config['var_lidar']})
+    events = replay(data['imu_f'], data['imu_w'], [('gnss', data['gnss']), ('lidar', lidar)])
+    return [est.latency for est in estimates(online, events)]
+
+
+def rms_error(part, p_est):
+    """RMS position error [m] of p_est against the part's ground truth."""
+    gt = load_any(PARTS[part]['data'])['gt']
+    err = gt.p - p_est[:gt.p.shape[0]]
+    return float(np.sqrt(np.mean(np.sum(err ** 2, axis=1))))
+
+
+def macro(atol=1e-6, update_reference=False):
+    """
+    Full runs over the bundled datasets.
+
+    The reduced precisions (esekf.PRECISIONS), the square-root form, the invariant filter and
+    the bias-estimating filter are run as well, and reported with their deviation from the
+    float64 estimates and their error against ground truth, next to the float64 run's.
+
+    :return: (results, problems): benchmark summaries, and a list of messages for runs
+             whose estimates differ from the reference by more than atol.
+    """
+    results = {}
+    problems = []
+    for part in MACRO_PARTS:
+        _, p_est, seconds = run_part(part)
+        ekf, _, _ = run_part(part, TimedESEKF)
+        n = p_est.shape[0]
+        results['run pt%d' % part] = {'samples': n, 'per_second': n / seconds,
+                                      'seconds': seconds, 'rms_error': rms_error(part, p_est)}
+        variants = [(precision, ESEKF, precision) for precision in PRECISIONS if precision != 'float64']
+        variants += [('sqrt', SqrtESEKF, 'float64'), ('sqrt float32', SqrtESEKF, 'float32')]
+        variants += [('invariant', InvariantESEKF, 'float64'), ('bias', BiasESEKF, 'float64')]
+        for name, ekf_class, precision in variants:
+            _, p_var, var_seconds = run_part(part, ekf_class, precision=precision)
+            results['run pt%d %s' % (part, name)] = {
+                'samples': n, 'per_second': n / var_seconds, 'seconds': var_seconds,
+                'rms_error': rms_error(part, p_var), 'max_abs_diff_float64': float(np.abs(p_var - p_est).max())}
+        results['run pt%d predict' % part] = summarize(ekf.predict_times)
+        results['run pt%d correct' % part] = summarize(ekf.correct_times)
+        results['stream pt%d push' % part] = summarize(stream_part(part))
+
+        path = REFERENCE % part
+        if update_reference:
+            np.save(path, p_est)
+        else:
+            ref = np.load(path)
+            err = np.abs(p_est - ref).max() if ref.shape == p_est.shape else np.inf
+            results['run pt%d' % part]['max_abs_diff'] = float(err)
+            if not err <= atol:
+                problems.append('pt%d: p_est differs from %s by %.3g (> %g)' % (part, path, err, atol))
+    return results, problems
+
+
+def regressions(results, previous, threshold):
+    """Messages for benchmarks that got slower than previous by more than threshold."""
+    out = []
+    for name, r in results.items():
+        old = previous.get(name)
+        if old is None:
+            continue
+        if 'p50_us' in r and 'p50_us' in old:
+            ratio = r['p50_us'] / old['p50_us']
+        else:
+            ratio = old['per_second'] / r['per_second']
+        if ratio > 1 + threshold:
+            out.append('%s: %.2fx slower than the previous run' % (name, ratio))
+    return out
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(results):
+    lines = ['%-34s %14s %10s %10s %10s' % ('benchmark', 'samples/s', 'p50 us', 'p90 us', 'p99 us')]
+    for name, r in results.items():
+        if 'p50_us' in r:
+            lines.append('%-34s %14.0f %10.2f %10.2f %10.2f'
+                         % (name, r['per_second'], r['p50_us'], r['p90_us'], r['p99_us']))
+        else:
+            lines.append('%-34s %14.0f %10s %10s %10s' % (name, r['per_second'], '', '', ''))
+    accuracy = [(name, r) for name, r in results.items() if 'rms_error' in r]
+    if accuracy:
+        lines.append('')
+        lines.append('%-34s %14s %21s' % ('accuracy', 'rms error m', 'max diff float64 m'))
+        for name, r in accuracy:
+            diff = r.get('max_abs_diff_float64')
+            lines.append('%-34s %14.4f %21s' % (name, r['rms_error'], '' if diff is None else '%.3g' % diff))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='ES-EKF micro- and macro-benchmarks.')
+    parser.add_argument('--only', choices=['micro', 'macro'], default=None)
+    parser.add_argument('-n', type=int, default=2000, help='calls per micro-benchmark')
+    parser.add_argument('--history', default=HISTORY, help='JSON-lines results history')
+    parser.add_argument('--no-record', action='store_true', help='do not append to the history')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='allowed slowdown against the previous run (0.25 = 25%%)')
+    parser.add_argument('--atol', type=float, default=1e-6,
+                        help='allowed deviation of p_est from the reference [m]')
+    parser.add_argument('--update-reference', action='store_true',
+                        help='overwrite the reference trajectories with this run')
+    args = parser.parse_args(argv)
+
+    results = {}
+    problems = []
+    if args.only != 'macro':
+        results.update(micro(args.n))
+    if args.only != 'micro':
+        r, problems = macro(args.atol, args.update_reference)
+        results.update(r)
+    print(report(results))
+
+    previous = {}
+    if os.path.exists(args.history):
+        with open(args.history) as file:
+            lines = [line for line in file if line.strip()]
+        if lines:
+            previous = json.loads(lines[-1])['results']
+    problems += regressions(results, previous, args.threshold)
+
+    if not args.no_record and not problems:
+        entry = {'time': datetime.datetime.now().isoformat(timespec='seconds'),
+                 'commit': git_commit(), 'results': results}
+        with open(args.history, 'a') as file:
+            file.write(json.dumps(entry) + '\n')
+
+    for p in problems:
+        print('FAIL ' + p)
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,179 @@
+# Bias-estimating ES-EKF: the 9-state filter of esekf.py extended with accelerometer and
+# gyro biases, modelled as random walks.
+#
+# The error state is [dp, dv, dtheta, dba, dbg] (15), and the motion model jacobian is
+#
+#   F = [[A, B], [0, I]],  A = [[I, I dt, 0], [0, I, -C [f]x dt], [0, 0, I]],
+#                          B = [[0, 0], [-C dt, 0], [0, -I dt]],
+#
+# with f the bias-corrected specific force. The bias rows of F are the identity, so only its
+# top 9 rows M = [A B] are kept, and F P F^T + Q is formed block by block:
+#
+#   T = M P (9 x 15),  P[:9, :9] = T M^T,  P[:9, 9:] = T[:, 9:],  P[9:, 9:] += Q_b,
+#
+# about half the arithmetic of the dense 15 x 15 product. Of M, only the C-dependent blocks
+# change from one step to the next; the dt blocks are rewritten when dt changes.
+import numpy as np
+from esekf import POSITION, PRECISIONS, g, quat_mult, selection_update
+from lie import rotvec_quat
+
+
+class BiasESEKF():
+    def __init__(self, p, v, q, p_cov=None, var_imu_f=0.10, var_imu_w=0.25, ba=None, bg=None,
+                 var_ba=1e-6, var_bg=1e-8, var_ba0=1e-2, var_bg0=1e-4, precision='float64'):
+        """
+        15-state ES-EKF with the interface of esekf.ESEKF (and esekf.run()).
+
+        x = [p, v, q] holds the navigation state as in ESEKF, and b = [ba, bg] the biases;
+        p, v, q, ba and bg are views into them, owned by the filter and updated in place.
+
+        :param p: Initial position [3,].
+        :param v: Initial velocity [3,].
+        :param q: Initial orientation as a wxyz quaternion [4,].
+        :param p_cov: Initial 15x15 error-state covariance. Defaults to zero for the
+                      navigation states and var_ba0, var_bg0 for the biases.
+        :param var_imu_f: IMU specific force variance.
+        :param var_imu_w: IMU angular rate variance.
+        :param ba: Initial accelerometer bias [3,]. Defaults to zero.
+        :param bg: Initial gyro bias [3,]. Defaults to zero.
+        :param var_ba: Accelerometer bias random walk variance, per second.
+        :param var_bg: Gyro bias random walk variance, per second.
+        :param var_ba0: Initial accelerometer bias variance (if p_cov is not given).
+        :param var_bg0: Initial gyro bias variance (if p_cov is not given).
+        :param precision: 'float64', 'mixed' or 'float32' (see esekf.PRECISIONS).
+        """
+        if precision not in PRECISIONS:
+            raise ValueError("precision must be one of %s." % (tuple(PRECISIONS),))
+        self.precision = precision
+        dtype, cov_dtype = PRECISIONS[precision]
+        self.joseph = cov_dtype != np.float64
+        self.deferred = False
+        self.x = np.zeros(10, dtype=dtype)
+        self.p = self.x[0:3]
+        self.v = self.x[3:6]
+        self.q = self.x[6:10]
+        self.p[:] = p
+        self.v[:] = v
+        self.q[:] = q
+        self.b = np.zeros(6, dtype=dtype)
+        self.ba = self.b[0:3]
+        self.bg = self.b[3:6]
+        if ba is not None:
+            self.ba[:] = ba
+        if bg is not None:
+            self.bg[:] = bg
+        self.p_cov = np.zeros((15, 15), dtype=cov_dtype)
+        if p_cov is not None:
+            self.p_cov[:] = p_cov
+        else:
+            self.p_cov[range(9, 12), range(9, 12)] = var_ba0
+            self.p_cov[range(12, 15), range(12, 15)] = var_bg0
+        self.var_imu_f = var_imu_f
+        self.var_imu_w = var_imu_w
+        self.var_ba = var_ba
+        self.var_bg = var_bg
+        self._g = g.tolist()
+
+        # Work buffers, reused on every step.
+        self._M = np.zeros((9, 15), dtype=cov_dtype)  # top rows of F
+        self._M[range(9), range(9)] = 1
+        self._M_dt = self._M.reshape(-1)[3:48:16]  # views of M[0:3, 3:6] and M[6:9, 12:15]
+        self._M_bg = self._M.reshape(-1)[102:147:16]  # diagonals
+        self._T = np.zeros((9, 15), dtype=cov_dtype)
+        self._p_cov_diag = self.p_cov.reshape(-1)[::16]  # view of the diagonal of p_cov
+        self._q_diag = np.zeros(15, dtype=cov_dtype)  # diagonal of L Q L^T for the cached dt
+        self._dt = None
+
+    def predict(self, imu_f, imu_w, dt):
+        """
+        Propagate the nominal state and the error-state covariance through one IMU sample,
+        with the bias-corrected inputs.
+
+        :param imu_f: Specific force in the vehicle frame, length 3.
+        :param imu_w: Angular rate in the vehicle frame, length 3.
+        :param dt: Time step [s].
+        """
+        px, py, pz, vx, vy, vz, qw, qx, qy, qz = self.x.tolist()
+        bax, bay, baz, bgx, bgy, bgz = self.b.tolist()
+        fx, fy, fz = imu_f
+        wx, wy, wz = imu_w
+        fx -= bax
+        fy -= bay
+        fz -= baz
+
+        # Rotation matrix of q (see ESEKF.predict).
+        d = qw * qw - (qx * qx + qy * qy + qz * qz)
+        w2 = 2 * qw
+        c00 = d + 2 * qx * qx
+        c01 = 2 * qx * qy - w2 * qz
+        c02 = 2 * qx * qz + w2 * qy
+        c10 = 2 * qy * qx + w2 * qz
+        c11 = d + 2 * qy * qy
+        c12 = 2 * qy * qz - w2 * qx
+        c20 = 2 * qz * qx - w2 * qy
+        c21 = 2 * qz * qy + w2 * qx
+        c22 = d + 2 * qz * qz
+
+        # Nominal state (f_imu).
+        gx, gy, gz = self._g
+        cfx = c00 * fx + c01 * fy + c02 * fz + gx
+        cfy = c10 * fx + c11 * fy + c12 * fz + gy
+        cfz = c20 * fx + c21 * fy + c22 * fz + gz
+        h = dt ** 2 / 2.0
+        self.x[:] = (px + dt * vx + h * cfx,
+                     py + dt * vy + h * cfy,
+                     pz + dt * vz + h * cfz,
+                     vx + dt * cfx,
+                     vy + dt * cfy,
+                     vz + dt * cfz) + quat_mult((qw, qx, qy, qz),
+                                                rotvec_quat((wx - bgx) * dt, (wy - bgy) * dt, (wz - bgz) * dt))
+
+        M = self._M
+        if dt != self._dt:
+            self._dt = dt
+            self._M_dt[:] = dt
+            self._M_bg[:] = -dt
+            self._q_diag[3:6] = self.var_imu_f * dt ** 2
+            self._q_diag[6:9] = self.var_imu_w * dt ** 2
+            self._q_diag[9:12] = self.var_ba * dt
+            self._q_diag[12:15] = self.var_bg * dt
+
+        # M[3:6, 6:12] = [-C [f]x dt, -C dt].
+        M[3:6, 6:12] = (((c02 * fy - c01 * fz) * dt, (c00 * fz - c02 * fx) * dt, (c01 * fx - c00 * fy) * dt,
+                         -c00 * dt, -c01 * dt, -c02 * dt),
+                        ((c12 * fy - c11 * fz) * dt, (c10 * fz - c12 * fx) * dt, (c11 * fx - c10 * fy) * dt,
+                         -c10 * dt, -c11 * dt, -c12 * dt),
+                        ((c22 * fy - c21 * fz) * dt, (c20 * fz - c22 * fx) * dt, (c21 * fx - c20 * fy) * dt,
+                         -c20 * dt, -c21 * dt, -c22 * dt))
+
+        # P = F P F^T + L Q L^T by blocks; the bias-bias block only gains Q.
+        P = self.p_cov
+        T = self._T
+        np.matmul(M, P, out=T)
+        np.matmul(T, M.T, out=P[0:9, 0:9])
+        P[0:9, 9:15] = T[:, 9:15]
+        P[9:15, 0:9] = T[:, 9:15].T
+        self._p_cov_diag += self._q_diag
+
+    def state_arrays(self):
+        """x, the biases b and p_cov, owned by the filter (see esekf.ESEKF.state_arrays)."""
+        return self.x, self.b, self.p_cov
+
+    def correct(self, y, var, joseph=None):
+        """
+        Fuse a position measurement.
+
+        :param y: Measured position [3,].
+        :param var: Measurement variance, isotropic or per axis (see selection_update).
+        :param joseph: Use the Joseph-form covariance update. Defaults to self.joseph, set
+                       for the reduced precisions.
+        """
+        if joseph is None:
+            joseph = self.joseph
+        px, py, pz, vx, vy, vz, qw, qx, qy, qz = self.x.tolist()
+        y0, y1, y2 = y
+        dx = selection_update(self.p_cov, POSITION, [y0 - px, y1 - py, y2 - pz], var, joseph).tolist()
+
+        self.x[:] = (px + dx[0], py + dx[1], pz + dx[2],
+                     vx + dx[3], vy + dx[4], vz + dx[5]) + quat_mult((qw, qx, qy, qz), rotvec_quat(*dx[6:9]))
+        self.b += dx[9:15]
@@ -0,0 +1,38 @@
+# LIDAR-to-IMU extrinsic calibration for the Coursera SDC Course 2 final project.
+#
+# The LIDAR data are positions estimated by a separate scan-matching system, expressed in
+# the LIDAR frame. They are moved into the vehicle (IMU) frame with the extrinsic rotation
+# C_li and translation t_i_li before being fused as position measurements.
+import numpy as np
+from data.utils import StampedData
+
+C_LI = {
+    # Correct calibration rotation matrix, corresponding to Euler RPY angles (0.05, 0.05, 0.1).
+    'correct': np.array([
+        [0.99376, -0.09722, 0.05466],
+        [0.09971, 0.99401, -0.04475],
+        [-0.04998, 0.04992, 0.9975]
+    ]),
+    # Incorrect calibration rotation matrix, corresponding to Euler RPY angles (0.05, 0.05, 0.05).
+    'incorrect': np.array([
+        [0.9975, -0.04742, 0.05235],
+        [0.04992, 0.99763, -0.04742],
+        [-0.04998, 0.04992, 0.9975]
+    ]),
+}
+
+t_i_li = np.array([0.5, 0.1, 0.5])
+
+
+def lidar_to_imu(lidar, C_li, t=t_i_li):
+    """
+    Transform LIDAR positions to the vehicle (IMU) frame, without modifying the input.
+
+    :param lidar: StampedData of LIDAR positions.
+    :param C_li: 3x3 rotation matrix, or a key of C_LI.
+    :param t: Translation of the LIDAR in the IMU frame.
+    :return: New StampedData sharing the timestamps of lidar.
+    """
+    if isinstance(C_li, str):
+        C_li = C_LI[C_li]
+    return StampedData((C_li @ lidar.data.T).T + t, lidar.t)
@@ -0,0 +1,137 @@
+# Covariance history storage for ES-EKF runs.
+#
+# Keeping every 9x9 covariance of a long run costs 648 bytes per IMU sample, although the
+# matrices are symmetric and the analysis only reads a few blocks of them. The recorder
+# stores a reduced form selected by a policy, optionally in float32, every k-th step only,
+# or streamed to a file in chunks, and rebuilds the blocks the error plots need.
+import numpy as np
+
+POLICIES = ('full', 'packed', 'diag')
+
+
+class CovarianceRecorder():
+    def __init__(self, n, dim=9, policy='full', dtype=np.float64, every=1, path=None, chunk=4096):
+        """
+        :param n: Number of filter steps that will be offered to record().
+        :param dim: State dimension.
+        :param policy: 'full' (dim x dim), 'packed' (upper triangle, dim(dim+1)/2 values) or
+                       'diag' (variances only).
+        :param dtype: Storage dtype, e.g. np.float32 to halve the memory.
+        :param every: Keep only steps k with k % every == 0.
+        :param path: If given, stream the records to this raw binary file in chunks of
+                     `chunk` rows instead of keeping them in memory.
+        :param chunk: Rows per write when streaming.
+        """
+        if policy not in POLICIES:
+            raise ValueError("policy must be one of %s." % (POLICIES,))
+        self.dim = dim
+        self.policy = policy
+        self.dtype = np.dtype(dtype)
+        self.every = every
+        self.path = path
+        self._steps = np.arange(0, n, every)
+
+        if policy == 'full':
+            self._shape = (dim, dim)
+            self._index = None
+        elif policy == 'packed':
+            iu = np.triu_indices(dim)
+            self._shape = (len(iu[0]),)
+            self._index = np.ravel_multi_index(iu, (dim, dim))
+        else:
+            self._shape = (dim,)
+            self._index = np.arange(0, dim * dim, dim + 1)
+
+        if path is None:
+            self._data = np.zeros((len(self._steps),) + self._shape, dtype=self.dtype)
+            self._row = None
+        else:
+            self._data = np.zeros((chunk,) + self._shape, dtype=self.dtype)
+            self._file = open(path, 'wb')
+            self._row = 0  # rows buffered in _data
+        self._count = 0  # rows recorded so far
+
+    def record(self, k, P):
+        """Record the covariance P of step k (skipped unless k % every == 0)."""
+        if k % self.every:
+            return
+        if self._row is None:
+            row = self._count
+        else:
+            row = self._row
+            self._row += 1
+        if self._index is None:
+            self._data[row] = P
+        else:
+            np.take(P, self._index, out=self._data[row])
+        self._count += 1
+        if self._row is not None and self._row == len(self._data):
+            self.flush()
+
+    def flush(self):
+        """Write the buffered rows to the file (streaming mode only)."""
+        if self._row:
+            self._data[:self._row].tofile(self._file)
+            self._file.flush()
+            self._row = 0
+
+    def close(self):
+        """Flush and close the file (streaming mode only)."""
+        if self.path is not None and not self._file.closed:
+            self.flush()
+            self._file.close()
+
+    @property
+    def data(self):
+        """
+        Recorded rows in their stored form; a read-only memory map when streaming (an empty
+        array if nothing has been recorded, as an empty file cannot be mapped).
+        """
+        if self.path is None or not self._count:
+            return self._data[:self._count]
+        self.flush()
+        return np.memmap(self.path, dtype=self.dtype, mode='r',
+                         shape=(self._count,) + self._shape)
+
+    @property
+    def steps(self):
+        """Filter steps of the recorded rows."""
+        return self._steps[:self._count]
+
+    def __len__(self):
+        return self._count
+
+    def _entry(self, i, j):
+        """Column of the stored rows holding P[i, j]."""
+        if self.policy == 'diag':
+            if i != j:
+                raise ValueError("The 'diag' policy does not keep off-diagonal terms.")
+            return i
+        i, j = min(i, j), max(i, j)
+        # Row-major upper triangle: rows 0..i-1 hold dim + (dim-1) + ... entries.
+        return i * self.dim - i * (i - 1) // 2 + (j - i)
+
+    def var(self, idx=slice(None)):
+        """Variances of the states idx at the recorded steps (len(self) x m)."""
+        idx = np.arange(self.dim)[idx]
+        data = self.data
+        if self.policy == 'full':
+            return np.diagonal(data, axis1=1, axis2=2)[:, idx].astype(np.float64)
+        return data[:, [self._entry(i, i) for i in idx]].astype(np.float64)
+
+    def std(self, idx=slice(None)):
+        """Standard deviations of the states idx at the recorded steps (len(self) x m)."""
+        return np.sqrt(self.var(idx))
+
+    def block(self, idx):
+        """Covariance block P[idx, idx] at the recorded steps (len(self) x m x m)."""
+        idx = np.arange(self.dim)[idx]
+        data = self.data
+        if self.policy == 'full':
+            return data[:, idx[:, None], idx].astype(np.float64)
+        cols = [[self._entry(i, j) for j in idx] for i in idx]
+        return data[:, cols].astype(np.float64)
+
+    def full(self):
+        """All recorded covariances as len(self) x dim x dim float64 matrices."""
+        return self.block(slice(None))
@@ -0,0 +1,94 @@
+# Columnar, memory-mapped storage for the Coursera SDC Course 2 datasets.
+#
+# A pickled dataset (a dict of Data and StampedData objects) is stored as a directory with
+# one .npy file per array field and an index.json describing how to rebuild the objects.
+# Loading memory-maps the .npy files, so it costs the same for any log length, and the
+# arrays are paged in from the shared page cache only when they are read.
+#
+# Convert once with:
+#   python -m data.columnar data/pt1_data.pkl  # writes data/pt1_data/
+import json
+import os
+import pickle
+import sys
+import numpy as np
+from data.data import Data
+from data.utils import StampedData
+
+CLASSES = {'Data': Data, 'StampedData': StampedData}
+INDEX = 'index.json'
+
+
+def convert(pkl_path, out_dir=None):
+    """
+    Convert a pickled dataset to a columnar directory.
+
+    :param pkl_path: Path of the pickle (e.g. data/pt1_data.pkl).
+    :param out_dir: Output directory. Defaults to pkl_path without its extension.
+    :return: out_dir
+    """
+    if out_dir is None:
+        out_dir = os.path.splitext(pkl_path)[0]
+    with open(pkl_path, 'rb') as file:
+        data = pickle.load(file)
+    os.makedirs(out_dir, exist_ok=True)
+
+    index = {}
+    for name, obj in data.items():
+        fields = {}
+        for attr, value in vars(obj).items():
+            if isinstance(value, np.ndarray) and value.dtype != object:
+                filename = '%s.%s.npy' % (name, attr)
+                np.save(os.path.join(out_dir, filename), np.ascontiguousarray(value))
+                fields[attr] = {'file': filename}
+            elif isinstance(value, np.ndarray):
+                # Placeholder for a missing field, e.g. Data's np.array([None]).
+                fields[attr] = {'missing': value.tolist()}
+            else:
+                fields[attr] = {'value': value}
+        index[name] = {'class': type(obj).__name__, 'fields': fields}
+
+    with open(os.path.join(out_dir, INDEX), 'w') as file:
+        json.dump(index, file, indent=1)
+    return out_dir
+
+
+def load(path, mmap_mode='r'):
+    """
+    Load a columnar dataset directory.
+
+    :param path: Directory written by convert().
+    :param mmap_mode: Passed to np.load; 'r' maps the arrays read-only, None reads them.
+    :return: Dict of Data / StampedData objects, as stored in the original pickle, whose
+             array fields are backed by the memory maps.
+    """
+    with open(os.path.join(path, INDEX)) as file:
+        index = json.load(file)
+
+    data = {}
+    for name, entry in index.items():
+        obj = CLASSES[entry['class']].__new__(CLASSES[entry['class']])
+        for attr, field in entry['fields'].items():
+            if 'file' in field:
+                value = np.load(os.path.join(path, field['file']), mmap_mode=mmap_mode)
+            elif 'missing' in field:
+                value = np.array(field['missing'])
+            else:
+                value = field['value']
+            setattr(obj, attr, value)
+        data[name] = obj
+    return data
+
+
+def load_any(path):
+    """Load a dataset from either a pickle file or a columnar directory."""
+    if os.path.isdir(path):
+        return load(path)
+    with open(path, 'rb') as file:
+        return pickle.load(file)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (2, 3):
+        sys.exit('usage: python -m data.columnar DATASET.pkl [OUT_DIR]')
+    print(convert(*sys.argv[1:]))
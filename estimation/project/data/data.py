@@ -6,9 +6,23 @@ class Data():
     """
     Storage class specific to ground truth data generated by CARLA simulator.
     """
+    # Derived quantities (with do_diff) and the field each is differentiated from. They are
+    # computed on first read and cached; setting a field drops the cached quantities that
+    # depend on it, directly or in turn (p -> v -> a, r -> w -> alpha).
+    SOURCES = {'v': 'p', 'a': 'v', 'w': 'r', 'alpha': 'w'}
+
+    # Poses as N x 4 x 4 homogenous transformations, built from p and r on first use, or
+    # kept from transform() so that chained transforms compose the matrices directly.
+    # These and the attributes below are class-level defaults, as pickled and columnar
+    # datasets restore instances without calling __init__.
+    _T = None
+    _T_init = None
+    _derived = frozenset()  # names of the cached derived quantities
+    diff_scheme = 'forward'
 
     def __init__(self, t=np.array([None]), p=np.array([None]), r=np.array([None]), v=np.array([None]),
-                 w=np.array([None]), a=np.array([None]), alpha=np.array([None]), do_diff = False):
+                 w=np.array([None]), a=np.array([None]), alpha=np.array([None]), do_diff = False, T=None,
+                 diff_scheme='forward'):
         """
         :param t: Timestamps [s]
         :param p: Position [m]
@@ -18,14 +32,19 @@ class Data():
         :param a: Acceleration [m/s^2]
         :param alpha: Angular Acceleration [rad/s^2]
         :param diff: Flag - generate velocities and accelerations by differentiating
+        :param T: Poses matching p and r, as N x 4 x 4 homogenous transformations (optional)
+        :param diff_scheme: Finite differences used with do_diff, 'forward' (N - 1 values from
+                            N) or 'central' (N values, see utils.diff)
         """
         self.do_diff = do_diff
+        self.diff_scheme = diff_scheme
         self._p_init = p
         self._r_init = r
         self._v_init = v
         self._w_init = w
         self._a_init = a
         self._alpha_init = alpha
+        self._T_init = T
 
         self._t = t
         self._p = p
@@ -34,6 +53,7 @@ class Data():
         self._w = w
         self._a = a
         self._alpha = alpha
+        self._T = T
 
     def reset(self):
         """
@@ -45,101 +65,140 @@ class Data():
         self._w = self._w_init
         self._a = self._a_init
         self._alpha = self._alpha_init
+        self._T = self._T_init
+        self._derived = frozenset()
+
+    def _available(self, name):
+        # Missing fields hold the placeholder np.array([None]).
+        value = getattr(self, '_' + name)
+        return value.dtype != object or bool(value.any())
+
+    def _set(self, name, value):
+        """Set a field, and drop the quantities derived from its previous value."""
+        setattr(self, '_' + name, value)
+        self._derived = self._derived - {name}
+        if name in ('p', 'r'):
+            self._T = None
+        self._invalidate(name)
+
+    def _invalidate(self, name):
+        """Drop the derived quantities computed from field name, directly or in turn."""
+        for derived, source in self.SOURCES.items():
+            if source == name and derived in self._derived:
+                setattr(self, '_' + derived, np.array([None]))
+                self._derived = self._derived - {derived}
+                self._invalidate(derived)
+
+    def _derive(self, name):
+        """Compute and cache a derived quantity by differentiating its source."""
+        value = u.diff(getattr(self, self.SOURCES[name]), self._t, self.diff_scheme)
+        if name == 'w':
+            # value holds \dot{Theta} - the rates of change of the Euler angles; convert
+            # them to angular velocities *in the vehicle (IMU) frame*.
+            value = u.to_angular_rates(self.r[:len(value)], value)
+        setattr(self, '_' + name, value)
+        self._derived = self._derived | {name}
+        return value
+
+    def _get(self, name, description):
+        if self._available(name):
+            return getattr(self, '_' + name)
+        elif name in self.SOURCES and self.do_diff:
+            return self._derive(name)
+        raise ValueError('No %s data available.' % description)
 
     @property
     def p(self):
-        if self._p.any():
-            return self._p
-        raise ValueError('No position data available.')
+        return self._get('p', 'position')
 
     @p.setter
     def p(self, value):
-        self._p = value
+        self._set('p', value)
 
     @property
     def r(self):
-        if self._r.any():
-            return self._r
-        raise ValueError('No orientation data available.')
+        return self._get('r', 'orientation')
 
     @r.setter
     def r(self, value):
         # Active transform convention - roll applied first, then
         # pitch and then yaw.
-        self._r = value
+        self._set('r', value)
+
+    @property
+    def T(self):
+        """Poses as N x 4 x 4 homogenous transformations."""
+        if self._T is None:
+            self._T = u.to_mat(self.p, self.r)
+        return self._T
 
     @property
     def v(self):
-        if self._v.any():
-            return self._v
-        elif self.do_diff:
-            self._v = np.array(u.diff(self.p, self._t))
-            return self._v
-        raise ValueError('No velocity data available')
+        return self._get('v', 'velocity')
 
     @v.setter
     def v(self, value):
-        self._v = value
+        self._set('v', value)
 
     @property
     def a(self):
-        if self._a.any():
-            return self._a
-        elif self.do_diff:
-            self._a = np.array(u.diff(self.v, self._t))
-            return self._a
-        raise ValueError('No acceleration data available')
+        return self._get('a', 'acceleration')
 
     @a.setter
     def a(self, value):
-        self._a = value
+        self._set('a', value)
 
     @property
     def w(self):
-        if self._w.any():
-            return self._w
-        elif self.do_diff:
-            # First determine \dot{Theta} - the rates of change of the
-            # Euler angles...
-            self._w = np.array(u.diff(self.r, self._t))
-
-            # Now convert to angular velocities *in the vehicle (IMU) frame*.
-            for i in (range(len(self._w))):
-                # Referencing _r ... must be set before a call to w(self).
-                self._w[i, :] = u.to_angular_rates(self.r[i, :], self._w[i, :])
-            return self._w
-        raise ValueError('No angular velocity data available')
+        return self._get('w', 'angular velocity')
 
     @w.setter
     def w(self, value):
-        self._w = value
+        self._set('w', value)
 
     @property
     def alpha(self):
-        if self._alpha.any():
-            return self._alpha
-        elif self.do_diff:
-            self._alpha = np.array(u.diff(self.w, self._t))
-            return self._alpha
-        raise ValueError('No angular acceleration data available')
+        return self._get('alpha', 'angular acceleration')
 
     @alpha.setter
     def alpha(self, value):
-        self._alpha = value
+        self._set('alpha', value)
+
+    def stamped(self, name):
+        """
+        Field name ('p', 'r', 'v', ...) as a StampedData, for time lookups and interpolation.
+        Its samples are matched to the first timestamps, as fields may be shorter than t
+        (e.g. forward differences, or ground truth ending before the other logs).
+        """
+        value = getattr(self, name)
+        return u.StampedData(value, self._t[:len(value)])
 
     def transform(self, T = np.array([[1, 0, 0, 0],[0, 1, 0, 0],[0, 0, 1, 0],[0, 0, 0, 1]]), side = "right"):
+        """
+        Data with the poses transformed by T (4 x 4, or N x 4 x 4 per sample): self.T T for
+        side "right", T self.T otherwise. The result keeps the composed poses, so chained
+        transforms do not go through the RPY angles in between.
+        """
         if side == "right":
-            p, r = u.transform_data_right(self.p, self.r, T)
+            poses = u.compose(self.T, T)
         else:
-            p, r = u.transform_data_left(self.p, self.r, T)
-        
-        return Data(self._t, p, r, do_diff = True)
+            poses = u.compose(T, self.T)
+        p, r = u.from_mat(poses)
+
+        return Data(self._t, p, r, do_diff = True, T = poses, diff_scheme = self.diff_scheme)
 
     def slice(self, s = 0, e = 0):
         """" Slice all data from s to e."""
-        self.p = self.p[s:e]
-        self.r = self.r[s:e]
-        self.alpha = self.alpha[s:e]
-        self.v = self.v[s:e]
-        self.w = self.w[s:e]
-        self.a = self.a[s:e]
\ No newline at end of file
+        # Read everything (deriving what is missing) before setting anything, so that no
+        # field is re-derived from already sliced data; derived fields stay marked as such.
+        p, r, alpha, v, w, a = self.p, self.r, self.alpha, self.v, self.w, self.a
+        derived = self._derived
+        if self._t.dtype != object:
+            self._t = self._t[s:e]
+        self.p = p[s:e]
+        self.r = r[s:e]
+        self.alpha = alpha[s:e]
+        self.v = v[s:e]
+        self.w = w[s:e]
+        self.a = a[s:e]
+        self._derived = derived
\ No newline at end of file
@@ -7,89 +7,178 @@ import numpy as np
 from numpy import sin, cos, arctan2, sqrt
 
 class StampedData():
-    def __init__(self):
-        self.data = []
-        self.t = []
+    def __init__(self, data=None, t=None):
+        """
+        Samples data[i] (along the first axis) stamped t[i], with t sorted. Either filled as
+        lists and converted with convert_lists_to_numpy(), or given as arrays.
+
+        The time lookups below use binary searches on t, so querying M times costs
+        O(M log N). If data and t differ in length, the samples are the first
+        min(len(data), len(t)) of both.
+        """
+        self.data = [] if data is None else data
+        self.t = [] if t is None else t
 
     def convert_lists_to_numpy(self):
         self.data = np.array(self.data)
         self.t = np.array(self.t)
 
-def to_rot(r):
-    Rx = np.mat([[ 1,         0,           0],
-                 [ 0, cos(r[0]), -sin(r[0]) ],
-                 [ 0, sin(r[0]),  cos(r[0]) ]])
-
-    Ry = np.mat([[ cos(r[1]), 0,  sin(r[1]) ],
-                 [ 0,         1,          0 ],
-                 [-sin(r[1]), 0,  cos(r[1]) ]])
+    def __len__(self):
+        return min(len(self.data), len(self.t))
+
+    def _arrays(self):
+        n = len(self)
+        return np.asarray(self.t, dtype=np.float64)[:n], np.asarray(self.data)[:n]
+
+    def at(self, t):
+        """Latest sample(s) stamped at or before t (scalar or array) - a zero-order hold."""
+        stamps, data = self._arrays()
+        i = np.searchsorted(stamps, t, side='right') - 1
+        if np.any(i < 0):
+            raise ValueError("t is before the first sample.")
+        return data[i]
+
+    def nearest(self, t):
+        """Sample(s) stamped closest to t (scalar or array); ties go to the earlier sample."""
+        stamps, data = self._arrays()
+        t = np.asarray(t, dtype=np.float64)
+        if len(stamps) < 2:
+            return data[np.zeros(t.shape, dtype=int)]
+        i = np.clip(np.searchsorted(stamps, t), 1, len(stamps) - 1)
+        i -= t - stamps[i - 1] <= stamps[i] - t
+        return data[i]
+
+    def between(self, t0, t1):
+        """StampedData of the samples with t0 <= t <= t1 (views, not copies)."""
+        stamps, data = self._arrays()
+        i0 = np.searchsorted(stamps, t0, side='left')
+        i1 = np.searchsorted(stamps, t1, side='right')
+        return StampedData(data[i0:i1], stamps[i0:i1])
+
+    def interpolate(self, t, slerp=False):
+        """
+        Samples interpolated at times t (scalar or array), held at the first and last
+        samples outside the stamped range.
+
+        :param t: Query times.
+        :param slerp: Interpolate unit quaternions (N x 4) along the shorter great arc
+                      instead of linearly.
+        :return: Interpolated samples, shaped t.shape + data.shape[1:].
+        """
+        stamps, data = self._arrays()
+        data = np.asarray(data, dtype=np.float64)
+        t = np.asarray(t, dtype=np.float64)
+        if len(stamps) < 2:
+            return data[np.zeros(t.shape, dtype=int)]
+        i = np.clip(np.searchsorted(stamps, t, side='right') - 1, 0, len(stamps) - 2)
+        dt = stamps[i + 1] - stamps[i]
+        u = np.clip((t - stamps[i]) / np.where(dt > 0, dt, 1.0), 0.0, 1.0)
+        u = u.reshape(u.shape + (1,) * (data.ndim - 1))
+        x0 = data[i]
+        x1 = data[i + 1]
+        if not slerp:
+            return x0 + u * (x1 - x0)
+
+        # q and -q are the same rotation: flip x1 onto the hemisphere of x0.
+        dot = np.sum(x0 * x1, axis=-1, keepdims=True)
+        x1 = np.where(dot < 0, -x1, x1)
+        theta = np.arccos(np.clip(np.abs(dot), 0.0, 1.0))
+        sin = np.sin(theta)
+        small = sin < 1e-9  # nearly equal quaternions: linear interpolation is exact enough
+        s = np.where(small, 1.0, sin)
+        w0 = np.where(small, 1 - u, np.sin((1 - u) * theta) / s)
+        w1 = np.where(small, u, np.sin(u * theta) / s)
+        q = w0 * x0 + w1 * x1
+        return q / np.linalg.norm(q, axis=-1, keepdims=True)
 
-    Rz = np.mat([[ cos(r[2]), -sin(r[2]), 0 ],
-                 [ sin(r[2]),  cos(r[2]), 0 ],
-                 [         0,          0, 1 ]])
+def to_rot(r):
+    """
+    Rotation matrices Rz Ry Rx of XYZ (RPY) Euler angles [rad].
 
-    return Rz*Ry*Rx
+    :param r: [3,] or N x 3 roll, pitch, yaw.
+    :return: 3 x 3 or N x 3 x 3 rotation matrices.
+    """
+    r = np.asarray(r, dtype=np.float64)
+    cr, cp, cy = cos(r[..., 0]), cos(r[..., 1]), cos(r[..., 2])
+    sr, sp, sy = sin(r[..., 0]), sin(r[..., 1]), sin(r[..., 2])
+    R = np.empty(r.shape[:-1] + (3, 3))
+    R[..., 0, 0] = cy * cp
+    R[..., 0, 1] = cy * sp * sr - sy * cr
+    R[..., 0, 2] = cy * sp * cr + sy * sr
+    R[..., 1, 0] = sy * cp
+    R[..., 1, 1] = sy * sp * sr + cy * cr
+    R[..., 1, 2] = sy * sp * cr - cy * sr
+    R[..., 2, 0] = -sp
+    R[..., 2, 1] = cp * sr
+    R[..., 2, 2] = cp * cr
+    return R
 
 def to_mat(p, r):
-    "Given a position [m] and orientation as RPY [rad], create homogenous transformation matrix."
-    R = to_rot(r)
-    return np.mat(np.r_[np.c_[R, p], [np.array([0, 0, 0, 1])]])
+    "Given positions [m] and orientations as RPY [rad] ([3,] or N x 3), create homogenous transformation matrices."
+    r = np.asarray(r, dtype=np.float64)
+    T = np.zeros(r.shape[:-1] + (4, 4))
+    T[..., 0:3, 0:3] = to_rot(r)
+    T[..., 0:3, 3] = p
+    T[..., 3, 3] = 1
+    return T
 
 def from_mat(T):
-    "Get position [m] and orientation as RPY [rad] from homogenous transformation matrix."
-    p = [T[0,3], T[1,3], T[2,3]]
-    r = [arctan2(T[2,1],T[2,2]) , arctan2(-T[2,0],sqrt(T[2,1] ** 2 + T[2,2] ** 2)), arctan2(T[1,0],T[0,0]) ]
+    "Get positions [m] and orientations as RPY [rad] from homogenous transformation matrices (4 x 4 or N x 4 x 4)."
+    T = np.asarray(T)
+    p = np.array(T[..., 0:3, 3], dtype=np.float64)
+    r = np.stack([arctan2(T[..., 2, 1], T[..., 2, 2]),
+                  arctan2(-T[..., 2, 0], sqrt(T[..., 2, 1] ** 2 + T[..., 2, 2] ** 2)),
+                  arctan2(T[..., 1, 0], T[..., 0, 0])], axis=-1)
     return p, r
 
+def compose(*T):
+    """
+    Product T[0] T[1] ... of homogenous transformations, each 4 x 4 or a stack N x 4 x 4;
+    single transformations are applied to every element of the stacks.
+    """
+    out = np.asarray(T[0], dtype=np.float64)
+    for T_i in T[1:]:
+        out = np.einsum('...ij,...jk->...ik', out, np.asarray(T_i, dtype=np.float64))
+    return out
+
 def transform_data_right(p, r, T_frame):
     "Transform data to a different frame."
-    p_new = [0]*len(p)
-    r_new = [0]*len(p)
-
-    for i in (range(len(p))):
-        T_i = to_mat(p[i, :], r[i, :])
-        T_new = T_i.dot(T_frame)
-        p_new[i], r_new[i] = from_mat(T_new)
-
-    return np.array(p_new), np.array(r_new)
+    return from_mat(compose(to_mat(p, r), T_frame))
 
 def transform_data_left(p, r, T_frame):
     "Transform data to different frame."
-    p_new = [0]*len(p)
-    r_new = [0]*len(p)
-
-    for i in (range(len(p))):
-        T_i = to_mat(p[i, :], r[i, :])
-        T_new = T_frame.dot(T_i)
-        p_new[i], r_new[i] = from_mat(T_new)
-
-    return np.array(p_new), np.array(r_new)
+    return from_mat(compose(T_frame, to_mat(p, r)))
 
 def to_own_frame(r, x):
-    x_new = np.zeros(x.shape)
-
-    for i in (range(len(x))):
-        x_new[i] = x[i].dot(to_rot(r[i]))
-
-    return x_new
+    "Rotate each row of x [N x 3] by the transposed rotation of the matching row of r."
+    return np.einsum('ni,nij->nj', x, to_rot(r))
 
 def to_angular_rates(r, r_dot):
     """
     Compute the inverse of the Euler kinematical matrix for the given roll,
     pitch, and yaw angles - the kinematical matrix is used to compute the
     rate of change of the Euler angles as a function of the angular velocity.
+    r and r_dot may be [3,] or N x 3.
     """
     # Still need to differentiate the Euler angles first wrt time.
-    cr = np.cos(r[0])
-    sr = np.sin(r[0])
-    sp = np.sin(r[1])
-    cp = np.cos(r[1])
+    r = np.asarray(r, dtype=np.float64)
+    cr = np.cos(r[..., 0])
+    sr = np.sin(r[..., 0])
+    sp = np.sin(r[..., 1])
+    cp = np.cos(r[..., 1])
 
     # Generate inverse of kinematical matrix.
     # M = np.array([[1, tp*sr, tp*cr], [0, cr, -sr], [0, sr/cp, cr/cp]])
-    G = np.array([[1, 0, -sp], [0, cr, sr*cp], [0, -sr, cr*cp]])
+    # G = np.array([[1, 0, -sp], [0, cr, sr*cp], [0, -sr, cr*cp]])
+    G = np.zeros(r.shape[:-1] + (3, 3))
+    G[..., 0, 0] = 1
+    G[..., 0, 2] = -sp
+    G[..., 1, 1] = cr
+    G[..., 1, 2] = sr * cp
+    G[..., 2, 1] = -sr
+    G[..., 2, 2] = cr * cp
 
-    return G @ r_dot
+    return np.einsum('...ij,...j->...i', G, r_dot)
 
 def integ(x, t):
     out = [None] * (len(x) + 1)
@@ -99,12 +188,19 @@ def integ(x, t):
 
     return out
 
-def diff(x, t):
-    out = [None] * (len(x) - 1)
-    for i in (range(len(out))):
-        # Forward finite difference scheme.
-        dt = t[i + 1] - t[i]
-        dx = x[i + 1, :] - x[i, :]
-        out[i] = dx / dt
+def diff(x, t, scheme='forward'):
+    """
+    Finite differences of the rows of x over the timestamps t.
 
-    return out
\ No newline at end of file
+    :param scheme: 'forward' for (x[i+1] - x[i]) / (t[i+1] - t[i]), len(x) - 1 rows, or
+                   'central' for second-order central differences on the (possibly
+                   non-uniform) timestamps with one-sided ones at the ends, len(x) rows.
+    """
+    x = np.asarray(x)
+    t = np.asarray(t, dtype=np.float64)[:len(x)]
+    if scheme == 'central':
+        return np.gradient(x, t, axis=0)
+    elif scheme != 'forward':
+        raise ValueError("scheme must be 'forward' or 'central'.")
+    dt = np.diff(t)
+    return np.diff(x, axis=0) / dt.reshape((-1,) + (1,) * (x.ndim - 1))
@@ -6,7 +6,9 @@ import pickle
 import numpy as np
 import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
-from rotations import angle_normalize, rpy_jacobian_axis_angle, skew_symmetric, Quaternion
+from rotations import angle_normalize, Quaternion
+from esekf import ESEKF, run
+from analysis import analyse
 
 # 1. Data ###################################################################################
 
@@ -101,177 +103,29 @@ var_imu_w = 0.25
 var_gnss = 0.01
 var_lidar = 1.00
 
-################################################################################################
-# We can also set up some constants that won't change for any iteration of our solver.
-################################################################################################
-g = np.array([0, 0, -9.81])  # gravity
-l_jac = np.zeros([9, 6])
-l_jac[3:, :] = np.eye(6)  # motion model noise jacobian
-h_jac = np.zeros([3, 9])
-h_jac[:, :3] = np.eye(3)  # measurement model jacobian
-
 # 3. Initial Values #########################################################################
 
 ################################################################################################
-# Let's set up some initial values for our ES-EKF solver.
+# Let's set up some initial values for our ES-EKF solver. The filter itself (motion model,
+# jacobians and measurement update) lives in esekf.py.
 ################################################################################################
-p_est = np.zeros([imu_f.data.shape[0], 3])  # position estimates
-v_est = np.zeros([imu_f.data.shape[0], 3])  # velocity estimates
-q_est = np.zeros([imu_f.data.shape[0], 4])  # orientation estimates as quaternions
-p_cov = np.zeros([imu_f.data.shape[0], 9, 9])  # covariance matrices at each timestep
-
-# Set initial values.
-p_est[0] = gt.p[0]
-v_est[0] = gt.v[0]
-q_est[0] = Quaternion(euler=gt.r[0]).to_numpy()
-p_cov[0] = np.zeros(9)  # covariance of estimate
-gnss_i = 0
-lidar_i = 0
-
+ekf = ESEKF(gt.p[0], gt.v[0], Quaternion(euler=gt.r[0]).to_numpy(),
+            var_imu_f=var_imu_f, var_imu_w=var_imu_w)
 
 # 4. Measurement Update #####################################################################
 
 ################################################################################################
-# Since we'll need a measurement update for both the GNSS and the LIDAR data, let's make
-# a function for it.
+# Both the GNSS and the LIDAR data use the same measurement update, ESEKF.correct().
 ################################################################################################
 
-
-def measurement_update(sensor_var, p_cov_check, y_k, p_check, v_check, q_check):
-    H = h_jac
-    R = np.identity(3) * sensor_var
-
-    # 3.1 Compute Kalman Gain
-    K = p_cov_check @ H.T @ np.linalg.inv(H @ p_cov_check @ H.T + R)
-
-    # 3.2 Compute error state
-    # sensor position - predicted position
-    dX = K @ (y_k - p_check)
-
-    # 3.3 Correct predicted state
-    p_hat = p_check + dX[0:3]
-    v_hat = v_check + dX[3:6]
-    q_hat = Quaternion(euler=dX[6:9]).quat_mult_right(q_check)
-
-    # 3.4 Compute corrected covariance
-    p_cov_hat = (np.eye(9) - K @ H) @ p_cov_check
-
-    return p_hat, v_hat, q_hat, p_cov_hat
-
-
-# ======================================================
-# motion model
-# ======================================================
-
-# imu update
-def f_imu(p, v, q, fi, wi, dt):
-    # create rotation matrix from previous 'q'
-    Cns = Quaternion(*q).to_mat()
-
-    cf = (Cns @ fi) + g
-
-    # update position
-    p = p + dt * v + (dt ** 2 / 2.0) * cf
-
-    # update velocity
-    v = v + dt * cf
-
-    # update orientation
-    # q = Quaternion(axis_angle=(wi * dt)).quat_mult_right(q)
-    q = Quaternion(*q).quat_mult_left(Quaternion(euler=(wi * dt)))
-
-    return p, v, q
-
-
 # 5. Main Filter Loop #######################################################################
 
-
 ################################################################################################
 # Now that everything is set up, we can start taking in the sensor data and creating estimates
-# for our state in a loop.
+# for our state: predict with each IMU sample, and correct whenever a GNSS or LIDAR
+# measurement is available.
 ################################################################################################
-
-# start at 1 b/c we have initial prediction from gt
-for k in range(1, imu_f.data.shape[0]):
-    delta_t = imu_f.t[k] - imu_f.t[k - 1]
-
-    # 1. Update state with IMU inputs
-    p_check, v_check, q_check = f_imu(p_est[k - 1],
-                                      v_est[k - 1],
-                                      q_est[k - 1],
-                                      imu_f.data[k - 1],
-                                      imu_w.data[k - 1],
-                                      delta_t)
-
-    # 1.1 Linearize the motion model and compute Jacobians
-    # see lesson 2 Linearized Motion Model Slide
-
-    Cns = Quaternion(*q_est[k - 1]).to_mat()
-
-    # 'x' subscript in lesson 2 linearized motion model is skew operator
-    X = (Cns @ -skew_symmetric(imu_f.data[k - 1])) * delta_t
-    I = np.identity(3)
-    F = np.zeros((9, 9))
-
-    # first row
-    F[0:3, 0:3] = I
-    F[0:3, 3:6] = delta_t * I
-    # F[0:3, 6:9] = 0
-
-    # second row
-    # F[3:6], 0:3] = 0
-    F[3:6, 3:6] = I
-    F[3:6, 6:9] = X
-
-    # third row
-    # F[6:9, 0:3] = 0
-    # F[6:9, 3:6] = 0
-    F[6:9, 6:9] = I
-
-    # 2. Propagate uncertainty
-    # see lesson 2 : Linearized Motion Model Slide
-    Q = np.eye(6)
-    Q[0:3, 0:3] = I * var_imu_f
-    Q[3:6, 3:6] = I * var_imu_w
-    Q = Q * delta_t ** 2
-
-    # see lesson 2 : EKF | IMU + GNSS + LIDAR slide  item 2.
-    p_cov_check = F @ p_cov[k - 1] @ F.T + l_jac @ Q @ l_jac.T
-
-    # update if no gnss or lidar measurement
-    p_hat = p_check
-    v_hat = v_check
-    q_hat = q_check
-    p_cov_hat = p_cov_check
-
-    # 3. Check availability of GNSS and LIDAR measurements
-    if (gnss_i < len(gnss.t)) and (gnss.t[gnss_i] <= imu_f.t[k]):
-        # got a gnss update
-        p_hat, v_hat, q_hat, p_cov_hat = measurement_update(var_gnss,
-                                                            p_cov_check,
-                                                            gnss.data[gnss_i],
-                                                            p_check,
-                                                            v_check,
-                                                            q_check)
-        # look for next gnss update
-        gnss_i += 1
-
-    if (lidar_i < len(lidar.t)) and (lidar.t[lidar_i] <= imu_f.t[k]):
-        # got a lidar update
-        p_hat, v_hat, q_hat, p_cov_hat = measurement_update(var_lidar,
-                                                            p_cov_check,
-                                                            lidar.data[lidar_i],
-                                                            p_check,
-                                                            v_check,
-                                                            q_check)
-        # look for next lidar update
-        lidar_i += 1
-
-    # Update states (save)
-    p_est[k] = p_hat
-    v_est[k] = v_hat
-    q_est[k] = q_hat
-    p_cov[k] = p_cov_hat
+p_est, v_est, q_est, p_cov = run(ekf, imu_f, imu_w, [(gnss, var_gnss), (lidar, var_lidar)])
 
 # 6. Results and Analysis ###################################################################
 
@@ -307,23 +161,13 @@ plt.show()
 error_fig, ax = plt.subplots(2, 3)
 error_fig.suptitle('Error Plots')
 num_gt = gt.p.shape[0]
-p_est_euler = []
-p_cov_euler_std = []
-
-# Convert estimated quaternions to euler angles
-for i in range(len(q_est)):
-    qc = Quaternion(*q_est[i, :])
-    p_est_euler.append(qc.to_euler())
-
-    # First-order approximation of RPY covariance
-    J = rpy_jacobian_axis_angle(qc.to_axis_angle())
-    p_cov_euler_std.append(np.sqrt(np.diagonal(J @ p_cov[i, 6:, 6:] @ J.T)))
-
-p_est_euler = np.array(p_est_euler)
-p_cov_euler_std = np.array(p_cov_euler_std)
 
-# Get uncertainty estimates from P matrix
-p_cov_std = np.sqrt(np.diagonal(p_cov[:, :6, :6], axis1=1, axis2=2))
+# Convert estimated quaternions to euler angles, with a first-order approximation of the RPY
+# covariance, and get uncertainty estimates from P matrix
+results = analyse(p_est, q_est, p_cov)
+p_est_euler = results.euler
+p_cov_euler_std = results.euler_std
+p_cov_std = results.p_std
 
 titles = ['Easting', 'Northing', 'Up', 'Roll', 'Pitch', 'Yaw']
 for i in range(3):
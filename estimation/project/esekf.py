@@ -0,0 +1,444 @@
+# Error-state EKF engine for the Coursera SDC Course 2 final project.
+#
+# The filter equations are the ones from es_ekf.py (lesson 2, "EKF | IMU + GNSS + LIDAR"),
+# packaged as a class that keeps its state and work buffers between steps instead of
+# rebuilding F, Q and the identity matrices on every IMU tick.
+import math
+import numpy as np
+from covariance import CovarianceRecorder
+from events import iter_events
+from lie import rotvec_quat
+
+g = np.array([0, 0, -9.81])  # gravity
+
+POSITION = slice(0, 3)  # error-state block observed by the GNSS and LIDAR position fixes
+
+DEFER_MIN = 8  # fewest deferred steps worth composing in one go (see ESEKF.flush)
+
+# Precision settings: dtype of the nominal state and of the covariance. Below float64, the
+# covariance update uses the symmetrised Joseph form, which keeps P symmetric and positive
+# semi-definite under rounding.
+PRECISIONS = {
+    'float64': (np.float64, np.float64),
+    'mixed': (np.float64, np.float32),
+    'float32': (np.float32, np.float32),
+}
+
+
+def quat_mult(a, b):
+    """Hamilton product a*b of two wxyz tuples."""
+    aw, ax, ay, az = a
+    bw, bx, by, bz = b
+    return (aw * bw - ax * bx - ay * by - az * bz,
+            ax * bw + aw * bx - az * by + ay * bz,
+            ay * bw + az * bx + aw * by - ax * bz,
+            az * bw - ay * bx + ax * by + aw * bz)
+
+
+def quat_rotation(qw, qx, qy, qz):
+    """Row-major rotation matrix of a wxyz quaternion (Quaternion.to_mat), as 9 floats."""
+    d = qw * qw - (qx * qx + qy * qy + qz * qz)
+    w2 = 2 * qw
+    return (d + 2 * qx * qx, 2 * qx * qy - w2 * qz, 2 * qx * qz + w2 * qy,
+            2 * qy * qx + w2 * qz, d + 2 * qy * qy, 2 * qy * qz - w2 * qx,
+            2 * qz * qx - w2 * qy, 2 * qz * qy + w2 * qx, d + 2 * qz * qz)
+
+
+def selection_update(p_cov, idx, r, var, joseph=False):
+    """
+    Kalman update for a sensor that observes a subset of the error state, i.e. whose
+    measurement jacobian is a selection matrix H = I[idx, :].
+
+    H P H^T and P H^T are slices of P, and the small m x m innovation covariance is
+    factored as S = L L^T, so that with W = L^-1 H P the update is dx = W^T L^-1 r and
+    P = P - W^T W. No general inverse or products with the zero columns of H are formed.
+
+    :param p_cov: n x n error-state covariance, updated in place.
+    :param idx: Observed states, as a slice or index list.
+    :param r: Innovation y - h(x), length m.
+    :param var: Measurement noise: a variance, m per-axis variances, or an m x m covariance.
+    :param joseph: Use the Joseph form (I - KH) P (I - KH)^T + K R K^T, symmetrised.
+    :return: Error-state correction dx [n,].
+    """
+    PHt = p_cov[:, idx]
+    S = PHt[idx].tolist()
+    m = len(S)
+    R = None
+    if isinstance(var, (int, float)):
+        for i in range(m):
+            S[i][i] += var
+    else:
+        R = np.asarray(var, dtype=np.float64)
+        if R.ndim < 2:
+            R = np.diag(np.broadcast_to(R, (m,)))
+        for i in range(m):
+            for j in range(m):
+                S[i][j] += R[i, j]
+
+    # Cholesky factor S = L L^T and its inverse, row by row on Python floats since m is small.
+    L = []
+    Linv = []
+    z = []  # L^-1 r
+    for i in range(m):
+        Si = S[i]
+        Li = [0.0] * m
+        for j in range(i):
+            Lj = L[j]
+            v = Si[j]
+            for k in range(j):
+                v -= Li[k] * Lj[k]
+            Li[j] = v / Lj[j]
+        v = Si[i]
+        for k in range(i):
+            v -= Li[k] * Li[k]
+        if v <= 0:
+            raise np.linalg.LinAlgError("Innovation covariance is not positive definite.")
+        Li[i] = math.sqrt(v)
+
+        Ii = [0.0] * m
+        for j in range(i):
+            v = 0.0
+            for k in range(j, i):
+                v -= Li[k] * Linv[k][j]
+            Ii[j] = v / Li[i]
+        Ii[i] = 1.0 / Li[i]
+        v = r[i]
+        for k in range(i):
+            v -= Li[k] * z[k]
+        z.append(v / Li[i])
+        L.append(Li)
+        Linv.append(Ii)
+    Linv = np.array(Linv)
+
+    W = Linv @ PHt.T
+    dx = np.dot(z, W)
+
+    if joseph:
+        if R is None:
+            R = var * np.eye(m)
+        K = W.T @ Linv
+        A = np.eye(p_cov.shape[0])
+        A[:, idx] -= K
+        P = A @ p_cov @ A.T + K @ R @ K.T
+        p_cov[...] = P
+        p_cov += P.T
+        p_cov *= 0.5
+    else:
+        p_cov -= W.T @ W
+    return dx
+
+
+def compose_transitions(tau, dt, B, var_imu_f, var_imu_w, C=None):
+    """
+    Composed jacobian and accumulated process noise of K predict() steps, without the 9x9
+    products of the individual steps.
+
+    Each F_j is block unit upper triangular, with dt_j I at [0:3, 3:6] and
+    B_j = -C_(j-1) [f_j]x dt_j at [3:6, 6:9], so F_K ... F_(j+1) only has the blocks
+    [0:3, 3:6] = (T - tau_j) I, [3:6, 6:9] = sum_(l>j) B_l and
+    [0:3, 6:9] = sum_(l>j) (T - tau_l) B_l. The process noise of step j, var_imu_f dt_j^2 on
+    v and var_imu_w dt_j^2 on theta, is carried to the end of the run by that product.
+
+    :param tau: Time since the start after each step [K,].
+    :param dt: Time steps [K,].
+    :param B: K x 9 row-major F[3:6, 6:9] blocks.
+    :param var_imu_f: IMU specific force variance.
+    :param var_imu_w: IMU angular rate variance.
+    :param C: Rotation of the frame the B blocks are expressed in, if not the world frame.
+    :return: (Phi, Q) such that the propagated covariance is Phi P Phi^T + Q.
+    """
+    k = len(tau)
+    T = tau[-1]
+    A = T - tau
+
+    # Y_j = [sum_(l>j) (T - tau_l) B_l; sum_(l>j) B_l], as totals minus inclusive cumulative
+    # sums.
+    G = np.empty((k, 2, 9))
+    np.multiply(A[:, None], B, out=G[:, 0])
+    G[:, 1] = B
+    Gc = np.cumsum(G, axis=0).reshape(k, 6, 3)
+    if C is not None:
+        Gc = (C @ Gc.reshape(k, 2, 3, 3)).reshape(k, 6, 3)
+    Y = Gc[-1] - Gc
+
+    Phi = np.eye(9)
+    Phi[0:3, 3:6] += T * np.eye(3)
+    Phi[0:6, 6:9] = Gc[-1]
+
+    # Attitude noise: sum_j w_j [Y_j; I] [Y_j; I]^T.
+    d2 = dt * dt
+    w = var_imu_w * d2
+    Ys = (Y * np.sqrt(w)[:, None, None]).transpose(1, 0, 2).reshape(6, -1)
+    Q = np.empty((9, 9))
+    Q[0:6, 0:6] = Ys @ Ys.T
+    Q[0:6, 6:9] = np.tensordot(w, Y, 1)
+    Q[6:9, 0:6] = Q[0:6, 6:9].T
+
+    # Velocity noise: sum_j a_j [(T - tau_j) I; I] [(T - tau_j) I; I]^T, on the diagonals of
+    # the position and velocity blocks.
+    saa, sa, s = (var_imu_f * (d2 @ np.vander(A, 3))).tolist()
+    Q.flat[_PV_DIAG] += (saa,) * 3 + (s,) * 3 + (sa,) * 6
+    Q[6:9, 6:9] = np.diag([var_imu_w * d2.sum()] * 3)
+    return Phi, Q
+
+
+# Flat indices in a 9x9 matrix of the diagonals of the [p, p], [v, v], [p, v] and [v, p] blocks.
+_PV_DIAG = np.array([0, 10, 20, 30, 40, 50, 3, 13, 23, 27, 37, 47])
+
+
+class ESEKF():
+    def __init__(self, p, v, q, p_cov=None, var_imu_f=0.10, var_imu_w=0.25, deferred=False,
+                 precision='float64'):
+        """
+        Error-state EKF with a [p, v, q] nominal state and a 9-dim error state [dp, dv, dtheta].
+
+        p, v and q are views into one state vector x = [p, v, q], and together with p_cov
+        they are owned by the filter and updated in place by predict() and correct(); copy
+        them if a snapshot is needed.
+
+        In deferred mode predict() only propagates the nominal state and keeps the blocks
+        of F that change; the covariance is propagated through all of the kept steps at
+        once (see compose_transitions) when p_cov is next read, e.g. by correct(). The
+        result is the same up to rounding.
+
+        With a reduced precision (see PRECISIONS) the state and the covariance are stored
+        in float32, and correct() defaults to the Joseph form.
+
+        :param p: Initial position [3,].
+        :param v: Initial velocity [3,].
+        :param q: Initial orientation as a wxyz quaternion [4,].
+        :param p_cov: Initial 9x9 error-state covariance. Defaults to zero.
+        :param var_imu_f: IMU specific force variance.
+        :param var_imu_w: IMU angular rate variance.
+        :param deferred: Defer the covariance propagation until it is needed.
+        :param precision: 'float64', 'mixed' (float32 covariance) or 'float32'.
+        """
+        if precision not in PRECISIONS:
+            raise ValueError("precision must be one of %s." % (tuple(PRECISIONS),))
+        self.precision = precision
+        dtype, cov_dtype = PRECISIONS[precision]
+        self.joseph = cov_dtype != np.float64
+        self.x = np.zeros(10, dtype=dtype)
+        self.p = self.x[0:3]
+        self.v = self.x[3:6]
+        self.q = self.x[6:10]
+        self.p[:] = p
+        self.v[:] = v
+        self.q[:] = q
+        self._p_cov = np.zeros((9, 9), dtype=cov_dtype)
+        if p_cov is not None:
+            self._p_cov[:] = p_cov
+        self.var_imu_f = var_imu_f
+        self.var_imu_w = var_imu_w
+        self._g = g.tolist()
+
+        # Work buffers, reused on every step.
+        self._F = np.eye(9, dtype=cov_dtype)  # motion model jacobian; only the off-diagonal blocks change
+        self._tmp = np.zeros((9, 9), dtype=cov_dtype)
+        self._p_cov_diag = self._p_cov.reshape(-1)[::10]  # view of the diagonal of p_cov
+        self._q_diag = np.zeros(9, dtype=cov_dtype)  # diagonal of L Q L^T for the cached dt
+        self._dt = None
+        # Deferred steps, flattened: time since the last flush, dt and F[3:6, 6:9] (row-major).
+        self.deferred = deferred
+        self._pending = [] if deferred else None
+        self._tau = 0.0
+
+    @property
+    def p_cov(self):
+        """9x9 error-state covariance, brought up to date first in deferred mode."""
+        if self._pending:
+            self.flush()
+        return self._p_cov
+
+    @property
+    def F(self):
+        """9x9 motion model jacobian of the latest predict() (not kept in deferred mode)."""
+        return self._F
+
+    def flush(self):
+        """Propagate the covariance through the deferred predict() steps."""
+        pending = self._pending
+        if not pending:
+            return
+        self._pending = []
+        self._tau = 0.0
+        if len(pending) < DEFER_MIN * 11:
+            # A few steps are cheaper one by one than composed.
+            for i in range(0, len(pending), 11):
+                self._propagate(pending[i + 1], (pending[i + 2:i + 5], pending[i + 5:i + 8], pending[i + 8:i + 11]))
+            return
+        rows = np.array(pending).reshape(-1, 11)
+        Phi, Q = compose_transitions(rows[:, 0], rows[:, 1], rows[:, 2:], self.var_imu_f, self.var_imu_w)
+        self._p_cov[...] = Phi @ self._p_cov @ Phi.T + Q
+
+    def predict(self, imu_f, imu_w, dt):
+        """
+        Propagate the nominal state and the error-state covariance through one IMU sample.
+
+        :param imu_f: Specific force in the vehicle frame, length 3.
+        :param imu_w: Angular rate in the vehicle frame, length 3.
+        :param dt: Time step [s].
+        """
+        c00, c01, c02, c10, c11, c12, c20, c21, c22 = self._predict_state(imu_f, imu_w, dt)
+        fx, fy, fz = imu_f
+
+        # Linearized motion model; F[0:3, 3:6] = dt * I and F[3:6, 6:9] = -C [f]x dt.
+        b0 = ((c02 * fy - c01 * fz) * dt, (c00 * fz - c02 * fx) * dt, (c01 * fx - c00 * fy) * dt)
+        b1 = ((c12 * fy - c11 * fz) * dt, (c10 * fz - c12 * fx) * dt, (c11 * fx - c10 * fy) * dt)
+        b2 = ((c22 * fy - c21 * fz) * dt, (c20 * fz - c22 * fx) * dt, (c21 * fx - c20 * fy) * dt)
+        if self._pending is not None:
+            self._tau += dt
+            self._pending.extend((self._tau, dt) + b0 + b1 + b2)
+        else:
+            self._propagate(dt, (b0, b1, b2))
+
+    def _predict_state(self, imu_f, imu_w, dt):
+        """Nominal state step of predict(); returns the rotation matrix of q before it, row-major."""
+        px, py, pz, vx, vy, vz, qw, qx, qy, qz = self.x.tolist()
+        fx, fy, fz = imu_f
+        wx, wy, wz = imu_w
+
+        # Rotation matrix of q (Quaternion.to_mat), computed once and shared by the nominal
+        # state update and the jacobian.
+        d = qw * qw - (qx * qx + qy * qy + qz * qz)
+        w2 = 2 * qw
+        c00 = d + 2 * qx * qx
+        c01 = 2 * qx * qy - w2 * qz
+        c02 = 2 * qx * qz + w2 * qy
+        c10 = 2 * qy * qx + w2 * qz
+        c11 = d + 2 * qy * qy
+        c12 = 2 * qy * qz - w2 * qx
+        c20 = 2 * qz * qx - w2 * qy
+        c21 = 2 * qz * qy + w2 * qx
+        c22 = d + 2 * qz * qz
+
+        # Nominal state (f_imu).
+        gx, gy, gz = self._g
+        cfx = c00 * fx + c01 * fy + c02 * fz + gx
+        cfy = c10 * fx + c11 * fy + c12 * fz + gy
+        cfz = c20 * fx + c21 * fy + c22 * fz + gz
+        h = dt ** 2 / 2.0
+        self.x[:] = (px + dt * vx + h * cfx,
+                     py + dt * vy + h * cfy,
+                     pz + dt * vz + h * cfz,
+                     vx + dt * cfx,
+                     vy + dt * cfy,
+                     vz + dt * cfz) + quat_mult((qw, qx, qy, qz), rotvec_quat(wx * dt, wy * dt, wz * dt))
+        return c00, c01, c02, c10, c11, c12, c20, c21, c22
+
+    def _propagate(self, dt, b):
+        """Propagate the covariance through one step, with F[3:6, 6:9] = b."""
+        F = self._F
+        if dt != self._dt:
+            self._dt = dt
+            F[0, 3] = F[1, 4] = F[2, 5] = dt
+            self._q_diag[3:6] = self.var_imu_f * dt ** 2
+            self._q_diag[6:9] = self.var_imu_w * dt ** 2
+        F[3:6, 6:9] = b
+
+        # P = F P F^T + L Q L^T, where L Q L^T is diagonal on the v and theta blocks.
+        np.matmul(F, self._p_cov, out=self._tmp)
+        np.matmul(self._tmp, F.T, out=self._p_cov)
+        self._p_cov_diag += self._q_diag
+
+    def state_arrays(self):
+        """
+        The arrays that hold the complete filter state, x and the covariance (brought up to
+        date first in deferred mode). They are owned by the filter: copying them takes a
+        snapshot, and writing a snapshot back into them restores it.
+        """
+        self.flush()
+        return self.x, self._p_cov
+
+    def propagate(self, preint):
+        """
+        Propagate the nominal state and the error-state covariance through all the samples
+        of a preintegrated interval at once; equivalent to calling predict() on each.
+
+        :param preint: preintegration.ImuPreintegrator holding the samples since the state
+                       was last propagated.
+        """
+        if not len(preint):
+            return
+        x = preint.predict(self.p, self.v, self.q)
+        preint.propagate_covariance(self.p_cov, self.q)
+        self.x[:] = x
+
+    def correct(self, y, var, joseph=None):
+        """
+        Fuse a position measurement.
+
+        :param y: Measured position [3,].
+        :param var: Measurement variance, isotropic or per axis (see selection_update).
+        :param joseph: Use the Joseph-form covariance update. Defaults to self.joseph, set
+                       for the reduced precisions.
+        """
+        if joseph is None:
+            joseph = self.joseph
+        px, py, pz, vx, vy, vz, qw, qx, qy, qz = self.x.tolist()
+        y0, y1, y2 = y
+        self._inject(selection_update(self.p_cov, POSITION, [y0 - px, y1 - py, y2 - pz], var, joseph).tolist())
+
+    def _inject(self, dx):
+        """Add an error-state correction (9 floats) to the nominal state."""
+        px, py, pz, vx, vy, vz, qw, qx, qy, qz = self.x.tolist()
+        self.x[:] = (px + dx[0], py + dx[1], pz + dx[2],
+                     vx + dx[3], vy + dx[4], vz + dx[5]) + quat_mult((qw, qx, qy, qz), rotvec_quat(*dx[6:9]))
+
+
+def run(ekf, imu_f, imu_w, sensors, n=None, recorder=None):
+    """
+    Run the filter over a recorded log.
+
+    IMU ticks and sensor samples are merged into one time-ordered event sequence (see
+    events.merge_streams). Tick k predicts from t[k-1] to t[k] with IMU sample k-1, and
+    each measurement is fused once, in time order, on top of the state at the latest tick:
+    several measurements in one tick are applied one after another.
+
+    :param ekf: ESEKF, already initialised at imu_f.t[0].
+    :param imu_f: StampedData of specific forces.
+    :param imu_w: StampedData of angular rates.
+    :param sensors: List of (StampedData, variance) position sensors. Measurements with
+                    equal timestamps are fused in this order.
+    :param n: Number of ticks to run. Defaults to imu_f.data.shape[0].
+    :param recorder: CovarianceRecorder for the covariance history. Defaults to keeping
+                     every full matrix (9x9, or the filter's error-state size). The
+                     covariance is only read at the steps the recorder keeps, so with a
+                     deferred-mode filter and every > 1 the other steps propagate the mean
+                     only.
+    :return: p_est, v_est, q_est arrays of length n, with the estimate at each tick after all
+             of its corrections, and the covariances: an n x 9 x 9 array (n x dim x dim), or
+             the recorder if one was given.
+    """
+    if n is None:
+        n = imu_f.data.shape[0]
+    dtype, cov_dtype = PRECISIONS[ekf.precision]
+    x_est = np.zeros([n, 10], dtype=dtype)  # [p, v, q] estimates, returned as views
+    p_cov = recorder
+    if recorder is None:
+        p_cov = CovarianceRecorder(n, dim=ekf.p_cov.shape[-1], dtype=cov_dtype)
+
+    f = imu_f.data.tolist()
+    w = imu_w.data.tolist()
+    t = imu_f.t[:n].tolist()
+    k = 0
+    for t_e, j, i in iter_events([imu_f.t[1:n]] + [s for s, _ in sensors]):
+        if t_e > t[-1]:
+            break
+        if j == 0:
+            x_est[k] = ekf.x
+            if not k % p_cov.every:
+                p_cov.record(k, ekf.p_cov)
+            k = i + 1
+            ekf.predict(f[k - 1], w[k - 1], t[k] - t[k - 1])
+        else:
+            y, var = sensors[j - 1]
+            ekf.correct(y.data[i], var)
+    x_est[k] = ekf.x
+    p_cov.record(k, ekf.p_cov)
+
+    if recorder is None:
+        p_cov = p_cov.data
+    else:
+        recorder.flush()
+    return x_est[:, 0:3], x_est[:, 3:6], x_est[:, 6:10], p_cov
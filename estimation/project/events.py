@@ -0,0 +1,32 @@
+# Event ordering for the ES-EKF time loop.
+#
+# Merges the timestamps of any number of sensor streams into one time-ordered sequence of
+# (t, stream, sample) events, so that every sample is handled exactly once and in order no
+# matter how the sensor rates relate to each other.
+import numpy as np
+
+
+def merge_streams(streams):
+    """
+    Merge sensor streams into one time-ordered event sequence.
+
+    All timestamps are concatenated and sorted with a single stable argsort. Samples with
+    equal timestamps keep the order of the streams list, then their order within a stream.
+
+    :param streams: List of StampedData objects, or of timestamp arrays.
+    :return: (t, stream, index) arrays, where event e is sample index[e] of
+             streams[stream[e]], stamped t[e].
+    """
+    stamps = [np.asarray(getattr(s, 't', s), dtype=np.float64) for s in streams]
+    t = np.concatenate(stamps)
+    stream = np.concatenate([np.full(len(ts), j) for j, ts in enumerate(stamps)])
+    index = np.concatenate([np.arange(len(ts)) for ts in stamps])
+
+    order = np.argsort(t, kind='stable')
+    return t[order], stream[order], index[order]
+
+
+def iter_events(streams):
+    """Iterate over merge_streams(streams) as (t, stream, index) tuples of Python scalars."""
+    t, stream, index = merge_streams(streams)
+    return zip(t.tolist(), stream.tolist(), index.tolist())
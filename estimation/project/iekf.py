@@ -0,0 +1,297 @@
+# Left-invariant EKF on SE_2(3) for the same IMU + position-fix problem.
+#
+# The state X = (C, v, p) is treated as an element of SE_2(3) and its error as the
+# left-invariant eta = X_hat^-1 X = exp(xi), xi = [xi_p, xi_v, xi_theta], i.e. the position,
+# velocity and attitude errors expressed in the body frame. With the discrete model of
+# esekf.ESEKF.predict() (C+ = C G, G the rotation of w dt), the error evolves as
+#
+#   xi+ = Phi xi,   Phi = diag(G^T, G^T, G^T) [[I, I dt, -[f]x dt^2 / 2],
+#                                              [0, I,    -[f]x dt],
+#                                              [0, 0,    I]],
+#
+# which only depends on the IMU sample and dt, not on the state: gravity and the attitude
+# drop out. A batch of filters fed the same IMU stream therefore shares one Phi per step,
+# and the position fix y = p + n has the constant jacobian H = [I 0 0] on the innovation
+# C_hat^T (y - p_hat), with unchanged noise for isotropic variances. The nominal state is
+# propagated exactly as by ESEKF, and corrections are applied with the SE_2(3) exponential.
+import math
+import numpy as np
+from batch import BatchESEKF
+from esekf import ESEKF, POSITION, quat_mult, quat_rotation, selection_update
+from lie import SERIES, SMALL, quat_exp, rotvec_quat, so3_exp, so3_hat, so3_left_jacobian
+from rotations import QuaternionArray
+
+
+def invariant_transition(imu_f, imu_w, dt):
+    """
+    Error-state transition Phi of the left-invariant filter.
+
+    :param imu_f: Specific force(s) in the vehicle frame, [3,] or N x 3.
+    :param imu_w: Angular rate(s) in the vehicle frame, [3,] or N x 3.
+    :param dt: Time step(s) [s], scalar or [N,].
+    :return: 9 x 9 or N x 9 x 9 transition matrices.
+    """
+    imu_f = np.asarray(imu_f, dtype=np.float64)
+    imu_w = np.asarray(imu_w, dtype=np.float64)
+    single = imu_f.ndim == 1 and imu_w.ndim == 1 and np.ndim(dt) == 0
+    f = np.atleast_2d(imu_f)
+    dt = np.asarray(dt, dtype=np.float64).reshape(-1, 1, 1)
+    Gt = so3_exp(np.atleast_2d(imu_w) * dt[:, :, 0]).transpose(0, 2, 1)
+    S = np.zeros((f.shape[0], 3, 3))
+    S[:, 0, 1], S[:, 0, 2] = -f[:, 2], f[:, 1]
+    S[:, 1, 0], S[:, 1, 2] = f[:, 2], -f[:, 0]
+    S[:, 2, 0], S[:, 2, 1] = -f[:, 1], f[:, 0]
+    M = Gt @ S
+
+    n = max(Gt.shape[0], M.shape[0])
+    Phi = np.zeros((n, 9, 9))
+    Phi[:, 0:3, 0:3] = Phi[:, 3:6, 3:6] = Phi[:, 6:9, 6:9] = Gt
+    Phi[:, 0:3, 3:6] = Gt * dt
+    Phi[:, 0:3, 6:9] = M * (-dt ** 2 / 2.0)
+    Phi[:, 3:6, 6:9] = M * -dt
+    return Phi[0] if single else Phi
+
+
+def _transition_entries(imu_f, imu_w, dt):
+    """invariant_transition() of one IMU sample, as 81 floats (row-major)."""
+    fx, fy, fz = imu_f
+    wx, wy, wz = imu_w
+    g00, g01, g02, g10, g11, g12, g20, g21, g22 = quat_rotation(*rotvec_quat(wx * dt, wy * dt, wz * dt))
+    # Rows i of G^T are (g0i, g1i, g2i); d are those of -G^T [f]x dt.
+    ax, ay, az = fx * dt, fy * dt, fz * dt
+    d00, d01, d02 = g20 * ay - g10 * az, g00 * az - g20 * ax, g10 * ax - g00 * ay
+    d10, d11, d12 = g21 * ay - g11 * az, g01 * az - g21 * ax, g11 * ax - g01 * ay
+    d20, d21, d22 = g22 * ay - g12 * az, g02 * az - g22 * ax, g12 * ax - g02 * ay
+    h = dt / 2.0
+    return (g00, g10, g20, dt * g00, dt * g10, dt * g20, h * d00, h * d01, h * d02,
+            g01, g11, g21, dt * g01, dt * g11, dt * g21, h * d10, h * d11, h * d12,
+            g02, g12, g22, dt * g02, dt * g12, dt * g22, h * d20, h * d21, h * d22,
+            0.0, 0.0, 0.0, g00, g10, g20, d00, d01, d02,
+            0.0, 0.0, 0.0, g01, g11, g21, d10, d11, d12,
+            0.0, 0.0, 0.0, g02, g12, g22, d20, d21, d22,
+            0.0, 0.0, 0.0, 0.0, 0.0, 0.0, g00, g10, g20,
+            0.0, 0.0, 0.0, 0.0, 0.0, 0.0, g01, g11, g21,
+            0.0, 0.0, 0.0, 0.0, 0.0, 0.0, g02, g12, g22)
+
+
+def compose_invariant_transitions(tau, dt, dp, dv, dq, var_imu_f, var_imu_w):
+    """
+    Composed transition and accumulated process noise of K invariant_transition() steps,
+    from the preintegrated increments of the steps (see preintegration.ImuPreintegrator).
+
+    The product Phi_K ... Phi_1 is D U_K, with D = diag(R^T, R^T, R^T) for the rotation R of
+    dq and U_j = [[I, tau_j I, -[dp_j]x], [0, I, -[dv_j]x], [0, 0, I]]. The noise of step j,
+    diag(0, var_imu_f dt_j^2 I, var_imu_w dt_j^2 I), is isotropic per block and so unchanged
+    by the rotations, and the accumulated noise is D U_K (sum_j U_j^-1 Q_j U_j^-T) U_K^T D^T,
+    with U_j^-1 = [[I, -tau_j I, [dp_j]x - tau_j [dv_j]x], [0, I, [dv_j]x], [0, 0, I]].
+
+    :param tau: Time since the start after each step [K,].
+    :param dt: Time steps [K,].
+    :param dp: K x 3 position increments after each step, in the start frame.
+    :param dv: K x 3 velocity increments after each step, in the start frame.
+    :param dq: Orientation increment after the last step, wxyz.
+    :param var_imu_f: IMU specific force variance.
+    :param var_imu_w: IMU angular rate variance.
+    :return: (Phi, Q) such that the propagated invariant covariance is Phi P Phi^T + Q.
+    """
+    P = so3_hat(dp)
+    V = so3_hat(dv)
+
+    # Attitude noise: sum_j w_j W_j W_j^T over the theta columns W_j of U_j^-1.
+    W = np.empty((len(tau), 9, 3))
+    W[:, 0:3] = P - tau[:, None, None] * V
+    W[:, 3:6] = V
+    W[:, 6:9] = np.eye(3)
+    W *= (np.sqrt(var_imu_w) * dt)[:, None, None]
+    Ws = W.transpose(1, 0, 2).reshape(9, -1)
+    S = Ws @ Ws.T
+
+    # Velocity noise: sum_j a_j [-tau_j I; I] [-tau_j I; I]^T, on the diagonals of the
+    # position and velocity blocks.
+    a = var_imu_f * dt * dt
+    i = np.arange(3)
+    S[i, i] += a @ (tau * tau)
+    S[i + 3, i + 3] += a.sum()
+    S[i, i + 3] -= a @ tau
+    S[i + 3, i] -= a @ tau
+
+    U = np.eye(9)
+    U[0:3, 3:6] += tau[-1] * np.eye(3)
+    U[0:3, 6:9] = -P[-1]
+    U[3:6, 6:9] = -V[-1]
+    Rt = np.array(quat_rotation(*dq)).reshape(3, 3).T
+    Phi = (Rt @ U.reshape(3, 3, 9)).reshape(9, 9)
+    return Phi, Phi @ S @ Phi.T
+
+
+def _frame_map(C):
+    """T = diag(C, C, I), mapping invariant errors to ESEKF errors (to first order)."""
+    T = np.zeros(C.shape[:-2] + (9, 9))
+    T[..., 0:3, 0:3] = T[..., 3:6, 3:6] = C
+    T[..., 6:9, 6:9] = np.eye(3)
+    return T
+
+
+class InvariantESEKF(ESEKF):
+    def __init__(self, p, v, q, p_cov=None, var_imu_f=0.10, var_imu_w=0.25, precision='float64'):
+        """
+        Left-invariant EKF with the ESEKF interface.
+
+        The filter keeps the covariance of the invariant error xi; p_cov maps it to the
+        [dp, dv, dtheta] error of ESEKF (world-frame position and velocity errors) when
+        read, and the initial p_cov is given in those terms as well. Writes to p_cov do not
+        change the filter, and state_arrays() returns the invariant covariance. Deferred
+        propagation is not available. See ESEKF for the parameters.
+        """
+        super().__init__(p, v, q, p_cov, var_imu_f, var_imu_w, precision=precision)
+        if p_cov is not None:
+            Ti = _frame_map(np.array(quat_rotation(*self.q.tolist())).reshape(3, 3).T)
+            self._p_cov[...] = Ti @ self._p_cov @ Ti.T
+        self._F_flat = self._F.reshape(-1)  # view, Phi is rewritten on every step
+        self._T = np.eye(9)
+
+    @property
+    def p_cov(self):
+        """9x9 covariance of the ESEKF error [dp, dv, dtheta] (a new array)."""
+        T = self._T
+        T[0:3, 0:3] = T[3:6, 3:6] = np.array(quat_rotation(*self.q.tolist())).reshape(3, 3)
+        return T @ self._p_cov @ T.T
+
+    def predict(self, imu_f, imu_w, dt):
+        """
+        Propagate the nominal state as ESEKF does, and the invariant covariance with
+        P = Phi P Phi^T + Q for the invariant transition of the IMU sample (see ESEKF.predict
+        for the parameters). The ESEKF jacobian is not formed.
+        """
+        self._predict_state(imu_f, imu_w, dt)
+        self._F_flat[:] = _transition_entries(imu_f, imu_w, dt)
+        F = self._F
+        if dt != self._dt:
+            self._dt = dt
+            self._q_diag[3:6] = self.var_imu_f * dt ** 2
+            self._q_diag[6:9] = self.var_imu_w * dt ** 2
+
+        np.matmul(F, self._p_cov, out=self._tmp)
+        np.matmul(self._tmp, F.T, out=self._p_cov)
+        self._p_cov_diag += self._q_diag
+
+    def correct(self, y, var, joseph=None):
+        """
+        Fuse a position measurement (see ESEKF.correct). The innovation is C^T (y - p);
+        per-axis or full measurement covariances are rotated into the body frame.
+        """
+        if joseph is None:
+            joseph = self.joseph
+        px, py, pz = self.p.tolist()
+        c00, c01, c02, c10, c11, c12, c20, c21, c22 = quat_rotation(*self.q.tolist())
+        e0, e1, e2 = y[0] - px, y[1] - py, y[2] - pz
+        r = [c00 * e0 + c10 * e1 + c20 * e2, c01 * e0 + c11 * e1 + c21 * e2, c02 * e0 + c12 * e1 + c22 * e2]
+        if not isinstance(var, (int, float)):
+            C = np.array((c00, c01, c02, c10, c11, c12, c20, c21, c22)).reshape(3, 3)
+            R = np.asarray(var, dtype=np.float64)
+            R = np.diag(np.broadcast_to(R, (3,))) if R.ndim < 2 else R
+            var = C.T @ R @ C
+        self._inject(selection_update(self._p_cov, POSITION, r, var, joseph).tolist())
+
+    def _inject(self, dx):
+        """X = X exp(dx) on SE_2(3), for a correction dx = [xi_p, xi_v, xi_theta] (9 floats)."""
+        px, py, pz, vx, vy, vz, qw, qx, qy, qz = self.x.tolist()
+        a0, a1, a2 = dx[6:9]
+        t2 = a0 * a0 + a1 * a1 + a2 * a2
+        if t2 < SMALL:
+            a = 0.5 - t2 / 24.0
+        else:
+            a = 2 * math.sin(math.sqrt(t2) / 2) ** 2 / t2
+        if t2 < SERIES:
+            # (t - sin(t)) / t^3 cancels in closed form for small t (see lie.py).
+            b = 1 / 6.0 - t2 * (1 / 120.0 - t2 * (1 / 5040.0 - t2 * (1 / 362880.0 - t2 / 39916800.0)))
+        else:
+            t = math.sqrt(t2)
+            b = (t - math.sin(t)) / (t2 * t)
+
+        def jac(u0, u1, u2):
+            # J(phi) u = u + a phi x u + b phi x (phi x u)
+            k0, k1, k2 = a1 * u2 - a2 * u1, a2 * u0 - a0 * u2, a0 * u1 - a1 * u0
+            l0, l1, l2 = a1 * k2 - a2 * k1, a2 * k0 - a0 * k2, a0 * k1 - a1 * k0
+            return u0 + a * k0 + b * l0, u1 + a * k1 + b * l1, u2 + a * k2 + b * l2
+
+        c00, c01, c02, c10, c11, c12, c20, c21, c22 = quat_rotation(qw, qx, qy, qz)
+        j0, j1, j2 = jac(*dx[0:3])
+        k0, k1, k2 = jac(*dx[3:6])
+        self.x[:] = (px + c00 * j0 + c01 * j1 + c02 * j2,
+                     py + c10 * j0 + c11 * j1 + c12 * j2,
+                     pz + c20 * j0 + c21 * j1 + c22 * j2,
+                     vx + c00 * k0 + c01 * k1 + c02 * k2,
+                     vy + c10 * k0 + c11 * k1 + c12 * k2,
+                     vz + c20 * k0 + c21 * k1 + c22 * k2) + quat_mult((qw, qx, qy, qz), rotvec_quat(a0, a1, a2))
+
+    def propagate(self, preint):
+        """
+        Propagate through a preintegrated interval (see ESEKF.propagate), with the composed
+        invariant transition, which only depends on the IMU samples.
+        """
+        if not len(preint):
+            return
+        x = preint.predict(self.p, self.v, self.q)
+        Phi, Q = preint.invariant_transition()
+        self._p_cov[...] = Phi @ self._p_cov @ Phi.T + Q
+        self.x[:] = x
+
+
+class BatchInvariantESEKF(BatchESEKF):
+    def __init__(self, *args, **kwargs):
+        """
+        Left-invariant form of BatchESEKF (see InvariantESEKF). p_cov holds the covariances
+        of the invariant errors; world_cov() maps them to the ESEKF error. The initial
+        p_cov is given in ESEKF terms. See BatchESEKF for the parameters.
+        """
+        super().__init__(*args, **kwargs)
+        Ti = _frame_map(QuaternionArray(self.q).to_mat().transpose(0, 2, 1))
+        self.p_cov[...] = Ti @ self.p_cov @ Ti.transpose(0, 2, 1)
+        self._Phi = np.zeros((9, 9), dtype=self.p_cov.dtype)  # shared by all members
+
+    def world_cov(self):
+        """M x 9 x 9 covariances of the ESEKF error [dp, dv, dtheta]."""
+        T = _frame_map(QuaternionArray(self.q).to_mat())
+        return T @ self.p_cov @ T.transpose(0, 2, 1)
+
+    def predict(self, imu_f, imu_w, dt):
+        """
+        Propagate all members through one IMU sample. With a shared IMU input, all members
+        share one transition matrix.
+
+        :param imu_f: Specific force in the vehicle frame, [3,] shared or M x 3.
+        :param imu_w: Angular rate in the vehicle frame, [3,] shared or M x 3.
+        :param dt: Time step [s].
+        """
+        imu_f = np.asarray(imu_f, dtype=np.float64)
+        imu_w = np.asarray(imu_w, dtype=np.float64)
+        self._predict_state(imu_f, imu_w, dt)
+        if dt != self._dt:
+            self._dt = dt
+            self._q_diag[:, 3:6] = (self.var_imu_f * dt ** 2)[:, None]
+            self._q_diag[:, 6:9] = (self.var_imu_w * dt ** 2)[:, None]
+        if imu_f.ndim == 1 and imu_w.ndim == 1:
+            Phi = self._Phi
+            Phi.reshape(-1)[:] = _transition_entries(imu_f.tolist(), imu_w.tolist(), dt)
+        else:
+            Phi = invariant_transition(imu_f, imu_w, dt).astype(self.p_cov.dtype, copy=False)
+        np.matmul(Phi, self.p_cov, out=self._tmp)
+        np.matmul(self._tmp, np.swapaxes(Phi, -1, -2), out=self.p_cov)
+        self._p_cov_diag += self._q_diag
+
+    def correct(self, y, var):
+        """
+        Fuse one position measurement into every member.
+
+        :param y: Measured position, [3,] shared or M x 3.
+        :param var: Measurement variance (isotropic), scalar or [M,].
+        """
+        C = QuaternionArray(self.q).to_mat()
+        r = np.einsum('mji,mj->mi', C, y - self.p)
+        dx = self._update(r, var)
+        phi = dx[:, 6:9]
+        J = so3_left_jacobian(phi)
+        self.p += np.einsum('mij,mj->mi', C @ J, dx[:, 0:3])
+        self.v += np.einsum('mij,mj->mi', C @ J, dx[:, 3:6])
+        self.q[:] = QuaternionArray(self.q).quat_mult_left(quat_exp(phi)).q
@@ -0,0 +1,201 @@
+# Exponential and logarithm maps of SO(3), SE(3) and the unit quaternions, with the SO(3)
+# jacobians.
+#
+# All functions are vectorized over any leading dimensions: a rotation vector phi [..., 3]
+# maps to a rotation matrix [..., 3, 3], a quaternion [..., 4] and so on. The closed forms
+# divide by powers of the angle t = |phi|, so each has a series branch near t = 0. Most
+# switch at t^2 < 1e-8, where the series is exact to double precision. In closed form,
+# (t - sin(t)) / t^3 and the inverse jacobian coefficient lose about eps / t^2 of relative
+# accuracy to cancellation, so they use a longer series up to t^2 < 1e-2 instead, which
+# keeps their relative error within about 2e-13.
+#
+# Conventions are those of the filters: quaternions are wxyz, exp(phi) is the rotation by
+# t about phi / t (the Quaternion(axis_angle=phi) of rotations.py), and SE(3) tangent
+# vectors are xi = [rho, phi], translation first.
+import math
+import numpy as np
+
+SMALL = 1e-8  # squared angle below which the series branches are used
+SERIES = 1e-2  # the same for the coefficients that cancel in closed form
+
+
+def _coefficients(t2):
+    """sin(t) / t, (1 - cos(t)) / t^2 and (t - sin(t)) / t^3 for squared angles t2."""
+    small = t2 < SMALL
+    t2s = np.where(small, 1.0, t2)
+    t = np.sqrt(t2s)
+    a = np.where(small, 1.0 - t2 / 6.0, np.sin(t) / t)
+    b = np.where(small, 0.5 - t2 / 24.0, 2 * np.sin(t / 2) ** 2 / t2s)  # 1 - cos(t) without cancellation
+    # sum_k (-t^2)^k / (2k + 3)!, to t^8.
+    series = 1 / 6.0 - t2 * (1 / 120.0 - t2 * (1 / 5040.0 - t2 * (1 / 362880.0 - t2 / 39916800.0)))
+    c = np.where(t2 < SERIES, series, (t - np.sin(t)) / (t2s * t))
+    return a, b, c
+
+
+def so3_hat(phi):
+    """Skew-symmetric matrices [phi]x [..., 3, 3] of vectors phi [..., 3]."""
+    phi = np.asarray(phi, dtype=np.float64)
+    K = np.zeros(phi.shape + (3,))
+    K[..., 0, 1], K[..., 0, 2] = -phi[..., 2], phi[..., 1]
+    K[..., 1, 0], K[..., 1, 2] = phi[..., 2], -phi[..., 0]
+    K[..., 2, 0], K[..., 2, 1] = -phi[..., 1], phi[..., 0]
+    return K
+
+
+def so3_vee(K):
+    """Vectors [..., 3] of the skew-symmetric parts of matrices K [..., 3, 3] (inverse of so3_hat)."""
+    K = np.asarray(K, dtype=np.float64)
+    return 0.5 * np.stack([K[..., 2, 1] - K[..., 1, 2],
+                           K[..., 0, 2] - K[..., 2, 0],
+                           K[..., 1, 0] - K[..., 0, 1]], axis=-1)
+
+
+def so3_exp(phi):
+    """Rotation matrices exp([phi]x) = I + sin(t)/t K + (1 - cos(t))/t^2 K^2 of rotation vectors [..., 3]."""
+    phi = np.asarray(phi, dtype=np.float64)
+    a, b, _ = _coefficients(np.einsum('...i,...i->...', phi, phi))
+    K = so3_hat(phi)
+    return np.eye(3) + a[..., None, None] * K + b[..., None, None] * (K @ K)
+
+
+def so3_log(C):
+    """
+    Rotation vectors [..., 3] of rotation matrices C [..., 3, 3], with angles in [0, pi].
+
+    The axis is taken from the skew-symmetric part of C, which vanishes at t = pi; from
+    cos(t) < -0.99 on it is taken from the symmetric part instead, C + C^T - 2 cos(t) I
+    = 2 (1 - cos(t)) u u^T, with the sign from the skew-symmetric part.
+    """
+    C = np.asarray(C, dtype=np.float64)
+    cos = np.clip((np.trace(C, axis1=-2, axis2=-1) - 1) / 2, -1.0, 1.0)
+    v = so3_vee(C)  # sin(t) u
+    sin = np.sqrt(np.einsum('...i,...i->...', v, v))
+    t = np.arctan2(sin, cos)  # unlike arccos(cos), accurate near 0 and pi
+
+    t2 = t * t
+    small = t2 < SMALL
+    scale = np.where(small, 1.0 + t2 / 6.0, t / np.where(small, 1.0, sin))
+    phi = v * scale[..., None]
+
+    near_pi = cos < -0.99
+    if np.any(near_pi):
+        Cp = C[near_pi]
+        cp = cos[near_pi]
+        S = (Cp + np.swapaxes(Cp, -1, -2) - 2 * cp[:, None, None] * np.eye(3)) / (2 * (1 - cp))[:, None, None]
+        k = np.argmax(np.diagonal(S, axis1=-2, axis2=-1), axis=-1)
+        rows = np.arange(len(k))
+        u = S[rows, k] / np.sqrt(S[rows, k, k])[:, None]
+        sign = np.where(np.einsum('ij,ij->i', u, v[near_pi]) < 0, -1.0, 1.0)
+        phi[near_pi] = u * (sign * t[near_pi])[:, None]
+    return phi
+
+
+def so3_left_jacobian(phi):
+    """Left jacobians J(phi) = I + (1 - cos(t))/t^2 K + (t - sin(t))/t^3 K^2 [..., 3, 3]."""
+    phi = np.asarray(phi, dtype=np.float64)
+    _, b, c = _coefficients(np.einsum('...i,...i->...', phi, phi))
+    K = so3_hat(phi)
+    return np.eye(3) + b[..., None, None] * K + c[..., None, None] * (K @ K)
+
+
+def so3_right_jacobian(phi):
+    """Right jacobians J_r(phi) = J(-phi) [..., 3, 3]."""
+    return so3_left_jacobian(-np.asarray(phi, dtype=np.float64))
+
+
+def _inverse_coefficient(t2):
+    """(1 - t sin(t) / (2 (1 - cos(t)))) / t^2, the K^2 coefficient of the inverse jacobians."""
+    small = t2 < SERIES
+    t2s = np.where(small, 1.0, t2)
+    t = np.sqrt(t2s)
+    # sum_n |B_2n| t^(2n - 2) / (2n)!, to t^8.
+    series = 1 / 12.0 + t2 * (1 / 720.0 + t2 * (1 / 30240.0 + t2 * (1 / 1209600.0 + t2 / 47900160.0)))
+    return np.where(small, series, (1 - t * np.sin(t) / (4 * np.sin(t / 2) ** 2)) / t2s)
+
+
+def so3_left_jacobian_inv(phi):
+    """Inverses of the left jacobians, I - K / 2 + e K^2 [..., 3, 3] (singular at t = 2 pi)."""
+    phi = np.asarray(phi, dtype=np.float64)
+    e = _inverse_coefficient(np.einsum('...i,...i->...', phi, phi))
+    K = so3_hat(phi)
+    return np.eye(3) - 0.5 * K + e[..., None, None] * (K @ K)
+
+
+def so3_right_jacobian_inv(phi):
+    """Inverses of the right jacobians, I + K / 2 + e K^2 [..., 3, 3]."""
+    return so3_left_jacobian_inv(-np.asarray(phi, dtype=np.float64))
+
+
+def se3_exp(xi):
+    """Homogeneous transforms [..., 4, 4] of twists xi = [rho, phi] [..., 6]: (exp(phi), J(phi) rho)."""
+    xi = np.asarray(xi, dtype=np.float64)
+    rho, phi = xi[..., 0:3], xi[..., 3:6]
+    a, b, c = _coefficients(np.einsum('...i,...i->...', phi, phi))
+    K = so3_hat(phi)
+    K2 = K @ K
+    T = np.zeros(xi.shape[:-1] + (4, 4))
+    T[..., 0:3, 0:3] = np.eye(3) + a[..., None, None] * K + b[..., None, None] * K2
+    J = np.eye(3) + b[..., None, None] * K + c[..., None, None] * K2
+    T[..., 0:3, 3] = np.einsum('...ij,...j->...i', J, rho)
+    T[..., 3, 3] = 1.0
+    return T
+
+
+def se3_log(T):
+    """Twists xi = [rho, phi] [..., 6] of homogeneous transforms T [..., 4, 4] (inverse of se3_exp)."""
+    T = np.asarray(T, dtype=np.float64)
+    phi = so3_log(T[..., 0:3, 0:3])
+    rho = np.einsum('...ij,...j->...i', so3_left_jacobian_inv(phi), T[..., 0:3, 3])
+    return np.concatenate([rho, phi], axis=-1)
+
+
+def quat_exp(phi):
+    """Unit quaternions [..., 4] (wxyz) of rotation vectors [..., 3]: (cos(t/2), sin(t/2) phi / t)."""
+    phi = np.asarray(phi, dtype=np.float64)
+    t2 = np.einsum('...i,...i->...', phi, phi)
+    small = t2 < SMALL
+    t = np.sqrt(np.where(small, 1.0, t2))
+    q = np.empty(phi.shape[:-1] + (4,))
+    q[..., 0] = np.where(small, 1.0 - t2 / 8.0, np.cos(t / 2))
+    q[..., 1:] = phi * np.where(small, 0.5 - t2 / 48.0, np.sin(t / 2) / t)[..., None]
+    return q
+
+
+def quat_log(q):
+    """
+    Rotation vectors [..., 3] of unit quaternions [..., 4] (inverse of quat_exp). Of q and -q,
+    which are the same rotation, the one with w >= 0 is used, so angles are in [0, pi].
+    """
+    q = np.asarray(q, dtype=np.float64)
+    w = np.abs(q[..., 0])
+    v = q[..., 1:] * np.where(q[..., 0] < 0, -1.0, 1.0)[..., None]
+    n2 = np.einsum('...i,...i->...', v, v)
+    small = n2 < SMALL * SMALL
+    n = np.sqrt(np.where(small, 1.0, n2))
+    # 2 atan2(n, w) / n -> 2 / w (1 - n^2 / (3 w^2)) for small n.
+    scale = np.where(small, 2 / np.where(small, w, 1.0), 2 * np.arctan2(n, w) / n)
+    return v * scale[..., None]
+
+
+def rotvec_quat(a0, a1, a2):
+    """wxyz components of quat_exp([a0, a1, a2]), as Python floats."""
+    t2 = a0 * a0 + a1 * a1 + a2 * a2
+    if t2 < SMALL:
+        s = 0.5 - t2 / 48.0
+        return 1.0 - t2 / 8.0, s * a0, s * a1, s * a2
+    t = math.sqrt(t2)
+    s = math.sin(t / 2) / t
+    return math.cos(t / 2), s * a0, s * a1, s * a2
+
+
+def quat_rotvec(qw, qx, qy, qz):
+    """quat_log() of one quaternion, as 3 Python floats."""
+    if qw < 0:
+        qw, qx, qy, qz = -qw, -qx, -qy, -qz
+    n2 = qx * qx + qy * qy + qz * qz
+    if n2 < SMALL * SMALL:
+        s = 2 / qw
+    else:
+        n = math.sqrt(n2)
+        s = 2 * math.atan2(n, qw) / n
+    return s * qx, s * qy, s * qz
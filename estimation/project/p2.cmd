@@ -1,15 +1 @@
-python es-ekr-part-2.py 40.0 >x.txt
-python es-ekr-part-2.py 45.0 >>x.txt
-python es-ekr-part-2.py 50.0 >>x.txt
-python es-ekr-part-2.py 55.0 >>x.txt
-python es-ekr-part-2.py 60.0 >>x.txt
-python es-ekr-part-2.py 65.0 >>x.txt
-python es-ekr-part-2.py 70.0 >>x.txt
-python es-ekr-part-2.py 75.0 >>x.txt
-python es-ekr-part-2.py 80.0 >>x.txt
-python es-ekr-part-2.py 85.0 >>x.txt
-python es-ekr-part-2.py 90.0 >>x.txt
-python es-ekr-part-2.py 95.0 >>x.txt
-python es-ekr-part-2.py 100.0 >>x.txt
-python es-ekr-part-2.py 105.0 >>x.txt
-
+python sweep.py --c-li incorrect --var-lidar 40 45 50 55 60 65 70 75 80 85 90 95 100 105 --out x.txt
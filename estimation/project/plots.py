@@ -0,0 +1,70 @@
+# Figures for the ES-EKF results (ground truth, estimated trajectory and error plots).
+#
+# Kept separate from the filter so that matplotlib is only imported when figures are
+# actually requested.
+import matplotlib.pyplot as plt
+from mpl_toolkits.mplot3d import Axes3D  # noqa: F401 (registers the 3d projection)
+
+
+def ground_truth(gt):
+    """Ground truth trajectory."""
+    gt_fig = plt.figure()
+    ax = gt_fig.add_subplot(111, projection='3d')
+    ax.plot(gt.p[:, 0], gt.p[:, 1], gt.p[:, 2])
+    ax.set_xlabel('x [m]')
+    ax.set_ylabel('y [m]')
+    ax.set_zlabel('z [m]')
+    ax.set_title('Ground Truth trajectory')
+    ax.set_zlim(-1, 5)
+    return gt_fig
+
+
+def trajectory(gt, p_est, zlim=(-20, 20)):
+    """Ground truth and estimated trajectories on the same plot."""
+    est_traj_fig = plt.figure()
+    ax = est_traj_fig.add_subplot(111, projection='3d')
+    ax.plot(p_est[:, 0], p_est[:, 1], p_est[:, 2], label='Estimated')
+    ax.plot(gt.p[:, 0], gt.p[:, 1], gt.p[:, 2], label='Ground Truth')
+    ax.set_xlabel('Easting [m]')
+    ax.set_ylabel('Northing [m]')
+    ax.set_zlabel('Up [m]')
+    ax.set_title('Ground Truth and Estimated Trajectory')
+    ax.set_xlim(0, 200)
+    ax.set_ylim(0, 200)
+    ax.set_zlim(*zlim)
+    ax.set_xticks([0, 50, 100, 150, 200])
+    ax.set_yticks([0, 50, 100, 150, 200])
+    ax.set_zticks([-2, -1, 0, 1, 2])
+    ax.legend(loc=(0.62, 0.77))
+    ax.view_init(elev=45, azim=-50)
+    return est_traj_fig
+
+
+def errors(gt, results):
+    """
+    Error for each of the 6 DOF (blue), with +/- 3 standard deviation bounds (red, dashed).
+
+    :param gt: Ground truth Data object.
+    :param results: analysis.Results of the run.
+    """
+    error_fig, ax = plt.subplots(2, 3)
+    error_fig.suptitle('Error Plots')
+    p_err, s, euler_err = results.errors(gt)
+    p_bound, euler_bound = results.bounds(3)
+    m = len(s)
+
+    titles = ['Easting', 'Northing', 'Up', 'Roll', 'Pitch', 'Yaw']
+    for i in range(3):
+        ax[0, i].plot(range(p_err.shape[0]), p_err[:, i])
+        ax[0, i].plot(s, p_bound[:m, i], 'r--')
+        ax[0, i].plot(s, -p_bound[:m, i], 'r--')
+        ax[0, i].set_title(titles[i])
+    ax[0, 0].set_ylabel('Meters')
+
+    for i in range(3):
+        ax[1, i].plot(s, euler_err[:, i])
+        ax[1, i].plot(s, euler_bound[:m, i], 'r--')
+        ax[1, i].plot(s, -euler_bound[:m, i], 'r--')
+        ax[1, i].set_title(titles[i + 3])
+    ax[1, 0].set_ylabel('Radians')
+    return error_fig
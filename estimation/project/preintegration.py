@@ -0,0 +1,240 @@
+# IMU preintegration between aiding epochs.
+#
+# Between two GNSS/LIDAR corrections the ES-EKF only integrates IMU samples, and all of its
+# nominal-state increments and motion-model jacobians can be expressed in the body frame
+# at the start of the interval, independently of the state the interval starts from:
+#
+#   p_k = p_0 + v_0 T + g T^2 / 2 + C_0 dp_k,   v_k = v_0 + g T + C_0 dv_k,   q_k = q_0 * dq_k
+#
+# The preintegrator accumulates dp, dv and dq sample by sample on Python floats, and forms
+# the composed jacobian F_k ... F_1 and the accumulated process noise of the whole interval
+# (esekf.compose_transitions) only when asked, so the filter covariance is propagated once
+# per epoch instead of once per IMU sample. The result equals the per-sample propagation of
+# esekf.ESEKF up to rounding, and the per-sample poses of the interval are available on
+# demand.
+import numpy as np
+from esekf import compose_transitions, g, quat_mult, quat_rotation
+from events import iter_events
+from iekf import compose_invariant_transitions
+from lie import rotvec_quat
+
+ROW = 22  # values stored per sample
+
+
+class ImuPreintegrator():
+    def __init__(self, var_imu_f=0.10, var_imu_w=0.25):
+        """
+        :param var_imu_f: IMU specific force variance.
+        :param var_imu_w: IMU angular rate variance.
+        """
+        self.var_imu_f = var_imu_f
+        self.var_imu_w = var_imu_w
+        # poses() computes x_j = x_0 + row_j M, see there; the gravity terms are constant.
+        self._M = np.zeros((ROW, 10))
+        self._M[0, 3:6] = g
+        self._M[1, 0:3] = g
+        self.reset()
+
+    def reset(self):
+        """Start a new interval."""
+        self.dt = 0.0  # length of the interval
+        self.dp = (0.0, 0.0, 0.0)
+        self.dv = (0.0, 0.0, 0.0)
+        self.dq = (1.0, 0.0, 0.0, 0.0)
+        # Per sample, flattened: tau (time since the start after the sample), tau^2 / 2, dt,
+        # the jacobian block B (row-major) and dp, dv, dq after the sample.
+        self._rows = []
+        self._array = None
+
+    def __len__(self):
+        return len(self._rows) // ROW
+
+    def integrate(self, imu_f, imu_w, dt):
+        """
+        Add one IMU sample, with the model of ESEKF.predict().
+
+        :param imu_f: Specific force in the vehicle frame, length 3.
+        :param imu_w: Angular rate in the vehicle frame, length 3.
+        :param dt: Time step [s].
+        """
+        fx, fy, fz = imu_f
+        wx, wy, wz = imu_w
+        qw, qx, qy, qz = self.dq
+        dpx, dpy, dpz = self.dp
+        dvx, dvy, dvz = self.dv
+        r00, r01, r02, r10, r11, r12, r20, r21, r22 = quat_rotation(qw, qx, qy, qz)
+
+        # u = C(dq) f dt, the velocity increment in the start frame, and the jacobian block
+        # B = -C(dq) [f]x dt of F[3:6, 6:9].
+        ux = (r00 * fx + r01 * fy + r02 * fz) * dt
+        uy = (r10 * fx + r11 * fy + r12 * fz) * dt
+        uz = (r20 * fx + r21 * fy + r22 * fz) * dt
+        B = ((r02 * fy - r01 * fz) * dt, (r00 * fz - r02 * fx) * dt, (r01 * fx - r00 * fy) * dt,
+             (r12 * fy - r11 * fz) * dt, (r10 * fz - r12 * fx) * dt, (r11 * fx - r10 * fy) * dt,
+             (r22 * fy - r21 * fz) * dt, (r20 * fz - r22 * fx) * dt, (r21 * fx - r20 * fy) * dt)
+
+        h = dt / 2.0
+        self.dp = dp = (dpx + dt * dvx + h * ux, dpy + dt * dvy + h * uy, dpz + dt * dvz + h * uz)
+        self.dv = dv = (dvx + ux, dvy + uy, dvz + uz)
+        self.dq = dq = quat_mult((qw, qx, qy, qz), rotvec_quat(wx * dt, wy * dt, wz * dt))
+        self.dt = tau = self.dt + dt
+        self._rows.extend((tau, tau * tau / 2.0, dt) + B + dp + dv + dq)
+        self._array = None
+
+    def _samples(self):
+        """The per-sample rows as a len(self) x ROW array."""
+        if self._array is None:
+            self._array = np.array(self._rows).reshape(-1, ROW)
+        return self._array
+
+    def _compose(self, C=None):
+        """Composed jacobian and noise of the interval, rotated by C (see compose_transitions)."""
+        rows = self._samples()
+        return compose_transitions(rows[:, 0], rows[:, 2], rows[:, 3:12],
+                                   self.var_imu_f, self.var_imu_w, C)
+
+    def jacobian(self):
+        """Composed motion-model jacobian F_k ... F_1 of the interval, in the start frame."""
+        return self._compose()[0]
+
+    def covariance(self):
+        """
+        Process noise accumulated over the interval, sum_j Phi_(k<-j) Q_j Phi_(k<-j)^T, in
+        the start frame.
+        """
+        return self._compose()[1]
+
+    def transition(self, q):
+        """
+        Composed jacobian and process noise of the interval in the world frame.
+
+        :param q: Orientation at the start of the interval, wxyz.
+        :return: (Phi, Q) such that the propagated covariance is Phi P Phi^T + Q.
+        """
+        return self._compose(np.array(quat_rotation(*q)).reshape(3, 3))
+
+    def invariant_transition(self):
+        """
+        Composed transition and process noise of the interval for the invariant error of
+        iekf.InvariantESEKF; unlike those of transition(), they do not depend on the state.
+        """
+        rows = self._samples()
+        return compose_invariant_transitions(rows[:, 0], rows[:, 2], rows[:, 12:15], rows[:, 15:18],
+                                             self.dq, self.var_imu_f, self.var_imu_w)
+
+    def propagate_covariance(self, p_cov, q):
+        """
+        Propagate an error-state covariance through the interval in place,
+        P = Phi P Phi^T + Q, with Phi and Q in the world frame.
+
+        :param p_cov: 9x9 covariance at the start of the interval.
+        :param q: Orientation at the start of the interval, wxyz.
+        """
+        if not len(self):
+            return
+        Phi, Q = self.transition(q)
+        p_cov[...] = Phi @ p_cov @ Phi.T + Q
+
+    def predict(self, p, v, q):
+        """
+        State at the end of the interval from the state at its start.
+
+        :return: x = [p, v, q] as a tuple of 10 floats.
+        """
+        px, py, pz = p
+        vx, vy, vz = v
+        qw, qx, qy, qz = q
+        dpx, dpy, dpz = self.dp
+        dvx, dvy, dvz = self.dv
+        gx, gy, gz = g.tolist()
+        T = self.dt
+        h = T * T / 2.0
+        c00, c01, c02, c10, c11, c12, c20, c21, c22 = quat_rotation(qw, qx, qy, qz)
+        return (px + vx * T + gx * h + c00 * dpx + c01 * dpy + c02 * dpz,
+                py + vy * T + gy * h + c10 * dpx + c11 * dpy + c12 * dpz,
+                pz + vz * T + gz * h + c20 * dpx + c21 * dpy + c22 * dpz,
+                vx + gx * T + c00 * dvx + c01 * dvy + c02 * dvz,
+                vy + gy * T + c10 * dvx + c11 * dvy + c12 * dvz,
+                vz + gz * T + c20 * dvx + c21 * dvy + c22 * dvz) + quat_mult((qw, qx, qy, qz), self.dq)
+
+    def poses(self, p, v, q):
+        """
+        States after each sample of the interval, from the state at its start.
+
+        :return: len(self) x 10 array of [p, v, q].
+        """
+        # x_j = x_0 + row_j M: tau -> v_0 tau and g tau, tau^2 / 2 -> g tau^2 / 2, dp and dv ->
+        # C_0 dp and C_0 dv, and dq -> q_0 * dq, as the left-multiplication matrix of q_0.
+        qw, qx, qy, qz = q
+        M = self._M
+        M[0, 0:3] = v
+        Ct = np.array(quat_rotation(qw, qx, qy, qz)).reshape(3, 3).T
+        M[12:15, 0:3] = Ct
+        M[15:18, 3:6] = Ct
+        M[18:22, 6:10] = ((qw, qx, qy, qz),
+                          (-qx, qw, qz, -qy),
+                          (-qy, -qz, qw, qx),
+                          (-qz, qy, -qx, qw))
+        x = self._samples() @ M
+        x[:, 0:3] += p
+        x[:, 3:6] += v
+        return x
+
+
+def run_preintegrated(ekf, imu_f, imu_w, sensors, n=None):
+    """
+    Run the filter over a recorded log like esekf.run(), but propagate the covariance once
+    per aiding epoch with an ImuPreintegrator.
+
+    :param ekf: ESEKF, already initialised at imu_f.t[0]; any engine with a propagate()
+                method that takes an ImuPreintegrator.
+    :param imu_f: StampedData of specific forces.
+    :param imu_w: StampedData of angular rates.
+    :param sensors: List of (StampedData, variance) position sensors.
+    :param n: Number of ticks to run. Defaults to imu_f.data.shape[0].
+    :return: p_est, v_est, q_est arrays of length n as from esekf.run(), the ticks at which
+             the covariance was propagated (the measurement ticks, then the last one) and
+             the covariances at those ticks, after their corrections.
+    """
+    if not hasattr(ekf, 'propagate'):
+        raise TypeError("%s does not support preintegrated propagation." % type(ekf).__name__)
+    if n is None:
+        n = imu_f.data.shape[0]
+    x_est = np.zeros([n, 10])
+    steps = []
+    p_cov = []
+    preint = ImuPreintegrator(ekf.var_imu_f, ekf.var_imu_w)
+
+    def flush(k):
+        if len(preint):
+            x_est[k - len(preint) + 1:k + 1] = preint.poses(ekf.p, ekf.v, ekf.q)
+            ekf.propagate(preint)
+            preint.reset()
+
+    f = imu_f.data.tolist()
+    w = imu_w.data.tolist()
+    t = imu_f.t[:n].tolist()
+    k = 0
+    x_est[0] = ekf.x
+    for t_e, j, i in iter_events([imu_f.t[1:n]] + [s for s, _ in sensors]):
+        if t_e > t[-1]:
+            break
+        if j == 0:
+            k = i + 1
+            preint.integrate(f[k - 1], w[k - 1], t[k] - t[k - 1])
+        else:
+            flush(k)
+            y, var = sensors[j - 1]
+            ekf.correct(y.data[i], var)
+            x_est[k] = ekf.x
+            if steps and steps[-1] == k:
+                p_cov[-1] = ekf.p_cov.copy()
+            else:
+                steps.append(k)
+                p_cov.append(ekf.p_cov.copy())
+    flush(k)
+    if not steps or steps[-1] != k:
+        steps.append(k)
+        p_cov.append(ekf.p_cov.copy())
+
+    return x_est[:, 0:3], x_est[:, 3:6], x_est[:, 6:10], np.array(steps), np.array(p_cov)
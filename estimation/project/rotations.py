@@ -2,6 +2,7 @@
 #
 # Authors: Trevor Ablett and Jonathan Kelly
 # University of Toronto Institute for Aerospace Studies
+import math
 import numpy as np
 
 def angle_normalize(a):
@@ -13,6 +14,7 @@ def angle_normalize(a):
 
 def skew_symmetric(v):
     """Skew symmetric form of a 3x1 vector."""
+    v = np.ravel(v)
     return np.array(
         [[0, -v[2], v[1]],
          [v[2], 0, -v[0]],
@@ -42,6 +44,11 @@ def rpy_jacobian_axis_angle(a):
     return Jr @ Ja
 
 class Quaternion():
+    # Components are plain attributes on a slotted object, and all arithmetic below is done
+    # in closed form on Python floats: a NumPy call costs microseconds, more than the whole
+    # product or conversion, so arrays are only created for the np outputs.
+    __slots__ = ('w', 'x', 'y', 'z')
+
     def __init__(self, w=1., x=0., y=0., z=0., axis_angle=None, euler=None):
         """
         Allow initialization with explicit quaterion wxyz, axis-angle, or Euler XYZ (RPY) angles.
@@ -62,31 +69,46 @@ class Quaternion():
         elif euler is not None and axis_angle is not None:
             raise AttributeError("Only one of axis_angle or euler can be specified.")
         elif axis_angle is not None:
-            if not (type(axis_angle) == list or type(axis_angle) == np.ndarray) or len(axis_angle) != 3:
+            if not isinstance(axis_angle, (list, np.ndarray)) or len(axis_angle) != 3:
                 raise ValueError("axis_angle must be list or np.ndarray with length 3.")
-            axis_angle = np.array(axis_angle)
-            norm = np.linalg.norm(axis_angle)
-            self.w = np.cos(norm / 2)
-            if norm < 1e-50:  # to avoid instabilities and nans
-                self.x = 0
-                self.y = 0
-                self.z = 0
+            if isinstance(axis_angle, np.ndarray):
+                axis_angle = axis_angle.ravel().tolist()
+            ax, ay, az = axis_angle
+            t2 = ax * ax + ay * ay + az * az
+            if t2 < 1e-8:
+                # Series of cos(t/2) and sin(t/2)/t, exact to double precision for t < 1e-4
+                # and well defined at t = 0.
+                self.w = 1 - t2 / 8
+                s = 0.5 - t2 / 48
             else:
-                imag = axis_angle / norm * np.sin(norm / 2)
-                self.x = imag[0].item()
-                self.y = imag[1].item()
-                self.z = imag[2].item()
+                t = math.sqrt(t2)
+                self.w = math.cos(t / 2)
+                s = math.sin(t / 2) / t
+            self.x = ax * s
+            self.y = ay * s
+            self.z = az * s
         else:
-            roll = euler[0]
-            pitch = euler[1]
-            yaw = euler[2]
+            if isinstance(euler, np.ndarray):
+                euler = euler.ravel().tolist()
+            roll = euler[0] * 0.5
+            pitch = euler[1] * 0.5
+            yaw = euler[2] * 0.5
 
-            cy = np.cos(yaw * 0.5)
-            sy = np.sin(yaw * 0.5)
-            cr = np.cos(roll * 0.5)
-            sr = np.sin(roll * 0.5)
-            cp = np.cos(pitch * 0.5)
-            sp = np.sin(pitch * 0.5)
+            if roll * roll + pitch * pitch + yaw * yaw < 1e-8:
+                # Series of the half-angle cosines and sines, exact to double precision here.
+                cy = 1 - yaw * yaw / 2
+                sy = yaw * (1 - yaw * yaw / 6)
+                cr = 1 - roll * roll / 2
+                sr = roll * (1 - roll * roll / 6)
+                cp = 1 - pitch * pitch / 2
+                sp = pitch * (1 - pitch * pitch / 6)
+            else:
+                cy = math.cos(yaw)
+                sy = math.sin(yaw)
+                cr = math.cos(roll)
+                sr = math.sin(roll)
+                cp = math.cos(pitch)
+                sp = math.sin(pitch)
 
             # Fixed frame
             self.w = cr * cp * cy + sr * sp * sy
@@ -104,19 +126,32 @@ class Quaternion():
         return "Quaternion (wxyz): [%2.5f, %2.5f, %2.5f, %2.5f]" % (self.w, self.x, self.y, self.z)
 
     def to_axis_angle(self):
-        t = 2*np.arccos(self.w)
-        return np.array(t*np.array([self.x, self.y, self.z])/np.sin(t/2))
+        w = self.w
+        x, y, z = self.x, self.y, self.z
+        n2 = x * x + y * y + z * z
+        if n2 < 1e-16 and w > 0:
+            # t / sin(t/2) -> 2 / w for small rotations, where arccos loses precision.
+            s = 2 / w
+        elif n2 == 0:
+            s = 0.
+        else:
+            n = math.sqrt(n2)
+            s = 2 * math.atan2(n, w) / n
+        return np.array([s * x, s * y, s * z])
 
     def to_mat(self):
-        v = np.array([self.x, self.y, self.z]).reshape(3,1)
-        return (self.w ** 2 - np.dot(v.T, v)) * np.eye(3) + \
-               2 * np.dot(v, v.T) + 2 * self.w * skew_symmetric(v)
+        w, x, y, z = self.w, self.x, self.y, self.z
+        d = w * w - (x * x + y * y + z * z)
+        return np.array([[d + 2 * x * x, 2 * (x * y - w * z), 2 * (x * z + w * y)],
+                         [2 * (y * x + w * z), d + 2 * y * y, 2 * (y * z - w * x)],
+                         [2 * (z * x - w * y), 2 * (z * y + w * x), d + 2 * z * z]])
 
     def to_euler(self):
         """Return as xyz (roll pitch yaw) Euler angles."""
-        roll = np.arctan2(2 * (self.w * self.x + self.y * self.z), 1 - 2 * (self.x**2 + self.y**2))
-        pitch = np.arcsin(2 * (self.w * self.y - self.z * self.x))
-        yaw = np.arctan2(2 * (self.w * self.z + self.x * self.y), 1 - 2 * (self.y**2 + self.z**2))
+        w, x, y, z = self.w, self.x, self.y, self.z
+        roll = math.atan2(2 * (w * x + y * z), 1 - 2 * (x * x + y * y))
+        pitch = math.asin(max(-1., min(1., 2 * (w * y - z * x))))
+        yaw = math.atan2(2 * (w * z + x * y), 1 - 2 * (y * y + z * z))
         return np.array([roll, pitch, yaw])
 
     def to_numpy(self):
@@ -125,7 +160,7 @@ class Quaternion():
 
     def normalize(self):
         """Return a (unit) normalized version of this quaternion."""
-        norm = np.linalg.norm([self.w, self.x, self.y, self.z])
+        norm = math.sqrt(self.w * self.w + self.x * self.x + self.y * self.y + self.z * self.z)
         return Quaternion(self.w / norm, self.x / norm, self.y / norm, self.z / norm)
 
     def quat_mult_right(self, q, out='np'):
@@ -137,23 +172,14 @@ class Quaternion():
         :param out: Output type, either np or Quaternion.
         :return: Returns quaternion of desired type.
         """
-        v = np.array([self.x, self.y, self.z]).reshape(3, 1)
-        sum_term = np.zeros([4,4])
-        sum_term[0,1:] = -v[:,0]
-        sum_term[1:, 0] = v[:,0]
-        sum_term[1:, 1:] = -skew_symmetric(v)
-        sigma = self.w * np.eye(4) + sum_term
-
-        if type(q).__name__ == "Quaternion":
-            quat_np = np.dot(sigma, q.to_numpy())
-        else:
-            quat_np = np.dot(sigma, q)
-
-        if out == 'np':
-            return quat_np
-        elif out == 'Quaternion':
-            quat_obj = Quaternion(quat_np[0], quat_np[1], quat_np[2], quat_np[3])
-            return quat_obj
+        if isinstance(q, Quaternion):
+            return _hamilton(q.w, q.x, q.y, q.z, self.w, self.x, self.y, self.z, out)
+        shape = (4,)
+        if isinstance(q, np.ndarray):
+            shape = q.shape
+            q = q.ravel().tolist()
+        qw, qx, qy, qz = q
+        return _hamilton(qw, qx, qy, qz, self.w, self.x, self.y, self.z, out, shape)
 
     def quat_mult_left(self, q, out='np'):
         """
@@ -164,20 +190,238 @@ class Quaternion():
         :param out: Output type, either np or Quaternion.
         :return: Returns quaternion of desired type.
         """
-        v = np.array([self.x, self.y, self.z]).reshape(3, 1)
-        sum_term = np.zeros([4,4])
-        sum_term[0,1:] = -v[:,0]
-        sum_term[1:, 0] = v[:,0]
-        sum_term[1:, 1:] = skew_symmetric(v)
-        sigma = self.w * np.eye(4) + sum_term
-
-        if type(q).__name__ == "Quaternion":
-            quat_np = np.dot(sigma, q.to_numpy())
-        else:
-            quat_np = np.dot(sigma, q)
+        if isinstance(q, Quaternion):
+            return _hamilton(self.w, self.x, self.y, self.z, q.w, q.x, q.y, q.z, out)
+        shape = (4,)
+        if isinstance(q, np.ndarray):
+            shape = q.shape
+            q = q.ravel().tolist()
+        qw, qx, qy, qz = q
+        return _hamilton(self.w, self.x, self.y, self.z, qw, qx, qy, qz, out, shape)
+
+
+def _hamilton(aw, ax, ay, az, bw, bx, by, bz, out, shape=(4,)):
+    """Hamilton product a*b, as a Quaternion or an np.ndarray of the given shape."""
+    w = aw * bw - ax * bx - ay * by - az * bz
+    x = ax * bw + aw * bx - az * by + ay * bz
+    y = ay * bw + az * bx + aw * by - ax * bz
+    z = az * bw - ay * bx + ax * by + aw * bz
+    if out == 'np':
+        quat_np = np.array([w, x, y, z])
+        return quat_np if shape == (4,) else quat_np.reshape(shape)
+    elif out == 'Quaternion':
+        return Quaternion(w, x, y, z)
+
+class QuaternionArray():
+    def __init__(self, q=None):
+        """
+        Array-backed batch of quaternions, stored as an N x 4 (wxyz) np.ndarray.
+
+        Every operation acts on the whole batch with a handful of NumPy calls, so converting
+        a full run of estimates does not create one Quaternion object per sample.
+
+        :param q: N x 4 (or 4,) array-like of wxyz quaternions. Defaults to a single identity.
+        """
+        if q is None:
+            q = [1., 0., 0., 0.]
+        q = np.array(q, dtype=np.float64)
+        if q.ndim == 1:
+            q = q.reshape(1, 4)
+        if q.ndim != 2 or q.shape[1] != 4:
+            raise ValueError("q must be array-like with shape [N, 4].")
+        self.q = q
+
+    @classmethod
+    def from_euler(cls, euler):
+        """Create from an N x 3 array of XYZ (RPY) Euler angles."""
+        euler = np.atleast_2d(np.asarray(euler, dtype=np.float64))
+        half = 0.5 * euler
+        c = np.cos(half)
+        s = np.sin(half)
+        cr, cp, cy = c[:, 0], c[:, 1], c[:, 2]
+        sr, sp, sy = s[:, 0], s[:, 1], s[:, 2]
+
+        # Fixed frame, as in Quaternion(euler=...).
+        q = np.empty((euler.shape[0], 4))
+        q[:, 0] = cr * cp * cy + sr * sp * sy
+        q[:, 1] = sr * cp * cy - cr * sp * sy
+        q[:, 2] = cr * sp * cy + sr * cp * sy
+        q[:, 3] = cr * cp * sy - sr * sp * cy
+        return cls(q)
+
+    @classmethod
+    def from_axis_angle(cls, axis_angle):
+        """Create from an N x 3 array of axis-angle (rotation) vectors."""
+        axis_angle = np.atleast_2d(np.asarray(axis_angle, dtype=np.float64))
+        norm = np.linalg.norm(axis_angle, axis=1)
+        q = np.empty((axis_angle.shape[0], 4))
+        q[:, 0] = np.cos(norm / 2)
+
+        # Zero rotations get a zero imaginary part, to avoid instabilities and nans.
+        scale = np.zeros_like(norm)
+        nz = norm >= 1e-50
+        scale[nz] = np.sin(norm[nz] / 2) / norm[nz]
+        q[:, 1:] = axis_angle * scale[:, None]
+        return cls(q)
+
+    @classmethod
+    def from_mat(cls, C):
+        """Create from an N x 3 x 3 stack of rotation matrices (inverse of to_mat)."""
+        C = np.asarray(C, dtype=np.float64)
+        if C.ndim == 2:
+            C = C[None]
+        n = C.shape[0]
+        trace = C[:, 0, 0] + C[:, 1, 1] + C[:, 2, 2]
+
+        # Shepperd's method: pick the largest of w, x, y, z to divide by.
+        cand = np.stack([trace, C[:, 0, 0], C[:, 1, 1], C[:, 2, 2]], axis=1)
+        big = np.argmax(cand, axis=1)
+        q = np.empty((n, 4))
+
+        i = big == 0
+        s = 2 * np.sqrt(1 + trace[i])
+        q[i, 0] = 0.25 * s
+        q[i, 1] = (C[i, 2, 1] - C[i, 1, 2]) / s
+        q[i, 2] = (C[i, 0, 2] - C[i, 2, 0]) / s
+        q[i, 3] = (C[i, 1, 0] - C[i, 0, 1]) / s
+
+        i = big == 1
+        s = 2 * np.sqrt(1 + C[i, 0, 0] - C[i, 1, 1] - C[i, 2, 2])
+        q[i, 0] = (C[i, 2, 1] - C[i, 1, 2]) / s
+        q[i, 1] = 0.25 * s
+        q[i, 2] = (C[i, 0, 1] + C[i, 1, 0]) / s
+        q[i, 3] = (C[i, 0, 2] + C[i, 2, 0]) / s
+
+        i = big == 2
+        s = 2 * np.sqrt(1 + C[i, 1, 1] - C[i, 0, 0] - C[i, 2, 2])
+        q[i, 0] = (C[i, 0, 2] - C[i, 2, 0]) / s
+        q[i, 1] = (C[i, 0, 1] + C[i, 1, 0]) / s
+        q[i, 2] = 0.25 * s
+        q[i, 3] = (C[i, 1, 2] + C[i, 2, 1]) / s
+
+        i = big == 3
+        s = 2 * np.sqrt(1 + C[i, 2, 2] - C[i, 0, 0] - C[i, 1, 1])
+        q[i, 0] = (C[i, 1, 0] - C[i, 0, 1]) / s
+        q[i, 1] = (C[i, 0, 2] + C[i, 2, 0]) / s
+        q[i, 2] = (C[i, 1, 2] + C[i, 2, 1]) / s
+        q[i, 3] = 0.25 * s
+
+        # Keep the scalar part non-negative, so that q and -q map to one representative.
+        q[q[:, 0] < 0] *= -1
+        return cls(q)
+
+    def __len__(self):
+        return self.q.shape[0]
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            return Quaternion(*self.q[key].tolist())
+        return QuaternionArray(self.q[key])
+
+    def __repr__(self):
+        return "QuaternionArray (wxyz), %d quaternions" % len(self)
+
+    @property
+    def w(self):
+        return self.q[:, 0]
+
+    @property
+    def x(self):
+        return self.q[:, 1]
+
+    @property
+    def y(self):
+        return self.q[:, 2]
+
+    @property
+    def z(self):
+        return self.q[:, 3]
+
+    def to_numpy(self):
+        """Return numpy N x 4 wxyz representation."""
+        return self.q
+
+    def to_mat(self):
+        """Return an N x 3 x 3 stack of rotation matrices."""
+        w, x, y, z = self.q.T
+        C = np.empty((len(self), 3, 3))
+        C[:, 0, 0] = w*w + x*x - y*y - z*z
+        C[:, 0, 1] = 2 * (x*y - w*z)
+        C[:, 0, 2] = 2 * (x*z + w*y)
+        C[:, 1, 0] = 2 * (x*y + w*z)
+        C[:, 1, 1] = w*w - x*x + y*y - z*z
+        C[:, 1, 2] = 2 * (y*z - w*x)
+        C[:, 2, 0] = 2 * (x*z - w*y)
+        C[:, 2, 1] = 2 * (y*z + w*x)
+        C[:, 2, 2] = w*w - x*x - y*y + z*z
+        return C
+
+    def to_euler(self):
+        """Return as N x 3 xyz (roll pitch yaw) Euler angles."""
+        w, x, y, z = self.q.T
+        euler = np.empty((len(self), 3))
+        euler[:, 0] = np.arctan2(2 * (w * x + y * z), 1 - 2 * (x**2 + y**2))
+        euler[:, 1] = np.arcsin(np.clip(2 * (w * y - z * x), -1., 1.))
+        euler[:, 2] = np.arctan2(2 * (w * z + x * y), 1 - 2 * (y**2 + z**2))
+        return euler
+
+    def to_axis_angle(self):
+        """Return as N x 3 axis-angle vectors (zero for identity rotations)."""
+        w = self.q[:, 0]
+        v = self.q[:, 1:]
+        n2 = np.einsum('ij,ij->i', v, v)
+        n = np.sqrt(n2)
+        # As Quaternion.to_axis_angle: t / sin(t/2) -> 2 / w for small rotations, where
+        # arccos loses precision.
+        small = (n2 < 1e-16) & (w > 0)
+        zero = n2 == 0
+        scale = 2 * np.arctan2(n, w) / np.where(zero, 1., n)
+        scale[small] = 2 / w[small]
+        scale[zero & ~small] = 0.
+        return v * scale[:, None]
+
+    def normalize(self):
+        """Return a (unit) normalized version of this batch."""
+        return QuaternionArray(self.q / np.linalg.norm(self.q, axis=1, keepdims=True))
+
+    def inverse(self):
+        """Return the inverse of each quaternion (conjugate over squared norm)."""
+        q = self.q * np.array([1., -1., -1., -1.])
+        return QuaternionArray(q / np.einsum('ij,ij->i', self.q, self.q)[:, None])
+
+    def quat_mult_left(self, q):
+        """
+        Hamilton product self*q, element by element. Either side may hold a single
+        quaternion, which is broadcast against the other.
+
+        :param q: QuaternionArray, Quaternion, or N x 4 / (4,) ndarray.
+        :return: QuaternionArray
+        """
+        if isinstance(q, Quaternion):
+            q = q.to_numpy()
+        elif isinstance(q, QuaternionArray):
+            q = q.q
+        q = np.atleast_2d(q)
+
+        w1, x1, y1, z1 = self.q.T
+        w2, x2, y2, z2 = q.T
+        out = np.empty((max(len(self), q.shape[0]), 4))
+        out[:, 0] = w1 * w2 - x1 * x2 - y1 * y2 - z1 * z2
+        out[:, 1] = w1 * x2 + x1 * w2 + y1 * z2 - z1 * y2
+        out[:, 2] = w1 * y2 - x1 * z2 + y1 * w2 + z1 * x2
+        out[:, 3] = w1 * z2 + x1 * y2 - y1 * x2 + z1 * w2
+        return QuaternionArray(out)
+
+    def quat_mult_right(self, q):
+        """
+        Hamilton product q*self, element by element (see quat_mult_left).
+
+        :param q: QuaternionArray, Quaternion, or N x 4 / (4,) ndarray.
+        :return: QuaternionArray
+        """
+        if not isinstance(q, QuaternionArray):
+            q = QuaternionArray(q.to_numpy() if isinstance(q, Quaternion) else q)
+        return q.quat_mult_left(self)
 
-        if out == 'np':
-            return quat_np
-        elif out == 'Quaternion':
-            quat_obj = Quaternion(quat_np[0], quat_np[1], quat_np[2], quat_np[3])
-            return quat_obj
\ No newline at end of file
+    def __mul__(self, q):
+        return self.quat_mult_left(q)
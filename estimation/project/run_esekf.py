@@ -0,0 +1,140 @@
+# Command line entry point for the ES-EKF project.
+#
+# Runs one part of the assignment (or a custom configuration) without a display:
+#   python run_esekf.py --part 1 --no-plot --submission-out pt1_submission.txt
+#   python run_esekf.py --part 3 --save-figures figures/
+# matplotlib is only imported when figures are shown or saved, and the wall time of each
+# phase (load, filter, analysis, output) is printed at the end of the run.
+import argparse
+import os
+import time
+import numpy as np
+from analysis import analyse
+from bias_esekf import BiasESEKF
+from calibration import lidar_to_imu
+from covariance import POLICIES, CovarianceRecorder
+from data.columnar import load_any
+from esekf import ESEKF, PRECISIONS, run
+from iekf import InvariantESEKF
+from rotations import Quaternion
+from sqrt_esekf import SqrtESEKF
+
+# Filter formulations, all with the ESEKF interface used by esekf.run().
+ENGINES = {'esekf': ESEKF, 'sqrt': SqrtESEKF, 'invariant': InvariantESEKF, 'bias': BiasESEKF}
+
+# Dataset, LIDAR calibration, LIDAR variance and submission indices of each part.
+PARTS = {
+    1: dict(data='data/pt1_data.pkl', c_li='correct', var_lidar=1.00,
+            indices=[9000, 9400, 9800, 10200, 10600], zlim=(-20, 20)),
+    2: dict(data='data/pt1_data.pkl', c_li='incorrect', var_lidar=75.0,
+            indices=[9000, 9400, 9800, 10200, 10600], zlim=(-2, 2)),
+    3: dict(data='data/pt3_data.pkl', c_li='correct', var_lidar=1.00,
+            indices=[6800, 7600, 8400, 9200, 10000], zlim=(-20, 20)),
+}
+
+
+class Timer():
+    """Wall time per named phase."""
+
+    def __init__(self):
+        self.phases = []
+
+    def __call__(self, name):
+        self.phases.append((name, time.perf_counter()))
+        return self
+
+    def report(self):
+        end = time.perf_counter()
+        lines = []
+        for (name, start), (_, stop) in zip(self.phases, self.phases[1:] + [(None, end)]):
+            lines.append('%-10s %8.3f s' % (name, stop - start))
+        lines.append('%-10s %8.3f s' % ('total', end - self.phases[0][1]))
+        return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the ES-EKF on one part of the project.')
+    parser.add_argument('--part', type=int, choices=sorted(PARTS), default=1)
+    parser.add_argument('--data', default=None,
+                        help="pickled dataset or columnar dataset directory (default: the part's)")
+    parser.add_argument('--c-li', choices=['correct', 'incorrect'], default=None)
+    parser.add_argument('--var-imu-f', type=float, default=0.10)
+    parser.add_argument('--var-imu-w', type=float, default=0.25)
+    parser.add_argument('--var-gnss', type=float, default=0.01)
+    parser.add_argument('--var-lidar', type=float, default=None)
+    parser.add_argument('--engine', choices=sorted(ENGINES), default='esekf',
+                        help='filter formulation (default: %(default)s)')
+    parser.add_argument('--deferred', action='store_true',
+                        help='propagate the covariance only when it is read (see ESEKF)')
+    parser.add_argument('--precision', choices=list(PRECISIONS), default='float64',
+                        help='filter state and covariance precision (see esekf.PRECISIONS)')
+    parser.add_argument('--cov', choices=POLICIES, default='full',
+                        help='covariance history policy')
+    parser.add_argument('--cov-dtype', choices=['float64', 'float32'], default='float64')
+    parser.add_argument('--cov-every', type=int, default=1, metavar='K',
+                        help='keep the covariance of every K-th step only')
+    parser.add_argument('--cov-file', default=None, metavar='PATH',
+                        help='stream the covariance history to PATH instead of memory')
+    parser.add_argument('--no-plot', action='store_true', help='do not show or save any figures')
+    parser.add_argument('--save-figures', metavar='DIR', default=None,
+                        help='save the figures to DIR instead of showing them')
+    parser.add_argument('--submission-out', metavar='PATH', default=None,
+                        help="write the part's submission string to PATH")
+    args = parser.parse_args(argv)
+    part = PARTS[args.part]
+    plot = not args.no_plot
+
+    timer = Timer()
+    timer('load')
+    data = load_any(args.data or part['data'])
+    gt = data['gt']
+    lidar = lidar_to_imu(data['lidar'], args.c_li or part['c_li'])
+    var_lidar = part['var_lidar'] if args.var_lidar is None else args.var_lidar
+
+    timer('filter')
+    if args.deferred and args.engine != 'esekf':
+        parser.error('--deferred is only available with --engine esekf')
+    kwargs = {'deferred': True} if args.deferred else {}
+    ekf = ENGINES[args.engine](gt.p[0], gt.v[0], Quaternion(euler=gt.r[0]).to_numpy(),
+                               var_imu_f=args.var_imu_f, var_imu_w=args.var_imu_w,
+                               precision=args.precision, **kwargs)
+    cov = CovarianceRecorder(data['imu_f'].data.shape[0], dim=ekf.p_cov.shape[-1], policy=args.cov,
+                             dtype=args.cov_dtype, every=args.cov_every, path=args.cov_file)
+    p_est, v_est, q_est, cov = run(ekf, data['imu_f'], data['imu_w'],
+                                   [(data['gnss'], args.var_gnss), (lidar, var_lidar)], recorder=cov)
+    cov.close()
+
+    timer('analysis')
+    results = analyse(p_est, q_est, cov)
+    p_err, _, _ = results.errors(gt)
+    print('position error norm x %.3f y %.3f z %.3f' % tuple(np.linalg.norm(p_err, axis=0)))
+
+    timer('output')
+    if args.submission_out is not None:
+        with open(args.submission_out, 'w') as file:
+            file.write(results.submission(part['indices']))
+    if plot:
+        if args.save_figures is not None:
+            import matplotlib
+            matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+        import plots
+
+        figures = {
+            'ground_truth': plots.ground_truth(gt),
+            'trajectory': plots.trajectory(gt, p_est, part['zlim']),
+            'errors': plots.errors(gt, results),
+        }
+        if args.save_figures is not None:
+            os.makedirs(args.save_figures, exist_ok=True)
+            for name, fig in figures.items():
+                fig.savefig(os.path.join(args.save_figures, name + '.png'))
+                plt.close(fig)
+        else:
+            plt.show()
+
+    print(timer.report())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,344 @@
+# Rauch-Tung-Striebel smoothing of ES-EKF estimates.
+#
+# The smoothed error of step k relative to the filtered state follows the backward
+# recursion
+#
+#   d_k = G_k (d_(k+1) + c_(k+1)),   P_k = P_f(k) + G_k (P_(k+1) - P_p(k+1)) G_k^T,
+#
+# with G_k = P_f(k) F_(k+1)^T P_p(k+1)^-1 and c_(k+1) the correction the filter applied at
+# step k+1 (its filtered minus its predicted state). Each step is an affine map
+# (d, P) -> (G d + b, G P G^T + D), and these maps compose associatively, so:
+#
+# - rts() smooths a whole recorded run with a log-depth scan over all steps at once,
+#   instead of a Python loop over the steps;
+# - FixedLagSmoother keeps the maps of the last L steps in preallocated buffers as a
+#   two-stack queue, and emits the estimate of step k - L smoothed with everything up to
+#   step k at an amortised cost of a few map compositions per step.
+#
+# Both use the motion model of esekf.ESEKF, with F and the covariance of the world-frame
+# error [dp, dv, dtheta]. InvariantESEKF keeps its F in invariant coordinates and
+# BiasESEKF has 15 states, so neither can be smoothed here.
+import numpy as np
+from esekf import ESEKF, g, quat_mult
+from events import iter_events
+from lie import quat_exp, quat_log, quat_rotvec, rotvec_quat
+from rotations import QuaternionArray
+from sqrt_esekf import SqrtESEKF
+
+ENGINES = (ESEKF, SqrtESEKF)  # filters with F and p_cov in the world-frame error
+
+
+def transition(q, imu_f, dt):
+    """
+    Motion model jacobians F_(k+1) of ESEKF.predict() for a batch of steps.
+
+    :param q: N x 4 orientations at the start of the steps.
+    :param imu_f: N x 3 specific forces.
+    :param dt: N time steps.
+    :return: N x 9 x 9 jacobians.
+    """
+    n = len(dt)
+    C = QuaternionArray(q).to_mat()
+    f = imu_f * dt[:, None]
+    F = np.tile(np.eye(9), (n, 1, 1))
+    idx = np.arange(3)
+    F[:, idx, 3 + idx] = dt[:, None]
+    # -C [f]x dt, column by column (column i of [f]x is f x e_i).
+    F[:, 3:6, 6] = C[:, :, 2] * f[:, 1:2] - C[:, :, 1] * f[:, 2:3]
+    F[:, 3:6, 7] = C[:, :, 0] * f[:, 2:3] - C[:, :, 2] * f[:, 0:1]
+    F[:, 3:6, 8] = C[:, :, 1] * f[:, 0:1] - C[:, :, 0] * f[:, 1:2]
+    return F
+
+
+def predict_states(x, imu_f, imu_w, dt):
+    """Nominal states of ESEKF.predict() from N x 10 states [p, v, q], for a batch of steps."""
+    q = QuaternionArray(x[:, 6:10])
+    a = np.einsum('nij,nj->ni', q.to_mat(), imu_f) + g
+    d = dt[:, None]
+    out = np.empty_like(x)
+    out[:, 0:3] = x[:, 0:3] + d * x[:, 3:6] + (d ** 2 / 2.0) * a
+    out[:, 3:6] = x[:, 3:6] + d * a
+    out[:, 6:10] = q.quat_mult_left(quat_exp(imu_w * d)).q
+    return out
+
+
+def difference(x1, x0):
+    """N x 9 error states dx with x1 = x0 + dx, the inverse of the filter's injection."""
+    dx = np.empty(x1.shape[:-1] + (9,))
+    dx[..., 0:6] = x1[..., 0:6] - x0[..., 0:6]
+    q0 = QuaternionArray(x0[..., 6:10].reshape(-1, 4))
+    q1 = QuaternionArray(x1[..., 6:10].reshape(-1, 4))
+    dx[..., 6:9] = quat_log(q0.inverse().quat_mult_left(q1).q).reshape(dx[..., 6:9].shape)
+    return dx
+
+
+def inject(x, dx):
+    """States x + dx, with the error-state injection of ESEKF.correct()."""
+    out = np.empty(np.broadcast(x, dx[..., :1]).shape)
+    out[..., 0:6] = x[..., 0:6] + dx[..., 0:6]
+    q = QuaternionArray(x[..., 6:10].reshape(-1, 4))
+    out[..., 6:10] = q.quat_mult_left(quat_exp(dx[..., 6:9].reshape(-1, 3))).q.reshape(
+        out[..., 6:10].shape)
+    return out
+
+
+def _difference_step(x1, x0):
+    """difference() of two single states, on Python floats."""
+    x1 = x1.tolist()
+    x0 = x0.tolist()
+    qw, qx, qy, qz = x0[6:10]
+    return [a - b for a, b in zip(x1[0:6], x0[0:6])] + list(quat_rotvec(*quat_mult((qw, -qx, -qy, -qz), x1[6:10])))
+
+
+def _inject_step(x, dx):
+    """inject() for a single state, on Python floats."""
+    x = x.tolist()
+    dx = dx.tolist()
+    return np.array([a + b for a, b in zip(x[0:6], dx[0:6])] + list(quat_mult(x[6:10], rotvec_quat(*dx[6:9]))))
+
+
+def _gain(P_f, F, P_p):
+    """G = P_f F^T P_p^-1 for stacks of matrices (pseudo-inverse if P_p is singular)."""
+    FP = F @ P_f
+    try:
+        return np.swapaxes(np.linalg.solve(P_p, FP), -1, -2)
+    except np.linalg.LinAlgError:
+        pass
+    # E.g. the first step from a zero initial covariance, where P_p = L Q L^T: only those
+    # matrices go through the pseudo-inverse.
+    if P_p.ndim == 2:
+        return (np.linalg.pinv(P_p, hermitian=True) @ FP).T
+    X = np.empty_like(FP)
+    bad = (np.diagonal(P_p, axis1=1, axis2=2) == 0).any(axis=1)
+    X[bad] = np.linalg.pinv(P_p[bad], hermitian=True) @ FP[bad]
+    X[~bad] = np.linalg.solve(P_p[~bad], FP[~bad])
+    return np.swapaxes(X, -1, -2)
+
+
+def _compose(A1, b1, D1, A2, b2, D2):
+    """The affine map (d, P) -> map1(map2(d, P)), for stacks of maps."""
+    A = A1 @ A2
+    b = np.einsum('...ij,...j->...i', A1, b2) + b1
+    D = A1 @ D2 @ np.swapaxes(A1, -1, -2) + D1
+    return A, b, D
+
+
+def rts(p_est, v_est, q_est, p_cov, imu_f, imu_w, var_imu_f=0.10, var_imu_w=0.25):
+    """
+    Fixed-interval RTS smoothing of a recorded esekf.run() of one of ENGINES.
+
+    :param p_est: N x 3 filtered positions.
+    :param v_est: N x 3 filtered velocities.
+    :param q_est: N x 4 filtered orientations.
+    :param p_cov: N x 9 x 9 filtered covariances (the full history of the run).
+    :param imu_f: StampedData of specific forces used by the run.
+    :param imu_w: StampedData of angular rates used by the run.
+    :param var_imu_f: IMU specific force variance of the run.
+    :param var_imu_w: IMU angular rate variance of the run.
+    :return: Smoothed p, v, q (N x 3, N x 3, N x 4) and covariances (N x 9 x 9).
+    """
+    n = p_est.shape[0]
+    x_f = np.concatenate([p_est, v_est, q_est], axis=1)
+    P_f = np.asarray(p_cov, dtype=np.float64)
+    if P_f.shape != (n, 9, 9):
+        raise ValueError("p_cov must hold the N x 9 x 9 covariances of an ESEKF or SqrtESEKF run.")
+    dt = np.diff(imu_f.t[:n])
+    f = imu_f.data[:n - 1]
+    w = imu_w.data[:n - 1]
+
+    # Predictions of steps 1..N-1 from the filtered states of steps 0..N-2.
+    F = transition(x_f[:-1, 6:10], f, dt)
+    P_p = F @ P_f[:-1] @ F.transpose(0, 2, 1)
+    idx = np.arange(3)
+    P_p[:, 3 + idx, 3 + idx] += var_imu_f * dt[:, None] ** 2
+    P_p[:, 6 + idx, 6 + idx] += var_imu_w * dt[:, None] ** 2
+    c = difference(x_f[1:], predict_states(x_f[:-1], f, w, dt))
+
+    # Backward maps of steps 0..N-2, then a suffix scan: after the level with stride s, map
+    # k is the composition of the maps k..min(k + 2s, N - 1) - 1.
+    A = _gain(P_f[:-1], F, P_p)
+    b = np.einsum('nij,nj->ni', A, c)
+    D = P_f[:-1] - A @ P_p @ A.transpose(0, 2, 1)
+    s = 1
+    while s < n - 1:
+        A[:-s], b[:-s], D[:-s] = _compose(A[:-s], b[:-s], D[:-s], A[s:], b[s:], D[s:])
+        s *= 2
+
+    dx = np.zeros((n, 9))
+    dx[:-1] = b
+    P_s = np.empty_like(P_f)
+    P_s[:-1] = A @ P_f[-1] @ A.transpose(0, 2, 1) + D
+    P_s[-1] = P_f[-1]
+    x_s = inject(x_f, dx)
+    return x_s[:, 0:3], x_s[:, 3:6], x_s[:, 6:10], P_s
+
+
+class FixedLagSmoother():
+    def __init__(self, ekf, lag):
+        """
+        Fixed-lag RTS smoother driving an ESEKF: call predict() and correct() as on the
+        filter; from step `lag` on, each predict() returns the estimate of `lag` steps
+        earlier, smoothed with all the measurements up to the current step.
+
+        :param ekf: ESEKF or SqrtESEKF (see ENGINES; not in deferred mode), already
+                    initialised.
+        :param lag: Smoothing delay L in filter steps.
+        """
+        if type(ekf) not in ENGINES:
+            raise TypeError("The smoother needs an ESEKF or SqrtESEKF, whose F and p_cov are "
+                            "in the same frame; got %s." % type(ekf).__name__)
+        if ekf.deferred:
+            raise ValueError("The smoother needs the per-step jacobians; use deferred=False.")
+        self.ekf = ekf
+        self.lag = lag
+        self.k = 0  # current step
+
+        # Filtered states and covariances of the last L + 1 steps, by k % (L + 1).
+        self._x = np.zeros((lag + 1, 10))
+        self._P = np.zeros((lag + 1, 9, 9))
+        # Prediction and jacobian of the current step.
+        self._x_p = np.zeros(10)
+        self._P_p = np.zeros((9, 9))
+        self._F = np.eye(9)
+
+        # Backward maps of the last L steps, as a two-stack queue: the front stack holds, at
+        # position i, the composition of its own map with all maps above it in the stack,
+        # so its top is the composition of the oldest maps; the back stack holds single maps
+        # and the composition of all of them.
+        self._front = (np.zeros((lag, 9, 9)), np.zeros((lag, 9)), np.zeros((lag, 9, 9)))
+        self._back = (np.zeros((lag, 9, 9)), np.zeros((lag, 9)), np.zeros((lag, 9, 9)))
+        self._n_front = 0
+        self._n_back = 0
+        self._back_total = None
+
+    def __len__(self):
+        return self._n_front + self._n_back
+
+    def correct(self, y, var):
+        """Fuse a position measurement into the current step (see ESEKF.correct)."""
+        self.ekf.correct(y, var)
+
+    def predict(self, imu_f, imu_w, dt):
+        """
+        Close the current step and predict the next one (see ESEKF.predict).
+
+        :return: (k, x, p_cov) of step k = current - L, smoothed, or None during the first
+                 L steps.
+        """
+        out = self._close()
+        ekf = self.ekf
+        ekf.predict(imu_f, imu_w, dt)
+        self._x_p[:] = ekf.x
+        self._P_p[...] = ekf.p_cov
+        self._F[...] = ekf.F
+        self.k += 1
+        return out
+
+    def finish(self):
+        """Close the current step and return the smoothed estimates of the remaining steps."""
+        out = self._close()
+        out = [] if out is None else [out]
+        while len(self):
+            out.append(self._emit())
+            self._pop()
+        i = self.k % (self.lag + 1)
+        out.append((self.k, self._x[i].copy(), self._P[i].copy()))
+        return out
+
+    def _close(self):
+        """Store the filtered estimate of the current step and queue the map of the previous one."""
+        L = self.lag
+        ekf = self.ekf
+        i = self.k % (L + 1)
+        self._x[i] = ekf.x
+        self._P[i] = ekf.p_cov
+        if self.k == 0:
+            return None
+        h = (self.k - 1) % (L + 1)
+        G = _gain(self._P[h], self._F, self._P_p)
+        c = _difference_step(self._x[i], self._x_p)
+        self._push(G, G @ c, self._P[h] - G @ self._P_p @ G.T)
+        if len(self) < L:
+            return None
+        out = self._emit()
+        self._pop()
+        return out
+
+    def _emit(self):
+        """Smoothed estimate of the oldest queued step, from the composition of all maps."""
+        n = self._n_front
+        if n and self._n_back:
+            A, b, D = _compose(self._front[0][n - 1], self._front[1][n - 1], self._front[2][n - 1],
+                               *self._back_total)
+        elif n:
+            A, b, D = self._front[0][n - 1], self._front[1][n - 1], self._front[2][n - 1]
+        else:
+            A, b, D = self._back_total
+        i = self.k % (self.lag + 1)
+        k = self.k - len(self)
+        j = k % (self.lag + 1)
+        return k, _inject_step(self._x[j], b), A @ self._P[i] @ A.T + D
+
+    def _push(self, A, b, D):
+        m = self._n_back
+        self._back[0][m] = A
+        self._back[1][m] = b
+        self._back[2][m] = D
+        self._n_back += 1
+        if m:
+            self._back_total = _compose(*self._back_total, A, b, D)
+        else:
+            self._back_total = (A, b, D)
+
+    def _pop(self):
+        """Drop the oldest map, moving the back stack to the front one if that is empty."""
+        if not self._n_front:
+            # Newest map at the bottom of the front stack, each with everything newer.
+            A, b, D = self._back
+            FA, Fb, FD = self._front
+            m = self._n_back
+            FA[0], Fb[0], FD[0] = A[m - 1], b[m - 1], D[m - 1]
+            for i in range(1, m):
+                FA[i], Fb[i], FD[i] = _compose(A[m - 1 - i], b[m - 1 - i], D[m - 1 - i],
+                                               FA[i - 1], Fb[i - 1], FD[i - 1])
+            self._n_front = m
+            self._n_back = 0
+            self._back_total = None
+        self._n_front -= 1
+
+
+def run_fixed_lag(ekf, imu_f, imu_w, sensors, lag, n=None):
+    """
+    Run a FixedLagSmoother over a recorded log, with the event ordering of esekf.run().
+
+    :param ekf: ESEKF, already initialised at imu_f.t[0].
+    :param imu_f: StampedData of specific forces.
+    :param imu_w: StampedData of angular rates.
+    :param sensors: List of (StampedData, variance) position sensors.
+    :param lag: Smoothing delay in filter steps.
+    :param n: Number of ticks to run. Defaults to imu_f.data.shape[0].
+    :return: p, v, q arrays of length n, each step smoothed with the measurements up to
+             `lag` steps later.
+    """
+    if n is None:
+        n = imu_f.data.shape[0]
+    x_est = np.zeros([n, 10])
+    smoother = FixedLagSmoother(ekf, lag)
+
+    f = imu_f.data.tolist()
+    w = imu_w.data.tolist()
+    t = imu_f.t[:n].tolist()
+    for t_e, j, i in iter_events([imu_f.t[1:n]] + [s for s, _ in sensors]):
+        if t_e > t[-1]:
+            break
+        if j == 0:
+            k = i + 1
+            out = smoother.predict(f[k - 1], w[k - 1], t[k] - t[k - 1])
+            if out is not None:
+                x_est[out[0]] = out[1]
+        else:
+            y, var = sensors[j - 1]
+            smoother.correct(y.data[i], var)
+    for k, x, _ in smoother.finish():
+        x_est[k] = x
+    return x_est[:, 0:3], x_est[:, 3:6], x_est[:, 6:10]
@@ -0,0 +1,164 @@
+# Square-root (Cholesky-factor) form of the ES-EKF covariance.
+#
+# Instead of P the filters keep an upper-triangular factor S with P = S^T S, so P is
+# symmetric and positive semi-definite by construction, in any precision and over any run
+# length, without re-symmetrisation or Joseph-form updates:
+#
+# - propagation: F P F^T + L Q L^T = A^T A for the stacked A = [S F^T; sqrt(Q) L^T], so the
+#   new factor is the triangular R of A = QR;
+# - update: the triangular R of the array [sqrt(R_y) 0; S H^T S] is
+#   [Sy K'; 0 S+], with Sy^T Sy the innovation covariance, K' = Sy^-T H P and S+ the factor
+#   of P - P H^T (H P H^T + R_y)^-1 H P, i.e. the covariance downdate by the measurement.
+#
+# np.linalg.qr works on stacks of matrices, so the same two functions serve a single
+# filter and a batch of M filters.
+import numpy as np
+from batch import BatchESEKF
+from esekf import ESEKF, POSITION
+
+
+def factor(p_cov):
+    """
+    Upper-triangular S with S^T S = p_cov, for a 9x9 (or stack of) positive
+    semi-definite matrices; singular ones (e.g. a zero initial covariance) are allowed.
+    """
+    p_cov = np.asarray(p_cov)
+    try:
+        return np.swapaxes(np.linalg.cholesky(p_cov), -1, -2)
+    except np.linalg.LinAlgError:
+        w, V = np.linalg.eigh(p_cov)
+        A = np.sqrt(np.clip(w, 0, None))[..., :, None] * np.swapaxes(V, -1, -2)
+        return np.linalg.qr(A, mode='r')
+
+
+def sqrt_propagate(S, F, q_sqrt, out=None):
+    """
+    Factor of F P F^T + L Q L^T for P = S^T S, with L Q L^T diagonal on the v and theta
+    blocks.
+
+    :param S: n x n upper-triangular factors (or a stack of them).
+    :param F: n x n motion model jacobians, matching S.
+    :param q_sqrt: Standard deviations of the process noise on states 3..n-1 (or a stack).
+    :param out: Optional array for the result.
+    :return: The new factors.
+    """
+    n = S.shape[-1]
+    k = q_sqrt.shape[-1]
+    A = np.zeros(S.shape[:-2] + (n + k, n), dtype=S.dtype)
+    np.matmul(S, np.swapaxes(F, -1, -2), out=A[..., :n, :])
+    idx = np.arange(k)
+    A[..., n + idx, n - k + idx] = q_sqrt
+    R = np.linalg.qr(A, mode='r')
+    if out is None:
+        return R
+    out[...] = R
+    return out
+
+
+def sqrt_update(S, idx, r, var):
+    """
+    Measurement update of a factor for a sensor with H = I[idx, :] (see
+    esekf.selection_update).
+
+    :param S: n x n upper-triangular factors (or a stack of them), updated in place.
+    :param idx: Observed states, as a slice or index list.
+    :param r: Innovations y - h(x), length m (or a stack).
+    :param var: Measurement variances, broadcastable to the shape of r.
+    :return: Error-state corrections dx, length n (or a stack).
+    """
+    n = S.shape[-1]
+    SH = S[..., :, idx]
+    m = SH.shape[-1]
+    A = np.zeros(S.shape[:-2] + (m + n, m + n), dtype=S.dtype)
+    d = np.arange(m)
+    A[..., d, d] = np.sqrt(np.asarray(var, dtype=S.dtype))
+    A[..., m:, :m] = SH
+    A[..., m:, m:] = S
+    R = np.linalg.qr(A, mode='r')
+
+    # dx = P H^T (H P H^T + R_y)^-1 r = K'^T Sy^-T r.
+    z = np.linalg.solve(np.swapaxes(R[..., :m, :m], -1, -2), np.asarray(r, dtype=S.dtype)[..., None])
+    S[...] = R[..., m:, m:]
+    return (np.swapaxes(R[..., :m, m:], -1, -2) @ z)[..., 0]
+
+
+class SqrtESEKF(ESEKF):
+    def __init__(self, p, v, q, p_cov=None, var_imu_f=0.10, var_imu_w=0.25, precision='float64'):
+        """
+        ESEKF that propagates and updates a Cholesky factor of the covariance.
+
+        p_cov is computed from the factor when read, so unlike with ESEKF writes to it do
+        not change the filter; use self.S instead. Deferred propagation is not available,
+        and measurement noise is given as variances only. See ESEKF for the parameters.
+        """
+        super().__init__(p, v, q, p_cov, var_imu_f, var_imu_w, precision=precision)
+        self.joseph = False
+        self.S = factor(self._p_cov).astype(self._p_cov.dtype)
+        self._q_sqrt = np.zeros(6, dtype=self._p_cov.dtype)
+
+    @property
+    def p_cov(self):
+        """9x9 error-state covariance S^T S (a new array)."""
+        return self.S.T @ self.S
+
+    def _propagate(self, dt, b):
+        F = self._F
+        if dt != self._dt:
+            self._dt = dt
+            F[0, 3] = F[1, 4] = F[2, 5] = dt
+            self._q_sqrt[0:3] = np.sqrt(self.var_imu_f) * dt
+            self._q_sqrt[3:6] = np.sqrt(self.var_imu_w) * dt
+        F[3:6, 6:9] = b
+        sqrt_propagate(self.S, F, self._q_sqrt, out=self.S)
+
+    def correct(self, y, var, joseph=None):
+        """
+        Fuse a position measurement (see ESEKF.correct; the factor update needs no Joseph
+        form, and joseph is ignored).
+        """
+        px, py, pz, vx, vy, vz, qw, qx, qy, qz = self.x.tolist()
+        y0, y1, y2 = y
+        dx = sqrt_update(self.S, POSITION, [y0 - px, y1 - py, y2 - pz], var)
+        self._inject(dx.tolist())
+
+    def state_arrays(self):
+        """x and the factor S (see ESEKF.state_arrays)."""
+        return self.x, self.S
+
+    def propagate(self, preint):
+        """
+        Propagate through a preintegrated interval (see ESEKF.propagate), with the factor
+        of Phi P Phi^T + Q as the triangular R of [S Phi^T; sqrt(Q)] = QR.
+        """
+        if not len(preint):
+            return
+        x = preint.predict(self.p, self.v, self.q)
+        Phi, Q = preint.transition(self.q)
+        A = np.concatenate([self.S @ Phi.T, factor(Q)])
+        self.S[...] = np.linalg.qr(A, mode='r')
+        self.x[:] = x
+
+
+class BatchSqrtESEKF(BatchESEKF):
+    def __init__(self, *args, **kwargs):
+        """
+        BatchESEKF that propagates and updates Cholesky factors of the covariances. p_cov
+        is computed from self.S when read. See BatchESEKF for the parameters.
+        """
+        super().__init__(*args, **kwargs)
+        self.joseph = False
+
+    @property
+    def p_cov(self):
+        """M x 9 x 9 covariances S^T S (a new array); assigning to it refactors S."""
+        return np.swapaxes(self.S, 1, 2) @ self.S
+
+    @p_cov.setter
+    def p_cov(self, value):
+        self.S = factor(value).astype(value.dtype)
+
+    def _propagate(self):
+        sqrt_propagate(self.S, self._F, np.sqrt(self._q_diag[:, 3:9]), out=self.S)
+
+    def _update(self, r, var):
+        return sqrt_update(self.S, POSITION, r, np.asarray(var).reshape(-1, 1))
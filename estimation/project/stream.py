@@ -0,0 +1,194 @@
+# Online (push-based) interface to the ES-EKF.
+#
+# Instead of running over arrays sized from a complete log, the filter is fed one sensor
+# sample at a time, e.g. from a live feed or a replayed file, and hands out an estimate for
+# every sample it processes. Nothing grows with the length of the run: the only history
+# kept is an optional window of the most recent estimates and, for measurements that are
+# delivered late, a fixed-size ring buffer of the recent filter states and inputs.
+#
+#   online = StreamingESEKF(ekf, {'gnss': 0.01, 'lidar': 1.0})
+#   for kind, t, *values in replay(imu_f, imu_w, [('gnss', gnss), ('lidar', lidar)]):
+#       est = online.push_imu(t, *values) if kind == 'imu' else online.push_position(t, *values)
+import bisect
+import collections
+import time
+import numpy as np
+from events import iter_events
+
+Estimate = collections.namedtuple('Estimate', ['t', 'k', 'p', 'v', 'q', 'p_cov', 'latency'])
+Estimate.__doc__ = """
+Filter output after one pushed sample.
+
+t and k are the time and index of the latest IMU tick, p, v and q a snapshot of the nominal
+state, p_cov a copy of the covariance (None unless requested) and latency the wall time [s]
+spent processing the sample.
+"""
+
+
+class StreamingESEKF():
+    def __init__(self, ekf, sensors, history=0, with_cov=False, callback=None, max_lag=0):
+        """
+        :param ekf: ESEKF, initialised at the time of the first IMU sample that will be pushed.
+                    With max_lag, it must provide state_arrays() (see ESEKF.state_arrays)
+                    for the rollback.
+        :param sensors: Dict of position sensor id -> measurement variance.
+        :param history: Number of recent estimates kept in self.history (0 for none).
+        :param with_cov: Include a copy of the covariance in every estimate.
+        :param callback: Called with every estimate, as it is produced.
+        :param max_lag: Number of recent IMU ticks whose states and inputs are kept, so that
+                        a measurement stamped before the latest tick is fused at its own
+                        tick and the filter re-propagated from there. Measurements older
+                        than the window are dropped (and counted in self.dropped). With 0,
+                        measurements are always fused at the latest tick.
+        """
+        self.ekf = ekf
+        self.sensors = dict(sensors)
+        self.with_cov = with_cov
+        self.callback = callback
+        self.history = collections.deque(maxlen=history) if history else None
+        self.t = None  # time of the latest IMU tick
+        self.k = -1  # index of the latest IMU tick
+        self._imu = None  # latest (f, w) sample, applied over the next interval
+        self.dropped = 0
+
+        # Ring buffer over ticks k % max_lag: time, IMU sample, filter state (one buffer per
+        # array of ekf.state_arrays()) before the tick's corrections, and the (t, y, var)
+        # measurements fused at the tick.
+        self.max_lag = max_lag
+        if max_lag:
+            if not hasattr(ekf, 'state_arrays'):
+                raise TypeError("max_lag needs a filter whose state can be restored, "
+                                "%s has no state_arrays()." % type(ekf).__name__)
+            self._t = [None] * max_lag
+            self._u = [None] * max_lag
+            self._states = [np.zeros((max_lag,) + a.shape, dtype=a.dtype) for a in ekf.state_arrays()]
+            self._z = [[] for _ in range(max_lag)]
+
+    def _emit(self, start):
+        ekf = self.ekf
+        x = ekf.x.copy()
+        est = Estimate(self.t, self.k, x[0:3], x[3:6], x[6:10],
+                       ekf.p_cov.copy() if self.with_cov else None, time.perf_counter() - start)
+        if self.history is not None:
+            self.history.append(est)
+        if self.callback is not None:
+            self.callback(est)
+        return est
+
+    def push_imu(self, t, imu_f, imu_w):
+        """
+        Process one IMU sample: predict from the previous sample's time to t with the
+        previous sample, as esekf.run() does, and keep this one for the next interval.
+
+        :param t: Timestamp [s].
+        :param imu_f: Specific force in the vehicle frame, length 3.
+        :param imu_w: Angular rate in the vehicle frame, length 3.
+        :return: Estimate at t (before any measurement stamped t is pushed).
+        """
+        start = time.perf_counter()
+        if self._imu is not None:
+            self.ekf.predict(self._imu[0], self._imu[1], t - self.t)
+        self._imu = (imu_f, imu_w)
+        self.t = t
+        self.k += 1
+        if self.max_lag:
+            i = self.k % self.max_lag
+            self._t[i] = t
+            self._u[i] = self._imu
+            self._save(i)
+            self._z[i] = []
+        return self._emit(start)
+
+    def push_position(self, t, y, sensor_id, var=None):
+        """
+        Fuse one position measurement at the latest IMU tick.
+
+        A measurement stamped before the latest tick is fused at the last tick at or before
+        its timestamp, after the measurements already fused there with earlier or equal
+        stamps, if that tick is still in the max_lag window; the ticks after it are then
+        re-propagated. Estimates already handed out are not revised. A measurement pushed
+        before the first IMU sample is fused at the initial state, which the first tick
+        then starts from.
+
+        :param t: Timestamp [s].
+        :param y: Measured position [3,].
+        :param sensor_id: Key of the sensor in the sensors dict.
+        :param var: Measurement variance, if not the sensor's.
+        :return: Estimate at the latest tick after the correction, or None if the
+                 measurement was dropped.
+        """
+        start = time.perf_counter()
+        if var is None:
+            var = self.sensors[sensor_id]
+        if self.max_lag and self.t is not None and t < self.t:
+            if not self._fuse_late(t, y, var):
+                self.dropped += 1
+                return None
+        else:
+            self.ekf.correct(y, var)
+            if self.max_lag and self.k >= 0:
+                self._z[self.k % self.max_lag].append((t, y, var))
+        return self._emit(start)
+
+    def _save(self, i):
+        """Store the filter state in slot i of the ring buffer."""
+        for buf, a in zip(self._states, self.ekf.state_arrays()):
+            buf[i] = a
+
+    def _fuse_late(self, t, y, var):
+        """Fuse a measurement stamped before the latest tick; False if it is out of the window."""
+        L = self.max_lag
+        ekf = self.ekf
+        j = self.k
+        oldest = max(self.k - L + 1, 0)
+        while j >= oldest and self._t[j % L] > t:
+            j -= 1
+        if j < oldest:
+            return False
+
+        z = self._z[j % L]
+        z.insert(bisect.bisect_right([m[0] for m in z], t), (t, y, var))
+        for buf, a in zip(self._states, ekf.state_arrays()):
+            a[...] = buf[j % L]
+        for _, ym, vm in z:
+            ekf.correct(ym, vm)
+        for k in range(j + 1, self.k + 1):
+            i, h = k % L, (k - 1) % L
+            ekf.predict(self._u[h][0], self._u[h][1], self._t[i] - self._t[h])
+            self._save(i)
+            for _, ym, vm in self._z[i]:
+                ekf.correct(ym, vm)
+        return True
+
+
+def replay(imu_f, imu_w, sensors, n=None):
+    """
+    Events of a recorded log in the order esekf.run() processes them.
+
+    :param imu_f: StampedData of specific forces.
+    :param imu_w: StampedData of angular rates.
+    :param sensors: List of (sensor id, StampedData) position sensors.
+    :param n: Number of IMU samples. Defaults to imu_f.data.shape[0].
+    :return: Generator of ('imu', t, f, w) and ('position', t, y, sensor_id) tuples.
+    """
+    if n is None:
+        n = imu_f.data.shape[0]
+    t = imu_f.t[:n]
+    f = imu_f.data[:n].tolist()
+    w = imu_w.data[:n].tolist()
+    yield 'imu', float(t[0]), f[0], w[0]
+    for t_e, j, i in iter_events([t[1:]] + [s for _, s in sensors]):
+        if t_e > t[-1]:
+            break
+        if j == 0:
+            yield 'imu', t_e, f[i + 1], w[i + 1]
+        else:
+            sensor_id, s = sensors[j - 1]
+            yield 'position', t_e, s.data[i], sensor_id
+
+
+def estimates(online, events):
+    """Feed (kind, t, ...) events, e.g. from replay(), to a StreamingESEKF; yields the estimates."""
+    push = {'imu': online.push_imu, 'position': online.push_position}
+    for kind, t, *values in events:
+        yield push[kind](t, *values)
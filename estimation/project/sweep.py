@@ -0,0 +1,167 @@
+# Parallel noise-parameter sweep for the ES-EKF.
+#
+# Runs the filter for every combination of the given noise parameters and LIDAR calibration
+# choices, and writes one row per run with the position error against ground truth. The
+# dataset is loaded once in the parent process; on platforms that fork, worker processes
+# share that copy read-only instead of each unpickling their own. A columnar dataset
+# directory (see data/columnar.py) is memory-mapped, so all workers read one page-cache copy.
+# With --batch, all configurations instead run in one process as a lockstep batched filter.
+# Runs default to float64; --precision selects float32 or mixed storage (see
+# esekf.PRECISIONS), and benchmark.py reports how far those move the estimates.
+#
+# Example (the sweep that p2.cmd used to run one process at a time):
+#   python sweep.py --c-li incorrect --var-lidar 40 45 50 55 60 --out x.txt
+import argparse
+import csv
+import functools
+import itertools
+import multiprocessing
+import os
+import sys
+import time
+import numpy as np
+from batch import BatchESEKF, run_batch
+from calibration import lidar_to_imu
+from data.columnar import load_any
+from data.utils import StampedData
+from esekf import ESEKF, PRECISIONS, run
+from rotations import Quaternion
+
+FIELDS = ['var_imu_f', 'var_imu_w', 'var_gnss', 'var_lidar', 'c_li']
+PRECISION = 'float64'  # default precision of sweep runs
+RESULTS = ['x_error', 'y_error', 'z_error', 'rms_error', 'seconds']
+
+_data = None  # dataset shared with the workers
+
+
+def _init_worker(path):
+    global _data
+    if _data is None:
+        _data = load_any(path)
+
+
+def result_row(config, gt, p_est, seconds):
+    """config updated with the position errors of p_est against gt and the run time."""
+    err = gt.p - p_est[:gt.p.shape[0]]
+    result = dict(config)
+    result['x_error'], result['y_error'], result['z_error'] = np.linalg.norm(err, axis=0).tolist()
+    result['rms_error'] = np.sqrt(np.mean(np.sum(err ** 2, axis=1))).item()
+    result['seconds'] = seconds
+    return result
+
+
+def run_config(config, precision=PRECISION):
+    """
+    Run the filter once on the shared dataset.
+
+    :param config: Dict with the FIELDS keys.
+    :param precision: Filter precision (see esekf.PRECISIONS).
+    :return: config updated with the RESULTS keys. The x/y/z errors are the norms of the
+             per-axis position errors over the ground truth samples, as printed by
+             es-ekr-part-2.py.
+    """
+    gt = _data['gt']
+    lidar = lidar_to_imu(_data['lidar'], config['c_li'])
+    ekf = ESEKF(gt.p[0], gt.v[0], Quaternion(euler=gt.r[0]).to_numpy(),
+                var_imu_f=config['var_imu_f'], var_imu_w=config['var_imu_w'], precision=precision)
+
+    start = time.perf_counter()
+    p_est = run(ekf, _data['imu_f'], _data['imu_w'],
+                [(_data['gnss'], config['var_gnss']), (lidar, config['var_lidar'])])[0]
+    seconds = time.perf_counter() - start
+
+    return result_row(config, gt, p_est, seconds)
+
+
+def grid(**values):
+    """Every combination of the given parameter lists, as a list of config dicts."""
+    keys = list(values)
+    return [dict(zip(keys, combo)) for combo in itertools.product(*(values[k] for k in keys))]
+
+
+def sweep(path, configs, workers=None, precision=PRECISION):
+    """
+    Run configs over the dataset at path with a process pool.
+
+    :param path: Pickled dataset (e.g. data/pt1_data.pkl) or columnar dataset directory.
+    :param configs: List of config dicts (see grid()).
+    :param workers: Number of processes. Defaults to the number of CPUs.
+    :param precision: Filter precision (see esekf.PRECISIONS).
+    :return: List of result dicts, in the order of configs.
+    """
+    global _data
+    _data = load_any(path)
+    if 'fork' in multiprocessing.get_all_start_methods():
+        # Workers inherit the loaded dataset; _init_worker has nothing left to do.
+        ctx = multiprocessing.get_context('fork')
+    else:
+        ctx = multiprocessing.get_context()
+    with ctx.Pool(workers or os.cpu_count(), _init_worker, (path,)) as pool:
+        return pool.map(functools.partial(run_config, precision=precision), configs, chunksize=1)
+
+
+def batch_sweep(path, configs, precision=PRECISION):
+    """
+    Run configs in one process as a single lockstep BatchESEKF, one member per config.
+
+    :param precision: Filter precision (see esekf.PRECISIONS).
+
+    :return: List of result dicts, in the order of configs. 'seconds' is the batch run time
+             divided by the number of configs.
+    """
+    data = load_any(path)
+    gt = data['gt']
+    lidar = StampedData()
+    lidar.t = data['lidar'].t
+    lidar.data = np.stack([lidar_to_imu(data['lidar'], c['c_li']).data for c in configs])
+    ekf = BatchESEKF(gt.p[0], gt.v[0], Quaternion(euler=gt.r[0]).to_numpy(),
+                     var_imu_f=[c['var_imu_f'] for c in configs],
+                     var_imu_w=[c['var_imu_w'] for c in configs], m=len(configs), precision=precision)
+
+    start = time.perf_counter()
+    p_est = run_batch(ekf, data['imu_f'], data['imu_w'],
+                      [(data['gnss'], np.array([c['var_gnss'] for c in configs])),
+                       (lidar, np.array([c['var_lidar'] for c in configs]))])
+    seconds = (time.perf_counter() - start) / len(configs)
+
+    return [result_row(config, gt, p_est[:, j], seconds) for j, config in enumerate(configs)]
+
+
+def write(results, file):
+    writer = csv.DictWriter(file, FIELDS + RESULTS, extrasaction='ignore')
+    writer.writeheader()
+    for r in results:
+        writer.writerow({k: ('%.6g' % v if isinstance(v, float) else v) for k, v in r.items()})
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Parallel noise-parameter sweep for the ES-EKF.')
+    parser.add_argument('--data', default='data/pt1_data.pkl', help='pickled dataset or columnar dataset directory')
+    parser.add_argument('--var-imu-f', type=float, nargs='+', default=[0.10])
+    parser.add_argument('--var-imu-w', type=float, nargs='+', default=[0.25])
+    parser.add_argument('--var-gnss', type=float, nargs='+', default=[0.01])
+    parser.add_argument('--var-lidar', type=float, nargs='+', default=[1.00])
+    parser.add_argument('--c-li', nargs='+', default=['correct'], choices=['correct', 'incorrect'])
+    parser.add_argument('--workers', type=int, default=None, help='processes (default: all cores)')
+    parser.add_argument('--batch', action='store_true',
+                        help='run all configurations as one lockstep batched filter')
+    parser.add_argument('--precision', choices=list(PRECISIONS), default=PRECISION,
+                        help='filter state and covariance precision (default: %(default)s)')
+    parser.add_argument('--out', default=None, help='CSV results file (default: stdout)')
+    args = parser.parse_args(argv)
+
+    configs = grid(var_imu_f=args.var_imu_f, var_imu_w=args.var_imu_w, var_gnss=args.var_gnss,
+                   var_lidar=args.var_lidar, c_li=args.c_li)
+    if args.batch:
+        results = batch_sweep(args.data, configs, args.precision)
+    else:
+        results = sweep(args.data, configs, args.workers, args.precision)
+    if args.out is None:
+        write(results, sys.stdout)
+    else:
+        with open(args.out, 'w', newline='') as file:
+            write(results, file)
+
+
+if __name__ == '__main__':
+    main()